@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Measure CAM/ARP ingestion throughput of ``gather_cam_arp``.
+
+Feeds synthetic FDB and ARP tables of ``--entries`` rows each, spread over
+``--ports`` interfaces, into a throwaway test database in place of real
+SNMP walks. The first pass creates every host and the second refreshes
+them, as a rescan would. Reports entries per second and queries issued.
+
+Usage: python benchmarks/cam_arp_ingest.py [--entries 100000] [--ports 48]
+"""
+import argparse
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "optinoc.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+
+from inventory import snmp  # noqa: E402
+from inventory.models import Device, Host, Interface  # noqa: E402
+
+
+def _tables(entries, ports):
+    def mac(n):
+        return [2, 0, (n >> 24) & 255, (n >> 16) & 255, (n >> 8) & 255, n & 255]
+
+    return {
+        snmp.IF_NAME_OID: [(f"{snmp.IF_NAME_OID}.{p}", f"Gi1/0/{p}") for p in range(1, ports + 1)],
+        snmp.DOT1D_BASE_PORT_IFINDEX_OID: [
+            (f"{snmp.DOT1D_BASE_PORT_IFINDEX_OID}.{p}", p) for p in range(1, ports + 1)
+        ],
+        snmp.DOT1D_TP_FDB_PORT_OID: [
+            (f"{snmp.DOT1D_TP_FDB_PORT_OID}.{'.'.join(map(str, mac(n)))}", 1 + n % ports)
+            for n in range(entries)
+        ],
+        snmp.IP_NET_TO_MEDIA_PHYSADDR_OID: [
+            (f"{snmp.IP_NET_TO_MEDIA_PHYSADDR_OID}.{1 + n % ports}.10.{(n >> 16) & 255}."
+             f"{(n >> 8) & 255}.{n & 255}", bytes(mac(n)))
+            for n in range(entries)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000, help="rows in each of the FDB and ARP tables")
+    parser.add_argument("--ports", type=int, default=48)
+    args = parser.parse_args()
+
+    tables = _tables(args.entries, args.ports)
+
+    def fake_walk(oid, *args, **kwargs):
+        return iter(tables.get(oid, []))
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        device = Device.objects.create(hostname="core", management_ip="192.0.2.1")
+        Interface.objects.bulk_create(
+            Interface(device=device, name=f"Gi1/0/{p}") for p in range(1, args.ports + 1)
+        )
+        print(f"{args.entries} FDB + {args.entries} ARP entries, {connection.vendor}")
+        for label in ("initial", "rescan"):
+            with patch.object(snmp, "snmp_walk", side_effect=fake_walk), \
+                 CaptureQueriesContext(connection) as ctx:
+                began = time.perf_counter()
+                snmp.gather_cam_arp("192.0.2.1")
+                elapsed = time.perf_counter() - began
+            print(
+                f"{label:>8}: {2 * args.entries / elapsed:10.0f} entries/s, "
+                f"{elapsed:6.2f}s, {len(ctx.captured_queries)} queries"
+            )
+        print(f"   hosts: {Host.objects.count()}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
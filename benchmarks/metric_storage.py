@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Compare the ``records``, ``chunks`` and ``rra`` metric stores.
+
+Writes ``--series`` series of ``--samples`` samples each, polled every
+five minutes with a little timing jitter and gauge-like values, into a
+throwaway test database through each store. Reports database bytes per
+sample (table plus indexes, from the growth of the database file), the
+compressed payload of the chunk store, and the latency of a one-day range
+query against each. Round-robin archive files go to a temporary directory
+and are measured by their size, which is fixed
+whatever the number of samples.
+
+Usage: python benchmarks/metric_storage.py [--series 50] [--samples 2016]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "optinoc.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from inventory.metrics import ChunkStore, MetricWriter, RecordStore  # noqa: E402
+from inventory.models import Device, Interface, MetricChunk, MetricRecord  # noqa: E402
+from inventory.rra import RoundRobinStore  # noqa: E402
+
+INTERVAL = timedelta(minutes=5)
+
+
+def _database_bytes():
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("PRAGMA page_count")
+            pages = cursor.fetchone()[0]
+            cursor.execute("PRAGMA page_size")
+            return pages * cursor.fetchone()[0]
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT pg_total_relation_size(%s) + pg_total_relation_size(%s)",
+                [MetricRecord._meta.db_table, MetricChunk._meta.db_table],
+            )
+            return cursor.fetchone()[0]
+    raise SystemExit(f"Cannot measure table size on {connection.vendor}")
+
+
+def _directory_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    )
+
+
+def _series(count):
+    device = Device.objects.create(hostname="bench", management_ip="192.0.2.1")
+    return [Interface.objects.create(device=device, name=f"eth{i}") for i in range(count)]
+
+
+def _write(store, interfaces, samples, start):
+    rng = random.Random(1)
+    values = {iface.pk: rng.uniform(10, 90) for iface in interfaces}
+    with MetricWriter(batch_size=len(interfaces), flush_interval=3600, store=store) as writer:
+        for n in range(samples):
+            cycle = start + n * INTERVAL
+            for iface in interfaces:
+                values[iface.pk] = round(max(0.0, values[iface.pk] + rng.gauss(0, 2)), 1)
+                jitter = timedelta(milliseconds=rng.choice((0, 0, 0, 1, 2, 250)))
+                writer.add(iface.device, "util", values[iface.pk], cycle + jitter, interface=iface)
+
+
+def _query_latency(store, interfaces, start, end, repeat):
+    times = []
+    for _ in range(repeat):
+        iface = random.choice(interfaces)
+        began = time.perf_counter()
+        store.series("util", interface=iface, start=start, end=end)
+        times.append(time.perf_counter() - began)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--series", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=2016, help="samples per series (default one week)")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    rra_dir = tempfile.TemporaryDirectory()
+    try:
+        interfaces = _series(args.series)
+        start = timezone.now().replace(microsecond=0) - args.samples * INTERVAL
+        end = start + args.samples * INTERVAL
+        day = (end - timedelta(days=1), end)
+        total = args.series * args.samples
+
+        print(f"{args.series} series x {args.samples} samples, {connection.vendor}")
+        stores = (
+            ("records", RecordStore()),
+            ("chunks", ChunkStore()),
+            ("rra", RoundRobinStore(rra_dir.name, queue=False)),
+        )
+        for label, store in stores:
+            before = _database_bytes()
+            began = time.perf_counter()
+            _write(store, interfaces, args.samples, start)
+            write_time = time.perf_counter() - began
+            if label == "rra":
+                size = _directory_bytes(rra_dir.name)
+            else:
+                size = _database_bytes() - before
+            latency = _query_latency(store, interfaces, *day, args.queries)
+            print(
+                f"{label:>8}: {size / total:7.2f} bytes/sample on disk, "
+                f"write {write_time / total * 1e6:7.1f}us/sample, "
+                f"1-day range query {latency * 1e3:7.2f}ms"
+            )
+        payload = sum(len(bytes(data)) for data in MetricChunk.objects.values_list("data", flat=True))
+        print(f"   chunk payload: {payload / total:.2f} bytes/sample")
+    finally:
+        rra_dir.cleanup()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Measure per-request SNMP session overhead with and without pooling.
+
+Simulates a polling cycle over ``--devices`` targets with ``--requests``
+SNMP calls per device (a scan, neighbor discovery and CAM/ARP collection
+issue more than a dozen). No packets are sent; only the cost of building
+the engine, credentials and transport for each request is timed.
+
+Usage: python benchmarks/snmp_sessions.py [--devices 1000] [--requests 12]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "optinoc.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from inventory import snmp  # noqa: E402
+
+
+def _targets(count):
+    return [f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}" for i in range(1, count + 1)]
+
+
+def run_fresh(targets, requests):
+    for target in targets:
+        for _ in range(requests):
+            if snmp.SnmpEngine is not None:
+                snmp.SnmpEngine()
+            snmp._new_session(target, "public", 161, 1, 0)
+
+
+def run_pooled(targets, requests):
+    snmp.session_pool.clear()
+    for target in targets:
+        for _ in range(requests):
+            if snmp.SnmpEngine is not None:
+                snmp.session_pool.engine()
+            snmp._session(target, "public", 161, 1, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=12)
+    args = parser.parse_args()
+
+    if snmp.SnmpEngine is None and snmp.Client is None:
+        sys.exit("No SNMP library available")
+    backend = "pysnmp" if snmp.SnmpEngine is not None else "puresnmp"
+    targets = _targets(args.devices)
+    total = args.devices * args.requests
+
+    results = {}
+    for label, func in (("fresh", run_fresh), ("pooled", run_pooled)):
+        start = time.perf_counter()
+        func(targets, args.requests)
+        results[label] = time.perf_counter() - start
+
+    print(f"backend: {backend}, {args.devices} devices x {args.requests} requests")
+    for label, elapsed in results.items():
+        print(f"{label:>7}: {elapsed:8.3f}s total, {elapsed / total * 1e6:8.1f}us per request")
+    saved = results["fresh"] - results["pooled"]
+    print(f"  saved: {saved:8.3f}s per cycle ({saved / total * 1e6:.1f}us per request)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Normalised, indexable forms of MAC and IP addresses.
+
+MACs arrive from SNMP, ``ip neigh`` and users as ``aa:bb:..``, ``aa-bb-..``,
+``aabb.ccdd.eeff`` or bare hex; as a 48-bit integer they compare and sort
+the same whatever the spelling, and a prefix such as an OUI becomes an
+integer range. IP addresses are packed into 16 bytes, IPv4 as
+IPv4-mapped IPv6, so one byte-ordered column holds both families and a
+subnet is a contiguous range of it.
+"""
+import ipaddress
+import re
+
+MAC_BITS = 48
+_SEPARATORS = re.compile(r"[\s:.\-]")
+_IPV4_MAPPED = b"\x00" * 10 + b"\xff\xff"
+
+
+def _mac_digits(text):
+    digits = _SEPARATORS.sub("", str(text)).lower()
+    if not re.fullmatch(r"[0-9a-f]*", digits):
+        raise ValueError(f"Invalid MAC address {text!r}")
+    return digits
+
+
+def mac_to_int(text):
+    """Return the MAC *text* as an integer, or None if it is not a MAC."""
+    try:
+        digits = _mac_digits(text)
+    except ValueError:
+        return None
+    return int(digits, 16) if len(digits) == MAC_BITS // 4 else None
+
+
+def int_to_mac(value):
+    return value.to_bytes(MAC_BITS // 8, "big").hex(":")
+
+
+def mac_range(prefix):
+    """Return the inclusive integer range of MACs starting with *prefix*.
+
+    *prefix* is any number of leading hex digits, in any of the accepted
+    spellings; ``00:11:22`` is an OUI. Raises ValueError if it is not one.
+    """
+    digits = _mac_digits(prefix)
+    if not digits or len(digits) > MAC_BITS // 4:
+        raise ValueError(f"Invalid MAC prefix {prefix!r}")
+    free = MAC_BITS - 4 * len(digits)
+    low = int(digits, 16) << free
+    return low, low | ((1 << free) - 1)
+
+
+def pack_ip(text):
+    """Return the IP address *text* as 16 bytes, or None if it is not one."""
+    try:
+        address = ipaddress.ip_address(str(text).strip())
+    except ValueError:
+        return None
+    if address.version == 4:
+        return _IPV4_MAPPED + address.packed
+    return address.packed
+
+
+def network_range(cidr):
+    """Return the inclusive range of packed addresses in the network *cidr*.
+
+    Host bits are ignored. Raises ValueError if *cidr* is not a network.
+    """
+    network = ipaddress.ip_network(str(cidr).strip(), strict=False)
+    first, last = network.network_address.packed, network.broadcast_address.packed
+    if network.version == 4:
+        return _IPV4_MAPPED + first, _IPV4_MAPPED + last
+    return first, last
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Device, Interface, Connection, Tag, AlertProfile, Alert
+from .models import (
+    Device, Interface, Connection, Neighbor, Tag, AlertProfile, Alert, ChangeRecord, PollCycle,
+)
 
 
 @admin.register(Device)
@@ -18,9 +20,15 @@ class ConnectionAdmin(admin.ModelAdmin):
     list_display = ('interface_a', 'interface_b')
 
 
+@admin.register(Neighbor)
+class NeighborAdmin(admin.ModelAdmin):
+    list_display = ('device', 'protocol', 'address')
+    list_filter = ('protocol',)
+
+
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
-    list_display = ('name',)
+    list_display = ('name', 'poll_interval')
 
 
 @admin.register(AlertProfile)
@@ -33,3 +41,14 @@ class AlertProfileAdmin(admin.ModelAdmin):
 class AlertAdmin(admin.ModelAdmin):
     list_display = ('device', 'metric', 'value', 'threshold', 'timestamp', 'cleared_at')
     list_filter = ('metric', 'cleared_at')
+
+
+@admin.register(ChangeRecord)
+class ChangeRecordAdmin(admin.ModelAdmin):
+    list_display = ('device', 'interface_name', 'field', 'old_value', 'new_value', 'timestamp')
+    list_filter = ('field',)
+
+
+@admin.register(PollCycle)
+class PollCycleAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'finished_at', 'shards_done', 'shards', 'polled', 'devices', 'max_late')
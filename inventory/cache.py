@@ -0,0 +1,116 @@
+"""Short-lived cache for SNMP walk results shared by scan, discovery and polling.
+
+Entries live for ``SNMP_WALK_CACHE_TTL`` seconds, roughly one discovery or
+poll cycle. By default the cache is per process; set
+``SNMP_WALK_CACHE_URL`` to a Redis URL so every Celery worker shares it.
+"""
+import pickle
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_WALK_CACHE_TTL = 60
+KEY_PREFIX = "optinoc:snmp:"
+# purge expired local entries once the cache grows past this many keys
+LOCAL_PURGE_THRESHOLD = 10000
+
+
+class LocalCache:
+    """In-process cache with per-entry expiry."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= LOCAL_PURGE_THRESHOLD:
+                self._entries = {
+                    k: entry for k, entry in self._entries.items() if entry[0] >= now
+                }
+            self._entries[key] = (now + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+class RedisCache:
+    """Cache kept in Redis so walks are shared between Celery workers.
+
+    Redis errors are treated as cache misses so an unavailable server only
+    costs the extra SNMP walks, never a failed scan.
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        try:
+            data = self._client.get(KEY_PREFIX + key)
+        except Exception:
+            return None
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        try:
+            self._client.set(KEY_PREFIX + key, pickle.dumps(value), ex=max(1, int(ttl)))
+        except Exception:
+            pass
+
+    def delete(self, key):
+        try:
+            self._client.delete(KEY_PREFIX + key)
+        except Exception:
+            pass
+
+    def clear(self):
+        try:
+            keys = list(self._client.scan_iter(match=KEY_PREFIX + "*"))
+            if keys:
+                self._client.delete(*keys)
+        except Exception:
+            pass
+
+
+local_cache = LocalCache()
+_redis_caches = {}
+
+
+def walk_cache():
+    """Return the cache backend configured by ``SNMP_WALK_CACHE_URL``."""
+    url = getattr(settings, "SNMP_WALK_CACHE_URL", "")
+    if not url:
+        return local_cache
+    cache = _redis_caches.get(url)
+    if cache is None:
+        cache = _redis_caches[url] = RedisCache(url)
+    return cache
+
+
+def walk_cache_ttl():
+    """Return the walk cache lifetime in seconds; 0 disables caching."""
+    return getattr(settings, "SNMP_WALK_CACHE_TTL", DEFAULT_WALK_CACHE_TTL)
@@ -1,4 +1,9 @@
 import ipaddress
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, deque
 
 # Only scan addresses within these RFC1918 private ranges
 PRIVATE_NETWORKS = [
@@ -17,6 +22,7 @@ def _is_private(ip):
     return any(addr in net for net in PRIVATE_NETWORKS)
 
 from django.conf import settings
+from django.db import connection, connections
 from .snmp import (
     scan_device,
     discover_neighbors,
@@ -24,11 +30,23 @@ from .snmp import (
     discover_ospf_neighbors,
     discover_ospfv3_neighbors,
     discover_bgp_neighbors,
+    device_snmp_options,
+    save_change_markers,
+    unchanged_device,
 )
-from .models import Host, Device
+from .models import Connection, Device, Host, Neighbor
 from .server import discover_local_server
 
 DEFAULT_COMMUNITY = "public"
+DEFAULT_DISCOVERY_WORKERS = 16
+# scans of an address that raised are retried until it has failed this often
+SCAN_ATTEMPTS = 2
+DEFAULT_FANOUT_WINDOW = 256
+CRAWL_KEY_PREFIX = "optinoc:crawl:"
+# keys of an abandoned distributed crawl expire after this many seconds
+CRAWL_KEY_TTL = 86400
+
+logger = logging.getLogger(__name__)
 
 
 def _get_modules():
@@ -36,59 +54,316 @@ def _get_modules():
     return {m.strip().lower() for m in modules}
 
 
-def _crawl_network(seed_ips, community=DEFAULT_COMMUNITY):
-    """Discover devices starting from a list of seed IPs."""
-    discover_local_server()
+def _store_neighbors(device, protocol, addresses):
+    """Replace the stored *protocol* peers of *device* with *addresses*."""
+    addresses = {address for address in addresses if address}
+    Neighbor.objects.filter(device=device, protocol=protocol).exclude(address__in=addresses).delete()
+    Neighbor.objects.bulk_create(
+        [Neighbor(device=device, protocol=protocol, address=address) for address in addresses],
+        ignore_conflicts=True,
+    )
+
+
+def _known_neighbors(device, modules):
+    """Return the addresses recorded for *device*: hosts, routing peers and linked devices."""
+    hosts = Host.objects.filter(interface__device=device).values_list("ip_address", flat=True)
+    peers = Neighbor.objects.filter(device=device, protocol__in=modules).values_list("address", flat=True)
+    linked = (
+        Connection.objects.filter(interface_a__device=device)
+        .exclude(interface_b__device__management_ip__isnull=True)
+        .values_list("interface_b__device__management_ip", flat=True)
+    )
+    return list(hosts) + list(peers) + list(linked)
 
-    visited = set()
-    queue = [ip for ip in seed_ips if ip]
 
-    while queue:
-        ip = queue.pop(0)
-        if ip in visited:
-            continue
-        if not _is_private(ip):
-            continue
+def scan_and_expand(ip, community=DEFAULT_COMMUNITY, skip_unchanged=False):
+    """Scan the device at *ip* and return the addresses discovery should follow.
 
-        device = scan_device(ip, community)
+    Returns None if the device did not answer. With *skip_unchanged*, a
+    known device whose SNMP change markers have not moved since its last
+    full scan is not rescanned, and the hosts, routing peers and CDP/LLDP
+    neighbours recorded for it are followed instead. The markers are only
+    stored once every phase of a full scan succeeded.
+    """
+    modules = _get_modules()
+    device = unchanged_device(ip, community) if skip_unchanged else None
+    if device is None:
+        device = scan_device(ip, community, save_markers=False)
         if device is None:
             # device unreachable or SNMP failed
-            continue
+            return None
 
-        visited.add(ip)
-        modules = _get_modules()
+        options = device_snmp_options(device)
         if {"cdp", "lldp"} & modules:
             discover_neighbors(ip, community)
         if "arp" in modules:
             gather_cam_arp(ip, community)
-        new_ips = []
-        if "ospf" in modules:
-            new_ips.extend(discover_ospf_neighbors(ip, community))
-        if "ospfv3" in modules:
-            new_ips.extend(discover_ospfv3_neighbors(ip, community))
-        if "bgp" in modules:
-            new_ips.extend(discover_bgp_neighbors(ip, community))
-
-        hosts = Host.objects.filter(interface__device=device).values_list(
-            "ip_address", flat=True
-        )
-        for host_ip in hosts:
-            if host_ip and host_ip not in visited and _is_private(host_ip):
-                queue.append(host_ip)
-        for n_ip in new_ips:
-            if n_ip and n_ip not in visited and _is_private(n_ip):
-                queue.append(n_ip)
+        for protocol, discover in (
+            ("ospf", discover_ospf_neighbors),
+            ("ospfv3", discover_ospfv3_neighbors),
+            ("bgp", discover_bgp_neighbors),
+        ):
+            if protocol in modules:
+                _store_neighbors(device, protocol, discover(ip, community, **options))
+        save_change_markers(device)
+
+    return _known_neighbors(device, modules)
+
+
+class _Frontier:
+    """Deduplicated crawl frontier shared by the discovery workers.
+
+    Addresses are marked as seen when they are queued, so each one is
+    scanned at most once however many devices report it. A scan that
+    raised, rather than finding nothing, is queued again until it has
+    failed ``SCAN_ATTEMPTS`` times.
+    """
+
+    def __init__(self, seed_ips, private_only=True):
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._seen = set()
+        self._active = 0
+        self._failures = Counter()
+        self._private_only = private_only
+        self.visited = set()
+        for ip in seed_ips:
+            self._add(ip)
+
+    def _add(self, ip):
+        if ip and ip not in self._seen and (_is_private(ip) or not self._private_only):
+            self._seen.add(ip)
+            self._queue.append(ip)
+
+    def get(self):
+        """Return the next address to scan, or None once the crawl is done."""
+        with self._cond:
+            while not self._queue and self._active:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            self._active += 1
+            return self._queue.popleft()
+
+    def done(self, ip, found, failed=False):
+        """Record the result of scanning *ip*.
+
+        *found* is None if the device did not answer; *failed* means the
+        scan raised and may be retried.
+        """
+        with self._cond:
+            self._active -= 1
+            if failed:
+                self._failures[ip] += 1
+                if self._failures[ip] < SCAN_ATTEMPTS:
+                    self._queue.append(ip)
+            elif found is not None:
+                self.visited.add(ip)
+                for next_ip in found:
+                    self._add(next_ip)
+            self._cond.notify_all()
+
+
+def _crawl_worker(frontier, visit):
+    while True:
+        ip = frontier.get()
+        if ip is None:
+            return
+        found = None
+        failed = True
+        try:
+            found = visit(ip)
+            failed = False
+        except Exception:
+            logger.exception("Discovery of %s failed", ip)
+        finally:
+            frontier.done(ip, found, failed)
+
+
+def _threaded_crawl_worker(frontier, visit):
+    try:
+        _crawl_worker(frontier, visit)
+    finally:
+        # each worker thread opened its own database connection
+        connections.close_all()
+
+
+def _run_workers(frontier, visit, workers):
+    """Drain *frontier* with *visit* on *workers* threads; return the visited set."""
+    if workers == 1:
+        _crawl_worker(frontier, visit)
+    else:
+        threads = [
+            threading.Thread(
+                target=_threaded_crawl_worker,
+                args=(frontier, visit),
+                name=f"discovery-{n}",
+                daemon=True,
+            )
+            for n in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return frontier.visited
+
+
+def _discovery_workers(workers=None):
+    """Return the number of crawl threads, *workers* or ``DISCOVERY_WORKERS``.
+
+    Unset or 0 means 1 on SQLite, which locks the whole database for every
+    write, and ``DEFAULT_DISCOVERY_WORKERS`` on other backends.
+    """
+    if not workers:
+        workers = getattr(settings, "DISCOVERY_WORKERS", 0)
+    if not workers:
+        workers = 1 if connection.vendor == "sqlite" else DEFAULT_DISCOVERY_WORKERS
+    return max(1, int(workers))
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisFrontier:
+    """Crawl frontier and visited set kept in Redis for a distributed crawl.
 
+    Like :class:`_Frontier`, addresses are deduplicated when queued.
+    """
+
+    def __init__(self, client, crawl_id=None):
+        self._client = client
+        prefix = f"{CRAWL_KEY_PREFIX}{crawl_id or uuid.uuid4().hex}:"
+        self._seen_key = prefix + "seen"
+        self._queue_key = prefix + "queue"
+        self._visited_key = prefix + "visited"
+
+    def add(self, ips):
+        for ip in ips:
+            if ip and _is_private(ip) and self._client.sadd(self._seen_key, ip):
+                self._client.rpush(self._queue_key, ip)
+        for key in (self._seen_key, self._queue_key):
+            self._client.expire(key, CRAWL_KEY_TTL)
+
+    def retry(self, ip):
+        """Queue *ip* again; it is already marked as seen."""
+        self._client.rpush(self._queue_key, ip)
+
+    def pop(self):
+        """Return the next queued address, or None if the queue is empty."""
+        return _decode(self._client.lpop(self._queue_key))
+
+    def mark_visited(self, ip):
+        self._client.sadd(self._visited_key, ip)
+        self._client.expire(self._visited_key, CRAWL_KEY_TTL)
+
+    def visited(self):
+        return {_decode(ip) for ip in self._client.smembers(self._visited_key)}
+
+    def clear(self):
+        self._client.delete(self._seen_key, self._queue_key, self._visited_key)
+
+
+def _crawl_redis():
+    import redis
+
+    url = getattr(settings, "DISCOVERY_REDIS_URL", "") or settings.CELERY_BROKER_URL
+    return redis.Redis.from_url(url)
+
+
+def _distributed_crawl(seed_ips, community=DEFAULT_COMMUNITY, skip_unchanged=False, window=None,
+                       client=None, poll_interval=0.2):
+    """Crawl by dispatching one ``scan_device_task`` per address to Celery.
+
+    The coordinator keeps up to *window* tasks in flight and merges the
+    addresses each returns into a :class:`RedisFrontier`. A failed task is
+    dispatched again until its address has failed ``SCAN_ATTEMPTS`` times.
+    It stops once the frontier is empty and no task is pending.
+    """
+    from .tasks import scan_device_task
+
+    if window is None:
+        window = getattr(settings, "DISCOVERY_FANOUT_WINDOW", DEFAULT_FANOUT_WINDOW)
+    frontier = RedisFrontier(client or _crawl_redis())
+    frontier.add(seed_ips)
+    pending = {}
+    failures = Counter()
+    try:
+        while True:
+            while len(pending) < window:
+                ip = frontier.pop()
+                if ip is None:
+                    break
+                pending[ip] = scan_device_task.delay(ip, community, skip_unchanged)
+            if not pending:
+                break
+            finished = [ip for ip, result in pending.items() if result.ready()]
+            if not finished:
+                time.sleep(poll_interval)
+                continue
+            for ip in finished:
+                result = pending.pop(ip)
+                if not result.successful():
+                    logger.error("Discovery of %s failed: %r", ip, result.result)
+                    failures[ip] += 1
+                    if failures[ip] < SCAN_ATTEMPTS:
+                        frontier.retry(ip)
+                    continue
+                if result.result is not None:
+                    frontier.mark_visited(ip)
+                    frontier.add(result.result)
+        return list(frontier.visited())
+    finally:
+        frontier.clear()
+
+
+def _crawl_network(seed_ips, community=DEFAULT_COMMUNITY, skip_unchanged=False, workers=None,
+                   distributed=False):
+    """Discover devices starting from a list of seed IPs.
+
+    Up to *workers* devices (``DISCOVERY_WORKERS`` by default) are scanned
+    at once; with a single worker the crawl runs in the calling thread.
+    With *distributed*, devices are scanned by Celery workers instead.
+    """
+    discover_local_server()
+    if distributed:
+        return _distributed_crawl(seed_ips, community, skip_unchanged)
+
+    visited = _run_workers(
+        _Frontier(seed_ips),
+        lambda ip: scan_and_expand(ip, community, skip_unchanged),
+        _discovery_workers(workers),
+    )
     return list(visited)
 
 
-def discover_network(seed_ip, community=DEFAULT_COMMUNITY):
+def scan_devices(ips, community=DEFAULT_COMMUNITY, workers=None):
+    """Scan each of *ips* once, in parallel, without following neighbors.
+
+    Unlike a crawl, public addresses are scanned too. Returns the
+    addresses that answered.
+    """
+
+    def visit(ip):
+        return [] if scan_device(ip, community) is not None else None
+
+    visited = _run_workers(_Frontier(ips, private_only=False), visit, _discovery_workers(workers))
+    return list(visited)
+
+
+def discover_network(seed_ip, community=DEFAULT_COMMUNITY, workers=None, distributed=False):
     """Iteratively discover network starting from a single seed IP."""
-    return _crawl_network([seed_ip], community)
+    return _crawl_network([seed_ip], community, workers=workers, distributed=distributed)
 
 
-def periodic_scan(community=DEFAULT_COMMUNITY):
-    """Rescan known devices and expand discovery based on ARP entries."""
+def periodic_scan(community=DEFAULT_COMMUNITY, full=False, workers=None, distributed=False):
+    """Rescan known devices and expand discovery based on ARP entries.
+
+    Devices that report no change since their last full scan are skipped
+    until ``SCAN_FULL_INTERVAL`` forces a full rescan; pass *full* to rescan
+    everything now.
+    """
     server = discover_local_server()
 
     seeds = []
@@ -103,11 +378,15 @@ def periodic_scan(community=DEFAULT_COMMUNITY):
 
     seeds.extend(
         ip
-        for ip in Device.objects.exclude(management_ip__isnull=True)
-        .exclude(management_ip="")
-        .values_list("management_ip", flat=True)
+        # GenericIPAddressField turns "" into NULL, so exclude(management_ip="")
+        # would match nothing and drop every known device
+        for ip in Device.objects.exclude(management_ip__isnull=True).values_list(
+            "management_ip", flat=True
+        )
         if ip
     )
 
-    return _crawl_network(seeds, community)
+    return _crawl_network(
+        seeds, community, skip_unchanged=not full, workers=workers, distributed=distributed
+    )
 
@@ -19,6 +19,9 @@ class DeviceCredentialsForm(forms.ModelForm):
         model = Device
         fields = [
             "snmp_community",
+            "snmp_version",
+            "snmp_max_repetitions",
+            "poll_interval",
             "ssh_username",
             "ssh_password",
             "roadblocks",
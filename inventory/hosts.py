@@ -0,0 +1,109 @@
+"""Bulk upserts of hosts learned from CAM, ARP and neighbour tables.
+
+A core switch can report tens of thousands of MACs. Rather than a
+``get_or_create`` and ``save`` per entry, hosts are consumed from an
+iterator in batches of ``HOST_BATCH_SIZE`` and each batch is merged into
+:class:`~inventory.models.Host` with one ``INSERT ... ON CONFLICT`` keyed on
+``mac_address``, so a whole table is never held in memory and the query
+count grows with the number of batches, not entries.
+
+:func:`search_hosts` looks hosts up by MAC, MAC prefix, IP or subnet
+through the indexed ``mac_int`` and ``ip_packed`` columns (see
+:mod:`inventory.addresses`), as range scans rather than string matches.
+"""
+from collections import defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.utils import timezone
+
+from .addresses import mac_range, mac_to_int, network_range, pack_ip
+from .models import Host
+
+DEFAULT_HOST_BATCH_SIZE = 2000
+
+
+def format_mac(octets):
+    """Return *octets* (bytes or ints) as a lower-case colon-separated MAC."""
+    return bytes(octets).hex(":")
+
+
+def _merge(batch, fields):
+    """Collapse duplicate MACs in *batch*, later non-empty values winning."""
+    merged = {}
+    for host in batch:
+        current = merged.get(host.mac_address)
+        if current is None:
+            merged[host.mac_address] = host
+            continue
+        for field in fields:
+            value = getattr(host, field)
+            if value is not None:
+                setattr(current, field, value)
+    return merged.values()
+
+
+def upsert_hosts(hosts, fields, batch_size=None):
+    """Create or update unsaved :class:`Host` objects from the iterable *hosts*.
+
+    *fields* are the columns an existing host takes from the entry; a field
+    left as None on an entry keeps its stored value. ``last_seen`` is set
+    once per batch. Returns the number of entries merged.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, "HOST_BATCH_SIZE", DEFAULT_HOST_BATCH_SIZE)
+    fields = tuple(fields)
+    hosts = iter(hosts)
+    total = 0
+    while True:
+        batch = list(islice(hosts, max(1, batch_size)))
+        if not batch:
+            return total
+        total += len(batch)
+        now = timezone.now()
+        # rows updating different columns need their own statement
+        groups = defaultdict(list)
+        for host in _merge(batch, fields):
+            host.last_seen = now
+            host.set_address_keys()
+            present = tuple(field for field in fields if getattr(host, field) is not None)
+            groups[present].append(host)
+        for present, rows in groups.items():
+            Host.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=["mac_address"],
+                update_fields=[
+                    *present, *(["ip_packed"] if "ip_address" in present else []),
+                    "mac_int", "last_seen",
+                ],
+            )
+
+
+def search_hosts(mac=None, mac_prefix=None, ip=None, subnet=None):
+    """Return hosts matching every criterion given.
+
+    *mac* and *ip* match exactly in any common spelling, *mac_prefix* is
+    leading hex digits such as an OUI, and *subnet* is a network in CIDR
+    notation. Results are ordered by the column searched. Raises
+    ValueError for values that cannot be parsed.
+    """
+    hosts = Host.objects.all()
+    order = "pk"
+    if mac:
+        value = mac_to_int(mac)
+        if value is None:
+            raise ValueError(f"Invalid MAC address {mac!r}")
+        hosts = hosts.filter(mac_int=value)
+    if mac_prefix:
+        hosts = hosts.filter(mac_int__range=mac_range(mac_prefix))
+        order = "mac_int"
+    if ip:
+        packed = pack_ip(ip)
+        if packed is None:
+            raise ValueError(f"Invalid IP address {ip!r}")
+        hosts = hosts.filter(ip_packed=packed)
+    if subnet:
+        hosts = hosts.filter(ip_packed__range=network_range(subnet))
+        order = "ip_packed"
+    return hosts.order_by(order)
@@ -0,0 +1,186 @@
+"""ICMP echo engine that pings many hosts at once from a single socket.
+
+Unprivileged ICMP datagram sockets are used where the kernel allows them
+(see ``net.ipv4.ping_group_range``), raw sockets otherwise. Replies are
+matched to requests by identifier and sequence number, so a whole batch
+completes within one timeout window instead of one per host. Only IPv4
+targets are supported.
+"""
+import asyncio
+import ipaddress
+import random
+import socket
+import struct
+import time
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+PAYLOAD = b"optinoc-ping".ljust(32, b".")
+RECV_SIZE = 2048
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def echo_request(ident, seq, payload=PAYLOAD):
+    """Build an ICMP echo request packet."""
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+
+def parse_reply(packet, raw):
+    """Return ``(ident, seq)`` if *packet* is an echo reply, else None.
+
+    Raw sockets deliver the IP header in front of the ICMP message;
+    datagram sockets do not.
+    """
+    if raw:
+        if not packet:
+            return None
+        packet = packet[(packet[0] & 0x0F) * 4:]
+    if len(packet) < 8:
+        return None
+    icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", packet[:8])
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+
+def open_socket():
+    """Return ``(sock, raw)``, preferring an unprivileged datagram socket.
+
+    Raises PermissionError when neither kind of ICMP socket may be opened.
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        raw = False
+    except OSError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        raw = True
+    sock.setblocking(False)
+    return sock, raw
+
+
+def is_ipv4(host):
+    try:
+        return ipaddress.ip_address(host).version == 4
+    except ValueError:
+        return False
+
+
+class RateLimiter:
+    """Space packets out to at most *rate* per second across coroutines.
+
+    A rate of 0 or None disables the limit.
+    """
+
+    def __init__(self, rate=None):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Pinger:
+    """Send echo requests to many hosts over one socket and collect RTTs."""
+
+    def __init__(self, limiter=None):
+        self._limiter = limiter or RateLimiter()
+
+    async def ping(self, hosts, timeout=1.0):
+        """Ping each IPv4 address in *hosts* once.
+
+        Returns a dict mapping every host to its round trip time in seconds,
+        or None if no reply arrived within *timeout*.
+        """
+        results = await self.probe(hosts, count=1, timeout=timeout)
+        return {host: rtts[0] for host, rtts in results.items()}
+
+    async def probe(self, hosts, count=1, interval=0.0, timeout=1.0):
+        """Send *count* echo requests to each host, one round every *interval*.
+
+        All rounds share the socket and the final *timeout*, so the batch
+        takes about ``(count - 1) * interval + timeout`` seconds. Returns a
+        dict mapping every host to a list of *count* round trip times in
+        seconds, with None for each probe that got no reply.
+        """
+        loop = asyncio.get_running_loop()
+        results = {host: [None] * count for host in hosts}
+        sock, raw = open_socket()
+        if raw:
+            # raw sockets see every reply on the host; tell ours apart
+            ident = random.randrange(0x10000)
+        else:
+            # the kernel replaces the identifier with the socket's port
+            sock.bind(("", 0))
+            ident = sock.getsockname()[1]
+        pending = {}
+        finished = asyncio.Event()
+        sending = True
+
+        def on_readable():
+            while True:
+                try:
+                    packet, address = sock.recvfrom(RECV_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    return
+                received = time.monotonic()
+                reply = parse_reply(packet, raw)
+                if reply is None or reply[0] != ident:
+                    continue
+                entry = pending.pop((address[0], reply[1]), None)
+                if entry is not None:
+                    host, probe, sent = entry
+                    results[host][probe] = received - sent
+                if not pending and not sending:
+                    finished.set()
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            targets = [host for host in results if is_ipv4(host)]
+            seq = 0
+            for probe in range(count):
+                if probe:
+                    await asyncio.sleep(max(0.0, round_start + interval - time.monotonic()))
+                round_start = time.monotonic()
+                for host in targets:
+                    await self._limiter.wait()
+                    seq = (seq + 1) & 0xFFFF
+                    pending[(host, seq)] = (host, probe, time.monotonic())
+                    packet = echo_request(ident, seq)
+                    while True:
+                        try:
+                            sock.sendto(packet, (host, 0))
+                            break
+                        except (BlockingIOError, InterruptedError):
+                            # send buffer full; let replies drain
+                            await asyncio.sleep(0.001)
+                        except OSError:
+                            pending.pop((host, seq), None)
+                            break
+            sending = False
+            if pending:
+                try:
+                    await asyncio.wait_for(finished.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        return results
@@ -0,0 +1,35 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from inventory.metrics import backfill_rollups
+
+
+def _parse_moment(value):
+    try:
+        moment = parse_datetime(value)
+        day = parse_date(value) if moment is None else None
+    except ValueError:
+        moment = day = None
+    if moment is None:
+        if day is None:
+            raise CommandError(f"Invalid date: {value}")
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = "Build the hourly and daily rollups missing for stored raw metric samples"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Start date or time (default: oldest sample)')
+        parser.add_argument('--until', help='End date or time (default: now)')
+
+    def handle(self, *args, **options):
+        since = _parse_moment(options['since']) if options['since'] else None
+        until = _parse_moment(options['until']) if options['until'] else None
+        created = backfill_rollups(since, until)
+        self.stdout.write(self.style.SUCCESS(f"Created {created} rollups"))
@@ -7,9 +7,16 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('seed_ip')
         parser.add_argument('--community', default='public')
+        parser.add_argument('--workers', type=int, help='Devices to scan in parallel')
+        parser.add_argument(
+            '--distributed', action='store_true',
+            help='Fan device scans out to Celery workers'
+        )
 
     def handle(self, *args, **options):
         seed_ip = options['seed_ip']
         community = options['community']
-        visited = discover_network(seed_ip, community)
+        visited = discover_network(
+            seed_ip, community, workers=options['workers'], distributed=options['distributed']
+        )
         self.stdout.write(self.style.SUCCESS(f"Discovered {len(visited)} devices"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from inventory.partitions import INTERVALS, convert_to_partitioned
+
+
+class Command(BaseCommand):
+    help = "Convert the MetricRecord table to time-range partitions (PostgreSQL only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', choices=sorted(INTERVALS),
+            help='Partition range (default: METRIC_PARTITION_INTERVAL)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            created = convert_to_partitioned(options['interval'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(
+            self.style.SUCCESS(f"Partitioned metric table; created {len(created)} partitions")
+        )
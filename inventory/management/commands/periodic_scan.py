@@ -6,8 +6,17 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--community', default='public')
+        parser.add_argument('--full', action='store_true', help='Rescan devices even if unchanged')
+        parser.add_argument('--workers', type=int, help='Devices to scan in parallel')
+        parser.add_argument(
+            '--distributed', action='store_true',
+            help='Fan device scans out to Celery workers'
+        )
 
     def handle(self, *args, **options):
         community = options['community']
-        scanned = periodic_scan(community)
+        scanned = periodic_scan(
+            community, full=options['full'], workers=options['workers'],
+            distributed=options['distributed'],
+        )
         self.stdout.write(self.style.SUCCESS(f"Scanned {len(scanned)} devices"))
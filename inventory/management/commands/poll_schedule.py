@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from inventory.schedule import poll_schedule
+
+
+class Command(BaseCommand):
+    help = "Show each device's metric poll interval, next poll and lateness"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--late', action='store_true',
+            help='Only list devices past their deadline'
+        )
+
+    def handle(self, *args, **options):
+        rows = poll_schedule()
+        if options['late']:
+            rows = [row for row in rows if row['late']]
+        now = timezone.now()
+        for row in rows:
+            device = row['device']
+            line = (
+                f"{device.hostname or device.management_ip:<30} every {row['interval']:>5}s "
+                f"at +{row['offset']:<5} next in {(row['next_poll'] - now).total_seconds():>7.0f}s"
+            )
+            if row['late']:
+                line = self.style.WARNING(f"{line}  late by {row['late']:.0f}s")
+            self.stdout.write(line)
+        late = sum(1 for row in rows if row['late'])
+        self.stdout.write(self.style.SUCCESS(f"{len(rows)} devices, {late} past their deadline"))
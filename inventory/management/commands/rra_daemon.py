@@ -0,0 +1,35 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from inventory.rra import run_daemon
+
+
+class Command(BaseCommand):
+    help = "Apply queued round-robin archive updates in batches (METRIC_RRA_QUEUE_URL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Updates applied per batch (default: 10000)'
+        )
+        parser.add_argument(
+            '--flush-interval', type=float, default=5.0,
+            help='Seconds a queued update may wait before its batch is applied (default: 5)'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the queue once and exit'
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        applied = run_daemon(
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            once=options['once'],
+            stop=stop,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Applied {applied} archive updates"))
@@ -11,6 +11,11 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--seed', help='Seed IP address for initial discovery')
         parser.add_argument('--community', default='public')
+        parser.add_argument('--workers', type=int, help='Devices to scan in parallel')
+        parser.add_argument(
+            '--distributed', action='store_true',
+            help='Fan device scans out to Celery workers'
+        )
         parser.add_argument(
             '--async', action='store_true', dest='async',
             help='Run the scan asynchronously via Celery'
@@ -20,18 +25,24 @@ class Command(BaseCommand):
         community = options['community']
         seed_ip = options.get('seed')
         use_async = options.get('async')
+        workers = options.get('workers')
+        distributed = options.get('distributed')
 
         if seed_ip:
             if use_async:
                 from inventory.tasks import discover_network_task
-                result = discover_network_task.delay(seed_ip, community)
+                result = discover_network_task.delay(
+                    seed_ip, community, workers=workers, distributed=distributed
+                )
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'Started async discover_network task {result.id}'
                     )
                 )
             else:
-                visited = discover_network(seed_ip, community)
+                visited = discover_network(
+                    seed_ip, community, workers=workers, distributed=distributed
+                )
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'Discovered {len(visited)} devices'
@@ -40,14 +51,14 @@ class Command(BaseCommand):
         else:
             if use_async:
                 from inventory.tasks import periodic_scan_task
-                result = periodic_scan_task.delay(community)
+                result = periodic_scan_task.delay(community, workers=workers, distributed=distributed)
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'Started async periodic_scan task {result.id}'
                     )
                 )
             else:
-                scanned = periodic_scan(community)
+                scanned = periodic_scan(community, workers=workers, distributed=distributed)
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'Scanned {len(scanned)} devices'
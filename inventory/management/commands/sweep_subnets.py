@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from inventory.sweep import sweep_networks, sweep_subnets
+
+
+class Command(BaseCommand):
+    help = "Sweep subnets with ICMP and SNMP probes and scan the devices that respond"
+
+    def add_arguments(self, parser):
+        parser.add_argument('cidrs', nargs='+', help='Networks to sweep, e.g. 10.1.0.0/16')
+        parser.add_argument('--community', default='public')
+        parser.add_argument('--concurrency', type=int, help='Maximum probes in flight')
+        parser.add_argument('--rate', type=int, help='Maximum packets per second')
+        parser.add_argument('--timeout', type=float, default=1.0, help='Probe timeout in seconds')
+        parser.add_argument('--no-icmp', action='store_true', help='Skip the ICMP sweep')
+        parser.add_argument('--no-snmp', action='store_true', help='Skip the SNMP sysName probe')
+        parser.add_argument('--no-scan', action='store_true', help='Only report responders')
+        parser.add_argument('--workers', type=int, help='Devices to scan in parallel')
+        parser.add_argument(
+            '--min-prefix', type=int, dest='min_prefix',
+            help='Shortest prefix length allowed (default: SWEEP_MIN_PREFIX)'
+        )
+        parser.add_argument(
+            '--async', action='store_true', dest='async',
+            help='Run the sweep asynchronously via Celery'
+        )
+
+    def handle(self, *args, **options):
+        cidrs = options['cidrs']
+        try:
+            sweep_networks(cidrs, options['min_prefix'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options['async']:
+            from inventory.tasks import sweep_subnets_task
+            result = sweep_subnets_task.delay(
+                cidrs, options['community'], concurrency=options['concurrency'],
+                rate=options['rate'], timeout=options['timeout'], icmp=not options['no_icmp'],
+                snmp_probe=not options['no_snmp'], scan=not options['no_scan'],
+                workers=options['workers'], min_prefix=options['min_prefix'],
+            )
+            self.stdout.write(self.style.SUCCESS(f'Started async sweep_subnets task {result.id}'))
+            return
+
+        result = sweep_subnets(
+            cidrs, options['community'], concurrency=options['concurrency'],
+            rate=options['rate'], timeout=options['timeout'], icmp=not options['no_icmp'],
+            snmp_probe=not options['no_snmp'], scan=not options['no_scan'],
+            workers=options['workers'], min_prefix=options['min_prefix'],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Swept {result['addresses']} addresses in {result['wall_time']:.1f}s: "
+                f"{len(result['responders'])} responded, {len(result['scanned'])} scanned"
+            )
+        )
@@ -0,0 +1,561 @@
+"""Buffered ingestion and pluggable storage of metric samples.
+
+Pollers hand samples to a :class:`MetricWriter`, which writes them in bulk
+once ``METRIC_BATCH_SIZE`` are buffered or the oldest has waited
+``METRIC_FLUSH_INTERVAL`` seconds, instead of one INSERT per sample.
+
+``METRIC_BACKEND`` selects where samples go: ``records`` keeps one
+:class:`MetricRecord` row per sample, ``chunks`` packs each series into
+compressed :class:`MetricChunk` rows (see :mod:`inventory.tsdb`). Readers
+use :func:`get_store` and do not need to know which is active.
+``METRIC_INTERFACE_BACKEND`` may send interface octet counters elsewhere,
+such as the round-robin archive files of :mod:`inventory.rra`; use
+:func:`store_for` to find the store of a given series.
+
+Every flush also folds its samples into hourly and daily
+:class:`MetricRollup` rows, which answer long-range queries that do not
+need every raw sample. :func:`backfill_rollups` (``manage.py
+backfill_rollups``) builds them for samples stored before that.
+"""
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import tsdb
+from .models import MetricChunk, MetricRecord, MetricRollup
+
+DEFAULT_METRIC_BATCH_SIZE = 1000
+DEFAULT_METRIC_FLUSH_INTERVAL = 5.0
+DEFAULT_METRIC_BACKEND = "records"
+DEFAULT_METRIC_CHUNK_SAMPLES = 120
+DEVICE_METRICS = ("cpu", "memory")
+INTERFACE_METRICS = ("in_octets", "out_octets")
+# coarsest first: (tier, bucket width, retention setting, default days)
+ROLLUP_TIERS = (
+    ("day", timedelta(days=1), "METRIC_DAILY_RETENTION_DAYS", 730),
+    ("hour", timedelta(hours=1), "METRIC_HOURLY_RETENTION_DAYS", 90),
+)
+ROLLUP_WIDTHS = {tier: width for tier, width, _, _ in ROLLUP_TIERS}
+ROLLUP_AGGREGATES = ("avg", "min", "max", "last", "count")
+ROLLUP_FIELDS = ("count", "total", "min", "max", "last", "last_timestamp")
+ROLLUP_WRITE_ATTEMPTS = 3
+# rows per UPDATE statement when bulk_update rewrites chunks and rollups
+UPDATE_BATCH_SIZE = 500
+
+Sample = namedtuple("Sample", "timestamp value")
+
+
+def _bucket(timestamp, width):
+    return tsdb.EPOCH + (timestamp - tsdb.EPOCH) // width * width
+
+
+def _retention(setting, default):
+    days = getattr(settings, setting, default)
+    return timedelta(days=days) if days else None
+
+
+def _merge(rollup, count, total, low, high, last, last_timestamp):
+    rollup.count += count
+    rollup.total += total
+    rollup.min = min(rollup.min, low)
+    rollup.max = max(rollup.max, high)
+    if last_timestamp >= rollup.last_timestamp:
+        rollup.last, rollup.last_timestamp = last, last_timestamp
+
+
+def _partial_rollups(records):
+    """Aggregate *records* into unsaved rollups keyed by (series, tier, bucket)."""
+    partials = {}
+    for record in records:
+        if record.device_id is None:
+            continue
+        value = record.value
+        for tier, width, _, _ in ROLLUP_TIERS:
+            bucket = _bucket(record.timestamp, width)
+            key = (record.device_id, record.interface_id, record.metric, tier, bucket)
+            rollup = partials.get(key)
+            if rollup is None:
+                partials[key] = MetricRollup(
+                    device_id=record.device_id,
+                    interface_id=record.interface_id,
+                    metric=record.metric,
+                    tier=tier,
+                    bucket=bucket,
+                    count=1,
+                    total=value,
+                    min=value,
+                    max=value,
+                    last=value,
+                    last_timestamp=record.timestamp,
+                )
+            else:
+                _merge(rollup, 1, value, value, value, value, record.timestamp)
+    return partials
+
+
+def _locked_rollups(partials):
+    return MetricRollup.objects.select_for_update().filter(
+        device_id__in={key[0] for key in partials},
+        metric__in={key[2] for key in partials},
+        bucket__in={key[4] for key in partials},
+    )
+
+
+def _store_rollups(partials):
+    updated = []
+    for rollup in _locked_rollups(partials):
+        key = (rollup.device_id, rollup.interface_id, rollup.metric, rollup.tier, rollup.bucket)
+        partial = partials.pop(key, None)
+        if partial is not None:
+            _merge(rollup, *(getattr(partial, name) for name in ROLLUP_FIELDS))
+            updated.append(rollup)
+    MetricRollup.objects.bulk_create(partials.values())
+    MetricRollup.objects.bulk_update(updated, ROLLUP_FIELDS, batch_size=UPDATE_BATCH_SIZE)
+
+
+def update_rollups(records):
+    """Fold *records* into the hourly and daily rollups of their series.
+
+    Existing buckets are locked and merged into. If another writer creates
+    one of the new buckets first, the insert fails on the unique
+    constraint and the whole batch is retried, merging into its row.
+    """
+    partials = _partial_rollups(records)
+    if not partials:
+        return
+    for attempt in range(ROLLUP_WRITE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _store_rollups(dict(partials))
+            return
+        except IntegrityError:
+            if attempt == ROLLUP_WRITE_ATTEMPTS - 1:
+                raise
+            # keys handed out by the rolled back insert are gone
+            for rollup in partials.values():
+                rollup.pk = None
+                rollup._state.adding = True
+
+
+def _raw_records(start, end):
+    """Yield unsaved MetricRecords for every stored raw sample in [*start*, *end*)."""
+    yield from MetricRecord.objects.filter(timestamp__gte=start, timestamp__lt=end).iterator()
+    chunks = MetricChunk.objects.filter(start__lt=end, end__gte=start).values_list(
+        "device_id", "interface_id", "metric", "data", "count"
+    )
+    for device_id, interface_id, metric, data, count in chunks.iterator():
+        for timestamp, value in tsdb.decode(bytes(data), count):
+            if start <= timestamp < end:
+                yield MetricRecord(
+                    device_id=device_id, interface_id=interface_id, metric=metric,
+                    value=value, timestamp=timestamp,
+                )
+
+
+def backfill_rollups(since=None, until=None):
+    """Create the rollups missing for raw samples between *since* and *until*.
+
+    For history written before rollups were kept. Raw ``MetricRecord`` and
+    ``MetricChunk`` samples are read a day at a time, and only buckets that
+    have no rollup yet are written, so it can be run again at any time and
+    never adds to a bucket the writers already maintain. Defaults to all
+    stored samples. Returns the number of rollups created.
+    """
+    if since is None:
+        firsts = [
+            MetricRecord.objects.aggregate(first=Min("timestamp"))["first"],
+            MetricChunk.objects.aggregate(first=Min("start"))["first"],
+        ]
+        firsts = [first for first in firsts if first is not None]
+        if not firsts:
+            return 0
+        since = min(firsts)
+    until = until or timezone.now()
+    day = ROLLUP_WIDTHS["day"]
+    created = 0
+    start = _bucket(since, day)
+    while start < until:
+        end = start + day
+        partials = _partial_rollups(_raw_records(max(start, since), min(end, until)))
+        existing = set(
+            MetricRollup.objects.filter(bucket__gte=start, bucket__lt=end).values_list(
+                "device_id", "interface_id", "metric", "tier", "bucket"
+            )
+        )
+        missing = [rollup for key, rollup in partials.items() if key not in existing]
+        # a bucket a writer creates meanwhile is kept as it is
+        MetricRollup.objects.bulk_create(missing, batch_size=1000, ignore_conflicts=True)
+        created += len(missing)
+        start = end
+    return created
+
+
+def rollup_tier(start, resolution, now=None):
+    """Return the coarsest tier for a query, or None to use raw samples.
+
+    A tier qualifies if its buckets are no wider than *resolution* seconds
+    and its retention still reaches back to *start*.
+    """
+    now = now or timezone.now()
+    for tier, width, setting, default in ROLLUP_TIERS:
+        if width.total_seconds() > resolution:
+            continue
+        retention = _retention(setting, default)
+        if start is not None and retention is not None and start < now - retention:
+            continue
+        return tier
+    return None
+
+
+def rollup_series(tier, metric, device=None, interface=None, start=None, end=None, aggregate="avg"):
+    """Return one sample per *tier* bucket, oldest first, stamped with the bucket start."""
+    rollups = MetricRollup.objects.filter(tier=tier, metric=metric)
+    if device is not None:
+        rollups = rollups.filter(device=device)
+    if interface is not None:
+        rollups = rollups.filter(interface=interface)
+    if start:
+        rollups = rollups.filter(bucket__gte=_bucket(start, ROLLUP_WIDTHS[tier]))
+    if end:
+        rollups = rollups.filter(bucket__lte=end)
+    return [Sample(rollup.bucket, getattr(rollup, aggregate)) for rollup in rollups.order_by("bucket")]
+
+
+def prune_rollups(now=None):
+    """Delete rollups older than their tier's retention; return counts per tier."""
+    now = now or timezone.now()
+    deleted = {}
+    for tier, _, setting, default in ROLLUP_TIERS:
+        retention = _retention(setting, default)
+        if retention is not None:
+            deleted[tier], _ = MetricRollup.objects.filter(tier=tier, bucket__lt=now - retention).delete()
+    return deleted
+
+
+class BaseStore:
+    """Query interface shared by the metric stores."""
+
+    # whether MetricWriter should fold this store's samples into MetricRollup
+    keeps_rollups = True
+
+    def series(self, metric, device=None, interface=None, start=None, end=None,
+               resolution=None, aggregate="avg"):
+        """Return the samples of *metric* between *start* and *end*, oldest first.
+
+        With *resolution*, the widest spacing in seconds the caller can use,
+        the coarsest rollup tier that fits is read instead of raw samples;
+        *aggregate* then picks which of its values is returned.
+        """
+        tier = rollup_tier(start, resolution) if resolution else None
+        if tier is not None:
+            return rollup_series(tier, metric, device, interface, start, end, aggregate)
+        return self.raw_series(metric, device, interface, start, end)
+
+
+class RecordStore(BaseStore):
+    """One :class:`MetricRecord` row per sample."""
+
+    def write(self, records):
+        MetricRecord.objects.bulk_create(records)
+
+    def _records(self, metric, device, interface):
+        records = MetricRecord.objects.filter(metric=metric)
+        if device is not None:
+            records = records.filter(device=device)
+        if interface is not None:
+            records = records.filter(interface=interface)
+        return records
+
+    def raw_series(self, metric, device=None, interface=None, start=None, end=None):
+        records = self._records(metric, device, interface)
+        if start:
+            records = records.filter(timestamp__gte=start)
+        if end:
+            records = records.filter(timestamp__lte=end)
+        return [Sample(*row) for row in records.order_by("timestamp").values_list("timestamp", "value")]
+
+    def latest(self, metric, device=None, interface=None):
+        """Return the newest sample of *metric*, or None."""
+        row = (
+            self._records(metric, device, interface)
+            .order_by("-timestamp")
+            .values_list("timestamp", "value")
+            .first()
+        )
+        return Sample(*row) if row else None
+
+
+class _Head:
+    """Open chunk of a series; ``saved`` samples of it are in the database."""
+
+    def __init__(self, pk=None, saved=0, encoder=None):
+        self.pk = pk
+        self.saved = saved
+        self.encoder = encoder or tsdb.ChunkEncoder()
+
+
+class ChunkStore(BaseStore):
+    """Series stored as compressed :class:`MetricChunk` rows.
+
+    The newest chunk of a series is its head. It takes new samples until it
+    holds ``METRIC_CHUNK_SAMPLES``, and is cached in memory so appending
+    does not decode it again. Each write locks the cached heads it touches
+    and reloads any whose stored sample count moved, so processes sharing a
+    series never overwrite each other, then saves every chunk with one bulk
+    insert and one bulk update. Samples older than the head go into chunks
+    of their own. Timestamps are kept to the millisecond.
+    """
+
+    def __init__(self, chunk_samples=None):
+        if chunk_samples is None:
+            chunk_samples = getattr(settings, "METRIC_CHUNK_SAMPLES", DEFAULT_METRIC_CHUNK_SAMPLES)
+        self.chunk_samples = max(2, chunk_samples)
+        self._heads = {}
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        series = defaultdict(list)
+        for record in records:
+            key = (record.device_id, record.interface_id, record.metric)
+            series[key].append((record.timestamp, record.value))
+        with self._lock, transaction.atomic():
+            heads = self._current_heads(series)
+            created, updated = [], []
+            for key, samples in series.items():
+                samples.sort(key=itemgetter(0))
+                heads[key] = self._append(key, heads[key], samples, created, updated)
+            MetricChunk.objects.bulk_create([chunk for _, chunk in created])
+            MetricChunk.objects.bulk_update(
+                updated, ["start", "end", "count", "data"], batch_size=UPDATE_BATCH_SIZE
+            )
+            for head, chunk in created:
+                head.pk = chunk.pk
+            for head in heads.values():
+                head.saved = head.encoder.count
+        # backends that cannot return new primary keys reload the head next time
+        self._heads.update((key, head) for key, head in heads.items() if head.pk is not None)
+
+    def _current_heads(self, keys):
+        heads = {key: self._heads.pop(key) for key in keys if key in self._heads}
+        stored = {
+            pk: ((device_id, interface_id, metric), count)
+            for pk, device_id, interface_id, metric, count in MetricChunk.objects.select_for_update()
+            .filter(pk__in=[head.pk for head in heads.values()])
+            .values_list("pk", "device_id", "interface_id", "metric", "count")
+        }
+        for key in keys:
+            head = heads.get(key)
+            if head is None or stored.get(head.pk) != (key, head.saved):
+                heads[key] = self._load_head(key)
+        return heads
+
+    def _load_head(self, key):
+        device_id, interface_id, metric = key
+        chunk = (
+            MetricChunk.objects.select_for_update()
+            .filter(device_id=device_id, interface_id=interface_id, metric=metric)
+            .order_by("-end", "-pk")
+            .first()
+        )
+        if chunk is None or chunk.count >= self.chunk_samples:
+            return _Head()
+        samples = tsdb.decode(bytes(chunk.data), chunk.count)
+        return _Head(chunk.pk, chunk.count, tsdb.ChunkEncoder.from_samples(samples))
+
+    def _append(self, key, head, samples, created, updated):
+        """Append *samples* to *head*, queuing finished chunks; return the new head."""
+        last = head.encoder.last if head.encoder.count else None
+        late = [sample for sample in samples if last is not None and tsdb.to_millis(sample[0]) < last]
+        for timestamp, value in samples[len(late):]:
+            if head.encoder.count >= self.chunk_samples:
+                self._queue(key, head, created, updated)
+                head = _Head()
+            head.encoder.append(timestamp, value)
+        self._queue(key, head, created, updated)
+        for i in range(0, len(late), self.chunk_samples):
+            chunk = _Head(encoder=tsdb.ChunkEncoder.from_samples(late[i:i + self.chunk_samples]))
+            self._queue(key, chunk, created, updated)
+        return head
+
+    def _queue(self, key, head, created, updated):
+        encoder = head.encoder
+        if encoder.count == head.saved:
+            return
+        device_id, interface_id, metric = key
+        chunk = MetricChunk(
+            pk=head.pk,
+            device_id=device_id,
+            interface_id=interface_id,
+            metric=metric,
+            start=tsdb.from_millis(encoder.first),
+            end=tsdb.from_millis(encoder.last),
+            count=encoder.count,
+            data=encoder.getvalue(),
+        )
+        if head.pk is None:
+            created.append((head, chunk))
+        else:
+            updated.append(chunk)
+
+    def _chunks(self, metric, device, interface):
+        chunks = MetricChunk.objects.filter(metric=metric)
+        if device is not None:
+            chunks = chunks.filter(device=device)
+        if interface is not None:
+            chunks = chunks.filter(interface=interface)
+        return chunks
+
+    def raw_series(self, metric, device=None, interface=None, start=None, end=None):
+        chunks = self._chunks(metric, device, interface)
+        if start:
+            chunks = chunks.filter(end__gte=start)
+        if end:
+            chunks = chunks.filter(start__lte=end)
+        samples = []
+        for data, count in chunks.values_list("data", "count"):
+            samples.extend(
+                Sample(*sample)
+                for sample in tsdb.decode(bytes(data), count)
+                if (not start or sample[0] >= start) and (not end or sample[0] <= end)
+            )
+        samples.sort(key=itemgetter(0))
+        return samples
+
+    def latest(self, metric, device=None, interface=None):
+        """Return the newest sample of *metric*, or None."""
+        chunk = self._chunks(metric, device, interface).order_by("-end").values_list("data", "count").first()
+        if chunk is None:
+            return None
+        return Sample(*max(tsdb.decode(bytes(chunk[0]), chunk[1]), key=itemgetter(0)))
+
+
+STORES = {
+    "records": RecordStore,
+    "chunks": ChunkStore,
+    "rra": "inventory.rra.RoundRobinStore",
+}
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(name=None):
+    """Return the shared store for *name*, by default ``METRIC_BACKEND``."""
+    if name is None:
+        name = getattr(settings, "METRIC_BACKEND", DEFAULT_METRIC_BACKEND)
+    with _stores_lock:
+        if name not in _stores:
+            if name not in STORES:
+                raise ImproperlyConfigured(
+                    f"Unknown METRIC_BACKEND {name!r}; choose from {', '.join(STORES)}"
+                )
+            store = STORES[name]
+            _stores[name] = (import_string(store) if isinstance(store, str) else store)()
+        return _stores[name]
+
+
+def store_for(metric, interface=None):
+    """Return the store that holds *metric*, honouring ``METRIC_INTERFACE_BACKEND``."""
+    if interface is not None and metric in INTERFACE_METRICS:
+        return get_store(getattr(settings, "METRIC_INTERFACE_BACKEND", "") or None)
+    return get_store()
+
+
+class MetricWriter:
+    """Buffer metric samples and write them in bulk to *store*.
+
+    Use as a context manager, or call :meth:`flush` when done, so the last
+    partial batch is written. *flush_interval* is only checked when a
+    sample is added, so a writer that stops receiving samples keeps its
+    buffer until it is flushed.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, store=None):
+        if batch_size is None:
+            batch_size = getattr(settings, "METRIC_BATCH_SIZE", DEFAULT_METRIC_BATCH_SIZE)
+        if flush_interval is None:
+            flush_interval = getattr(
+                settings, "METRIC_FLUSH_INTERVAL", DEFAULT_METRIC_FLUSH_INTERVAL
+            )
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.store = store
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def add(self, device, metric, value, timestamp=None, interface=None):
+        """Buffer one sample; *timestamp* defaults to now."""
+        record = MetricRecord(
+            device=device,
+            interface=interface,
+            metric=metric,
+            value=value,
+            timestamp=timestamp or timezone.now(),
+        )
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(record)
+            due = (
+                len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._oldest >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def add_device_metrics(self, device, metrics, timestamp=None):
+        """Buffer the samples of a :func:`inventory.snmp.poll_metrics` result.
+
+        Interfaces are matched by name with one lookup per device; samples
+        for interfaces the inventory does not know are dropped.
+        """
+        timestamp = timestamp or timezone.now()
+        for metric in DEVICE_METRICS:
+            if metrics.get(metric) is not None:
+                self.add(device, metric, metrics[metric], timestamp)
+        if_metrics = metrics.get("interfaces") or {}
+        if not if_metrics:
+            return
+        interfaces = {iface.name: iface for iface in device.interfaces.all()}
+        for name, values in if_metrics.items():
+            iface = interfaces.get(name)
+            if iface is None:
+                continue
+            for metric in INTERFACE_METRICS:
+                if values.get(metric) is not None:
+                    self.add(device, metric, values[metric], timestamp, interface=iface)
+
+    def flush(self):
+        """Write all buffered samples.
+
+        Without an explicit store, each sample goes where :func:`store_for` says.
+        """
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            self._oldest = None
+        batches = defaultdict(list)
+        for record in records:
+            store = self.store or store_for(record.metric, record.interface)
+            batches[store].append(record)
+        # samples and the rollups they feed are written together or not at all
+        with transaction.atomic():
+            for store, batch in batches.items():
+                store.write(batch)
+                if store.keeps_rollups:
+                    update_rollups(batch)
+        return len(records)
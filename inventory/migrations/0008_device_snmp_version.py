@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0007_device_ping_fields"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="snmp_max_repetitions",
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="snmp_version",
+            field=models.CharField(
+                blank=True,
+                choices=[("1", "SNMPv1"), ("2c", "SNMPv2c")],
+                max_length=4,
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0008_device_snmp_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="sys_uptime",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="if_table_last_change",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="lldp_last_change",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_interfaces(apps, schema_editor):
+    """Fold duplicate (device, name) interfaces into the oldest row."""
+    Interface = apps.get_model("inventory", "Interface")
+    Host = apps.get_model("inventory", "Host")
+    MetricRecord = apps.get_model("inventory", "MetricRecord")
+    Connection = apps.get_model("inventory", "Connection")
+
+    duplicates = (
+        Interface.objects.values("device_id", "name")
+        .annotate(count=Count("id"), keep=Min("id"))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        extra = list(
+            Interface.objects.filter(device_id=row["device_id"], name=row["name"])
+            .exclude(pk=row["keep"])
+            .values_list("pk", flat=True)
+        )
+        Host.objects.filter(interface_id__in=extra).update(interface_id=row["keep"])
+        MetricRecord.objects.filter(interface_id__in=extra).update(interface_id=row["keep"])
+        Connection.objects.filter(interface_a_id__in=extra).update(interface_a_id=row["keep"])
+        Connection.objects.filter(interface_b_id__in=extra).update(interface_b_id=row["keep"])
+        Interface.objects.filter(pk__in=extra).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0009_device_change_markers"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_interfaces, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0010_merge_duplicate_interfaces"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="interface",
+            constraint=models.UniqueConstraint(
+                fields=("device", "name"), name="unique_interface_name_per_device"
+            ),
+        ),
+    ]
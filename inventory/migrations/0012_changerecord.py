@@ -0,0 +1,48 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0011_interface_unique_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("interface_name", models.CharField(blank=True, max_length=255)),
+                ("field", models.CharField(max_length=50)),
+                ("old_value", models.CharField(blank=True, max_length=255)),
+                ("new_value", models.CharField(blank=True, max_length=255)),
+                ("timestamp", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="changes",
+                        to="inventory.device",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["device", "timestamp"],
+                        name="inventory_c_device__62802f_idx",
+                    )
+                ],
+            },
+        ),
+    ]
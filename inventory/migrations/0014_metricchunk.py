@@ -0,0 +1,57 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0013_metricrecord_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricChunk",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("metric", models.CharField(max_length=100)),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                ("data", models.BinaryField()),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="metric_chunks",
+                        to="inventory.device",
+                    ),
+                ),
+                (
+                    "interface",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="metric_chunks",
+                        to="inventory.interface",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["device", "interface", "metric", "end"],
+                        name="inventory_m_device__fc4f3d_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,81 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0014_metricchunk"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("metric", models.CharField(max_length=100)),
+                (
+                    "tier",
+                    models.CharField(
+                        choices=[("hour", "Hourly"), ("day", "Daily")],
+                        max_length=10,
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                ("total", models.FloatField(default=0)),
+                ("min", models.FloatField()),
+                ("max", models.FloatField()),
+                ("last", models.FloatField()),
+                ("last_timestamp", models.DateTimeField()),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="metric_rollups",
+                        to="inventory.device",
+                    ),
+                ),
+                (
+                    "interface",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="metric_rollups",
+                        to="inventory.interface",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["tier", "bucket"], name="inventory_m_tier_2a020a_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="metricrollup",
+            constraint=models.UniqueConstraint(
+                fields=("device", "interface", "metric", "tier", "bucket"),
+                name="unique_metric_rollup_bucket",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="metricrollup",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(interface__isnull=True),
+                fields=("device", "metric", "tier", "bucket"),
+                name="unique_device_metric_rollup_bucket",
+            ),
+        ),
+    ]
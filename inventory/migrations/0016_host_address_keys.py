@@ -0,0 +1,46 @@
+from django.db import migrations, models
+
+from inventory.addresses import mac_to_int, pack_ip
+
+
+def fill_address_keys(apps, schema_editor):
+    """Derive mac_int and ip_packed for existing hosts."""
+    Host = apps.get_model("inventory", "Host")
+    batch = []
+    for host in Host.objects.only("mac_address", "ip_address").iterator(chunk_size=2000):
+        host.mac_int = mac_to_int(host.mac_address)
+        host.ip_packed = pack_ip(host.ip_address) if host.ip_address else None
+        batch.append(host)
+        if len(batch) >= 2000:
+            Host.objects.bulk_update(batch, ["mac_int", "ip_packed"])
+            batch = []
+    Host.objects.bulk_update(batch, ["mac_int", "ip_packed"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0015_metricrollup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="host",
+            name="ip_packed",
+            field=models.BinaryField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name="host",
+            name="mac_int",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_address_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="host",
+            index=models.Index(fields=["mac_int"], name="inventory_h_mac_int_594e26_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="host",
+            index=models.Index(fields=["ip_packed"], name="inventory_h_ip_pack_3984c4_idx"),
+        ),
+    ]
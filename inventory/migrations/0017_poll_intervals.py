@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0016_host_address_keys"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="last_polled",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="poll_interval",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="tag",
+            name="poll_interval",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
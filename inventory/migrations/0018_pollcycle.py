@@ -0,0 +1,39 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0017_poll_intervals"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PollCycle",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("started_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("shards", models.PositiveIntegerField(default=1)),
+                ("shards_done", models.PositiveIntegerField(default=0)),
+                ("devices", models.PositiveIntegerField(default=0)),
+                ("polled", models.PositiveIntegerField(default=0)),
+                ("poll_seconds", models.FloatField(default=0)),
+                ("max_late", models.FloatField(default=0)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["started_at"], name="inventory_p_started_967cea_idx")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0018_pollcycle"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="interface",
+            name="missed_scans",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+def clear_zero_max_repetitions(apps, schema_editor):
+    """A GETBULK size of 0 never worked; fall back to the default instead."""
+    Device = apps.get_model("inventory", "Device")
+    Device.objects.filter(snmp_max_repetitions=0).update(snmp_max_repetitions=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0019_interface_missed_scans"),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_zero_max_repetitions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="device",
+            name="snmp_max_repetitions",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+    ]
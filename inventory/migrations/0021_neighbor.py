@@ -0,0 +1,48 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0020_device_snmp_max_repetitions_min"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Neighbor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "protocol",
+                    models.CharField(
+                        choices=[("ospf", "OSPF"), ("ospfv3", "OSPFv3"), ("bgp", "BGP")],
+                        max_length=10,
+                    ),
+                ),
+                ("address", models.CharField(max_length=45)),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="neighbors",
+                        to="inventory.device",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="neighbor",
+            constraint=models.UniqueConstraint(
+                fields=("device", "protocol", "address"), name="unique_neighbor_per_device"
+            ),
+        ),
+    ]
@@ -1,4 +1,14 @@
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils import timezone
+
+from .addresses import mac_to_int, pack_ip
+
+
+SNMP_VERSION_CHOICES = [
+    ("1", "SNMPv1"),
+    ("2c", "SNMPv2c"),
+]
 
 
 class Device(models.Model):
@@ -12,18 +22,29 @@ class Device(models.Model):
     model = models.CharField(max_length=255, blank=True)
     os_version = models.CharField(max_length=255, blank=True)
     snmp_community = models.CharField(max_length=255, blank=True)
+    snmp_max_repetitions = models.PositiveSmallIntegerField(
+        blank=True, null=True, validators=[MinValueValidator(1)]
+    )
     ssh_username = models.CharField(max_length=255, blank=True)
     ssh_password = models.CharField(max_length=255, blank=True)
     # discovery metadata
     last_seen = models.DateTimeField(blank=True, null=True)
     last_scanned = models.DateTimeField(blank=True, null=True)
+    # SNMP change markers (TimeTicks) recorded by the last full scan
+    sys_uptime = models.BigIntegerField(blank=True, null=True)
+    if_table_last_change = models.BigIntegerField(blank=True, null=True)
+    lldp_last_change = models.BigIntegerField(blank=True, null=True)
     discovered_snmp_community = models.CharField(max_length=255, blank=True)
+    snmp_version = models.CharField(max_length=4, blank=True, choices=SNMP_VERSION_CHOICES)
     discovered_ssh_username = models.CharField(max_length=255, blank=True)
     discovered_ssh_password = models.CharField(max_length=255, blank=True)
     roadblocks = models.TextField(blank=True)
     # availability
     is_online = models.BooleanField(default=False)
     last_ping = models.DateTimeField(blank=True, null=True)
+    # metric polling; seconds, overriding the device's tags and METRIC_POLL_INTERVAL
+    poll_interval = models.PositiveIntegerField(blank=True, null=True)
+    last_polled = models.DateTimeField(blank=True, null=True)
     tags = models.ManyToManyField('Tag', blank=True, related_name='devices')
 
     def __str__(self):
@@ -39,6 +60,13 @@ class Interface(models.Model):
     ip_address = models.GenericIPAddressField(protocol="both", unpack_ipv4=True, blank=True, null=True)
     status = models.CharField(max_length=50, blank=True)
     last_scanned = models.DateTimeField(blank=True, null=True)
+    # consecutive scans of the device that did not report the interface
+    missed_scans = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["device", "name"], name="unique_interface_name_per_device")
+        ]
 
     def __str__(self):
         return f"{self.device.hostname}:{self.name}" if self.device_id else self.name
@@ -59,10 +87,41 @@ class Connection(models.Model):
         return f"{self.interface_a} <-> {self.interface_b}"
 
 
+class Neighbor(models.Model):
+    """Routing protocol peer reported by a device.
+
+    Stored by each full scan so discovery can still follow the peers of a
+    device it skips as unchanged.
+    """
+
+    PROTOCOL_CHOICES = [
+        ("ospf", "OSPF"),
+        ("ospfv3", "OSPFv3"),
+        ("bgp", "BGP"),
+    ]
+
+    device = models.ForeignKey(Device, related_name="neighbors", on_delete=models.CASCADE)
+    protocol = models.CharField(max_length=10, choices=PROTOCOL_CHOICES)
+    # a peer address, or the router ID OSPFv3 reports instead
+    address = models.CharField(max_length=45)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["device", "protocol", "address"], name="unique_neighbor_per_device"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.device} {self.protocol} {self.address}"
+
+
 class Tag(models.Model):
     """Label for grouping devices."""
 
     name = models.CharField(max_length=50, unique=True)
+    # metric poll interval in seconds for tagged devices; the shortest tag wins
+    poll_interval = models.PositiveIntegerField(blank=True, null=True)
 
     def __str__(self):
         return self.name
@@ -88,10 +147,31 @@ class Host(models.Model):
     ip_address = models.GenericIPAddressField(protocol="both", blank=True, null=True)
     interface = models.ForeignKey(Interface, related_name="hosts", null=True, blank=True, on_delete=models.SET_NULL)
     last_seen = models.DateTimeField(blank=True, null=True)
+    # indexed forms of the addresses above, kept in step by save() and upsert_hosts()
+    mac_int = models.BigIntegerField(blank=True, null=True, editable=False)
+    ip_packed = models.BinaryField(max_length=16, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["mac_int"]),
+            models.Index(fields=["ip_packed"]),
+        ]
 
     def __str__(self):
         return self.mac_address
 
+    def set_address_keys(self):
+        """Derive ``mac_int`` and ``ip_packed`` from the string fields."""
+        self.mac_int = mac_to_int(self.mac_address)
+        self.ip_packed = pack_ip(self.ip_address) if self.ip_address else None
+
+    def save(self, *args, **kwargs):
+        self.set_address_keys()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "mac_int", "ip_packed"}
+        super().save(*args, **kwargs)
+
 
 class MetricRecord(models.Model):
     """Time-series performance metric for a device or interface."""
@@ -112,7 +192,7 @@ class MetricRecord(models.Model):
     )
     metric = models.CharField(max_length=100)
     value = models.FloatField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         indexes = [
@@ -124,6 +204,92 @@ class MetricRecord(models.Model):
         return f"{target} {self.metric}={self.value}" if target else self.metric
 
 
+class MetricChunk(models.Model):
+    """Compressed run of samples of one metric series.
+
+    Used instead of one :class:`MetricRecord` per sample when
+    ``METRIC_BACKEND`` is ``chunks``; ``data`` holds ``count`` samples
+    encoded by :mod:`inventory.tsdb`.
+    """
+
+    device = models.ForeignKey(
+        Device, related_name="metric_chunks", on_delete=models.CASCADE
+    )
+    interface = models.ForeignKey(
+        Interface,
+        related_name="metric_chunks",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    metric = models.CharField(max_length=100)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["device", "interface", "metric", "end"])
+        ]
+
+    def __str__(self):
+        target = self.interface or self.device
+        return f"{target} {self.metric} {self.start:%Y-%m-%d %H:%M} ({self.count})"
+
+
+class MetricRollup(models.Model):
+    """Aggregate of one metric series over an hour or a day."""
+
+    TIER_CHOICES = [
+        ("hour", "Hourly"),
+        ("day", "Daily"),
+    ]
+
+    device = models.ForeignKey(
+        Device, related_name="metric_rollups", on_delete=models.CASCADE
+    )
+    interface = models.ForeignKey(
+        Interface,
+        related_name="metric_rollups",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    metric = models.CharField(max_length=100)
+    tier = models.CharField(max_length=10, choices=TIER_CHOICES)
+    bucket = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    total = models.FloatField(default=0)
+    min = models.FloatField()
+    max = models.FloatField()
+    last = models.FloatField()
+    last_timestamp = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["device", "interface", "metric", "tier", "bucket"],
+                name="unique_metric_rollup_bucket",
+            ),
+            # NULLs never conflict above, so device series need their own
+            models.UniqueConstraint(
+                fields=["device", "metric", "tier", "bucket"],
+                condition=models.Q(interface__isnull=True),
+                name="unique_device_metric_rollup_bucket",
+            ),
+        ]
+        indexes = [models.Index(fields=["tier", "bucket"])]
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        target = self.interface or self.device
+        return f"{target} {self.metric} {self.tier} {self.bucket:%Y-%m-%d %H:%M}"
+
+
 class Alert(models.Model):
     """Alert triggered when a metric threshold is crossed."""
 
@@ -141,3 +307,47 @@ class Alert(models.Model):
 
     def __str__(self):
         return f"{self.device} {self.metric}={self.value}"
+
+
+class ChangeRecord(models.Model):
+    """Append-only record of a device or interface change found by a scan."""
+
+    device = models.ForeignKey(Device, related_name="changes", on_delete=models.CASCADE)
+    # interfaces are kept by name so their history outlives them
+    interface_name = models.CharField(max_length=255, blank=True)
+    field = models.CharField(max_length=50)
+    old_value = models.CharField(max_length=255, blank=True)
+    new_value = models.CharField(max_length=255, blank=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["device", "timestamp"])]
+
+    def __str__(self):
+        target = f"{self.device}:{self.interface_name}" if self.interface_name else str(self.device)
+        return f"{target} {self.field}: {self.old_value} -> {self.new_value}"
+
+
+class PollCycle(models.Model):
+    """Completion record of one metric poll cycle, however many shards ran it."""
+
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    shards = models.PositiveIntegerField(default=1)
+    shards_done = models.PositiveIntegerField(default=0)
+    devices = models.PositiveIntegerField(default=0)
+    polled = models.PositiveIntegerField(default=0)
+    # summed across shards, which run side by side
+    poll_seconds = models.FloatField(default=0)
+    # seconds the latest device was past its deadline when the cycle began
+    max_late = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["started_at"])]
+
+    def __str__(self):
+        return f"poll cycle {self.started_at:%Y-%m-%d %H:%M:%S} ({self.shards_done}/{self.shards} shards)"
+
+    @property
+    def failed(self):
+        return self.devices - self.polled
@@ -0,0 +1,280 @@
+"""Time-partitioned MetricRecord storage on PostgreSQL, and metric retention.
+
+``manage.py partition_metrics`` turns ``inventory_metricrecord`` into a
+table range-partitioned on ``timestamp`` by day or week; the existing rows
+become a single legacy partition and a default partition catches anything
+outside the prepared ranges. ``maintain_metric_partitions_task`` then keeps
+``METRIC_PARTITIONS_AHEAD`` partitions ready, and retention drops whole
+partitions once all of their rows are older than ``METRIC_RETENTION_DAYS``
+instead of deleting rows. Range queries on ``timestamp`` only touch the
+partitions they overlap.
+
+Before conversion, and on other databases, expired rows are deleted in
+batches of ``METRIC_PRUNE_BATCH_SIZE``, each in its own short transaction.
+"""
+import logging
+import re
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import MetricChunk, MetricRecord
+
+logger = logging.getLogger(__name__)
+
+TABLE = MetricRecord._meta.db_table
+LEGACY_TABLE = f"{TABLE}_legacy"
+DEFAULT_TABLE = f"{TABLE}_default"
+INTERVALS = {
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+}
+DEFAULT_METRIC_PARTITION_INTERVAL = "day"
+DEFAULT_METRIC_PARTITIONS_AHEAD = 7
+DEFAULT_METRIC_RETENTION_DAYS = 30
+DEFAULT_METRIC_PRUNE_BATCH_SIZE = 5000
+BOUND_RE = re.compile(r"FROM \((?:'([^']*)'|MINVALUE)\) TO \((?:'([^']*)'|MAXVALUE)\)")
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def _interval(interval=None):
+    interval = interval or getattr(settings, "METRIC_PARTITION_INTERVAL", DEFAULT_METRIC_PARTITION_INTERVAL)
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown partition interval {interval!r}; choose from {', '.join(INTERVALS)}")
+    return interval
+
+
+def partition_start(when, interval):
+    """Return the start of the *interval* partition holding *when* (UTC, weeks start Monday)."""
+    start = when.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "week":
+        start -= timedelta(days=start.weekday())
+    return start
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y%m%d}"
+
+
+def is_partitioned():
+    """Return True if the metric table is a partitioned PostgreSQL table."""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid))",
+            [TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def parse_bound(expression):
+    """Return ``(lower, upper)`` of a partition bound expression.
+
+    Open ends are None; the default partition gives None.
+    """
+    match = BOUND_RE.search(expression or "")
+    if not match:
+        return None
+    lower, upper = match.groups()
+    return (parse_datetime(lower) if lower else None, parse_datetime(upper) if upper else None)
+
+
+def partitions():
+    """Return ``[(name, bounds)]`` for the partitions of the metric table."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s AND pg_table_is_visible(p.oid) ORDER BY c.relname",
+            [TABLE],
+        )
+        return [(name, parse_bound(expression)) for name, expression in cursor.fetchall()]
+
+
+def convert_to_partitioned(interval=None, now=None):
+    """Rebuild the metric table as a partitioned table, keeping every row.
+
+    Runs in one transaction holding an exclusive lock on the table. The
+    old table is attached unchanged as the partition for everything before
+    the first new partition, so no rows are copied, but attaching it builds
+    a unique index on ``(id, timestamp)`` and checks its foreign keys.
+    """
+    if connection.vendor != "postgresql":
+        raise ValueError("Partitioned metric storage requires PostgreSQL")
+    interval = _interval(interval)
+    now = now or timezone.now()
+    table, legacy = _quote(TABLE), _quote(LEGACY_TABLE)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        if is_partitioned():
+            raise ValueError(f"{TABLE} is already partitioned")
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = %s AND schemaname = current_schema()",
+            [TABLE],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            f'SELECT pg_get_serial_sequence(%s, %s), max(id), max("timestamp") FROM {table}', [TABLE, "id"]
+        )
+        sequence, max_id, newest = cursor.fetchone()
+
+        # everything up to the end of the current (or newest) interval stays in the legacy partition
+        cutover = partition_start(max(now, newest or now), interval) + INTERVALS[interval]
+
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        for name, _ in indexes:
+            cursor.execute(f"ALTER INDEX {_quote(name)} RENAME TO {_quote(name[:55] + '_legacy')}")
+        for name, _ in foreign_keys:
+            cursor.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {_quote(name)}")
+        cursor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT")
+        if sequence:
+            cursor.execute(f"DROP SEQUENCE IF EXISTS {sequence}")
+
+        id_sequence = _quote(f"{TABLE}_id_seq")
+        cursor.execute(f"CREATE SEQUENCE {id_sequence} START WITH {(max_id or 0) + 1}")
+        cursor.execute(f'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")')
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{id_sequence}')")
+        cursor.execute(f"ALTER SEQUENCE {id_sequence} OWNED BY {table}.id")
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {_quote(TABLE + "_pkey")} PRIMARY KEY (id, "timestamp")')
+        for name, definition in indexes:
+            if name != f"{TABLE}_pkey":
+                cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {_quote(name)} {definition}")
+
+        # a matching check constraint lets ATTACH skip its own scan of the rows
+        cursor.execute(
+            f'ALTER TABLE {legacy} ADD CONSTRAINT {_quote(LEGACY_TABLE + "_range")} '
+            f'CHECK ("timestamp" IS NOT NULL AND "timestamp" < %s)',
+            [cutover],
+        )
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)", [cutover])
+        cursor.execute(f"CREATE TABLE {_quote(DEFAULT_TABLE)} PARTITION OF {table} DEFAULT")
+    return ensure_partitions(interval=interval, now=cutover)
+
+
+def ensure_partitions(ahead=None, interval=None, now=None):
+    """Create the partitions for the current and next *ahead* intervals.
+
+    Rows that already landed in the default partition for a new range are
+    moved into it. Ranges that overlap an existing partition, for example
+    after switching from days to weeks, are skipped. Returns the names of
+    the partitions created; does nothing unless the table is partitioned.
+    """
+    if not is_partitioned():
+        return []
+    interval = _interval(interval)
+    if ahead is None:
+        ahead = getattr(settings, "METRIC_PARTITIONS_AHEAD", DEFAULT_METRIC_PARTITIONS_AHEAD)
+    width = INTERVALS[interval]
+    first = partition_start(now or timezone.now(), interval)
+    existing = [bounds for _, bounds in partitions() if bounds]
+    created = []
+    for step in range(ahead + 1):
+        lower, upper = first + step * width, first + (step + 1) * width
+        if any((low is None or low < upper) and (high is None or high > lower) for low, high in existing):
+            continue
+        name = partition_name(lower)
+        _create_partition(name, lower, upper)
+        existing.append((lower, upper))
+        created.append(name)
+    if created:
+        logger.info("Created metric partitions %s", ", ".join(created))
+    return created
+
+
+def _create_partition(name, lower, upper):
+    table, partition, default = _quote(TABLE), _quote(name), _quote(DEFAULT_TABLE)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {default} "
+            f'WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+            f"INSERT INTO {partition} SELECT * FROM moved",
+            [lower, upper],
+        )
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)", [lower, upper])
+
+
+def drop_expired_partitions(cutoff):
+    """Drop every partition whose rows are all older than *cutoff*."""
+    dropped = []
+    for name, bounds in partitions():
+        if bounds and bounds[1] is not None and bounds[1] <= cutoff:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"ALTER TABLE {_quote(TABLE)} DETACH PARTITION {_quote(name)}")
+                cursor.execute(f"DROP TABLE {_quote(name)}")
+            dropped.append(name)
+    if dropped:
+        logger.info("Dropped metric partitions %s", ", ".join(dropped))
+    return dropped
+
+
+def delete_in_batches(queryset, batch_size=None):
+    """Delete the rows of *queryset* *batch_size* at a time; return the count."""
+    if batch_size is None:
+        batch_size = getattr(settings, "METRIC_PRUNE_BATCH_SIZE", DEFAULT_METRIC_PRUNE_BATCH_SIZE)
+    model = queryset.model
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        count, _ = model.objects.filter(pk__in=pks).delete()
+        deleted += count
+
+
+def _delete_from_default(cutoff, batch_size=None):
+    if batch_size is None:
+        batch_size = getattr(settings, "METRIC_PRUNE_BATCH_SIZE", DEFAULT_METRIC_PRUNE_BATCH_SIZE)
+    default = _quote(DEFAULT_TABLE)
+    deleted = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                f"DELETE FROM {default} WHERE ctid IN "
+                f'(SELECT ctid FROM {default} WHERE "timestamp" < %s LIMIT %s)',
+                [cutoff, batch_size],
+            )
+            if not cursor.rowcount:
+                return deleted
+            deleted += cursor.rowcount
+
+
+def prune_metric_records(now=None):
+    """Apply ``METRIC_RETENTION_DAYS`` to raw samples in either metric store.
+
+    Returns the number of rows or chunks deleted, and on a partitioned
+    table the partitions dropped.
+    """
+    days = getattr(settings, "METRIC_RETENTION_DAYS", DEFAULT_METRIC_RETENTION_DAYS)
+    if not days:
+        return {}
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    result = {}
+    if is_partitioned():
+        result["partitions"] = drop_expired_partitions(cutoff)
+        # partitions straddling the cutoff wait until they expire whole
+        result["records"] = _delete_from_default(cutoff)
+    else:
+        result["records"] = delete_in_batches(MetricRecord.objects.filter(timestamp__lt=cutoff))
+    result["chunks"] = delete_in_batches(MetricChunk.objects.filter(end__lt=cutoff))
+    return result
@@ -1,6 +1,13 @@
 from pythonping import ping
+import asyncio
 import subprocess
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .icmp import Pinger, RateLimiter, is_ipv4
+
+# threads used for hosts the batch ICMP engine cannot reach
+FALLBACK_WORKERS = 64
 
 
 def _system_ping(host: str, count: int, timeout: float) -> bool:
@@ -28,3 +35,64 @@ def check_ping(host, count=1, timeout=1.0) -> bool:
         return _system_ping(host, count, timeout)
     except Exception:
         return _system_ping(host, count, timeout)
+
+
+def ping_statistics(rtts):
+    """Summarise per-probe round trip times (seconds, None if lost).
+
+    Returns ``up``, ``packet_loss`` in percent and ``rtt_min``, ``rtt_avg``,
+    ``rtt_max`` and ``jitter`` in milliseconds; the RTT figures are None
+    when nothing answered. Jitter is the mean difference between
+    consecutive replies.
+    """
+    replies = [rtt * 1000 for rtt in rtts if rtt is not None]
+    stats = {
+        "up": bool(replies),
+        "packet_loss": 100.0 * (len(rtts) - len(replies)) / len(rtts) if rtts else 100.0,
+        "rtt_min": None,
+        "rtt_avg": None,
+        "rtt_max": None,
+        "jitter": None,
+    }
+    if replies:
+        deltas = [abs(b - a) for a, b in zip(replies, replies[1:])]
+        stats.update(
+            rtt_min=min(replies),
+            rtt_avg=sum(replies) / len(replies),
+            rtt_max=max(replies),
+            jitter=sum(deltas) / len(deltas) if deltas else 0.0,
+        )
+    return stats
+
+
+def _unmeasured(up):
+    return {"up": up, "packet_loss": None, "rtt_min": None, "rtt_avg": None, "rtt_max": None,
+            "jitter": None}
+
+
+def ping_many(hosts, count=1, interval=0.2, timeout=1.0, rate=None):
+    """Ping many hosts at once and return ``{host: statistics}``.
+
+    IPv4 hosts are pinged together from one ICMP socket, *count* probes
+    each spaced *interval* seconds apart, so the batch takes about
+    ``(count - 1) * interval + timeout`` however many hosts there are.
+    Statistics are described in :func:`ping_statistics`. Other hosts, or
+    all of them when no ICMP socket may be opened, fall back to
+    :func:`check_ping` on a thread pool and only report ``up``.
+    """
+    hosts = list(dict.fromkeys(host for host in hosts if host))
+    ipv4 = [host for host in hosts if is_ipv4(host)]
+    others = [host for host in hosts if not is_ipv4(host)]
+    results = {}
+    if ipv4:
+        try:
+            rtts = asyncio.run(Pinger(RateLimiter(rate)).probe(ipv4, count, interval, timeout))
+        except PermissionError:
+            others = hosts
+        else:
+            results.update((host, ping_statistics(probes)) for host, probes in rtts.items())
+    if others:
+        with ThreadPoolExecutor(min(len(others), FALLBACK_WORKERS)) as executor:
+            up = executor.map(lambda host: check_ping(host, count=count, timeout=timeout), others)
+            results.update((host, _unmeasured(is_up)) for host, is_up in zip(others, up))
+    return results
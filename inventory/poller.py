@@ -0,0 +1,206 @@
+"""Concurrent SNMP metric polling on asyncio.
+
+Every device is polled at the same time, bounded by a global cap on
+in-flight SNMP requests and a smaller cap per device, so a handful of dead
+devices only cost one timeout window instead of stalling the whole cycle.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from django.conf import settings
+
+from . import snmp
+from .snmp import (
+    CPU_LOAD_OID,
+    DEFAULT_COMMUNITY,
+    DEFAULT_PORT,
+    MEM_AVAIL_OID,
+    MEM_TOTAL_OID,
+    METRIC_IF_COLUMNS,
+    SNMP_V1,
+    SnmpNoResponse,
+    build_metrics,
+    device_snmp_options,
+    negotiable_versions,
+    table_rows,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_CONCURRENCY = 200
+DEFAULT_POLL_DEVICE_CONCURRENCY = 2
+
+
+class RequestLimiter:
+    """Cap in-flight SNMP requests globally and per device."""
+
+    def __init__(self, total, per_device):
+        self._total = asyncio.Semaphore(total)
+        self._per_device = per_device
+        self._devices = {}
+
+    @asynccontextmanager
+    async def slot(self, target):
+        device = self._devices.get(target)
+        if device is None:
+            device = self._devices[target] = asyncio.Semaphore(self._per_device)
+        # take the device slot first so waiting requests do not hold global ones
+        async with device:
+            async with self._total:
+                yield
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _async_client(ip, community, version, port=DEFAULT_PORT, timeout=1, retries=0):
+    key = ("async", ip, port, community, timeout, retries, version)
+    return snmp.session_pool.session(
+        key, lambda: snmp._pure_client(ip, community, port, timeout, retries, version)
+    )
+
+
+async def _poll_once(ip, community, version, max_repetitions, limiter):
+    client = _async_client(ip, community, version)
+
+    async def _walk(columns):
+        async with limiter.slot(ip):
+            if version == SNMP_V1:
+                varbinds = client.multiwalk(columns)
+            else:
+                varbinds = client.bulkwalk(columns, bulk_size=max_repetitions)
+            return [(str(vb.oid), vb.value) async for vb in varbinds]
+
+    async def _get(oids):
+        async with limiter.slot(ip):
+            return await client.multiget(oids)
+
+    cpu, memory, if_table = await asyncio.gather(
+        _walk([CPU_LOAD_OID]),
+        _get([MEM_TOTAL_OID, MEM_AVAIL_OID]),
+        _walk(METRIC_IF_COLUMNS),
+        return_exceptions=True,
+    )
+    if all(isinstance(result, Exception) for result in (cpu, memory, if_table)):
+        raise SnmpNoResponse(ip)
+
+    cpu_loads = [] if isinstance(cpu, Exception) else [_as_int(v) for _, v in cpu]
+    mem_total = mem_avail = None
+    if not isinstance(memory, Exception):
+        mem_total, mem_avail = (_as_int(v) for v in memory)
+    if_rows = [] if isinstance(if_table, Exception) else table_rows(if_table, METRIC_IF_COLUMNS)
+    return build_metrics(
+        [v for v in cpu_loads if v is not None], mem_total, mem_avail, if_rows
+    )
+
+
+async def async_poll_metrics(ip, community=DEFAULT_COMMUNITY, version=None, max_repetitions=None,
+                             limiter=None):
+    """Async counterpart of :func:`inventory.snmp.poll_metrics`.
+
+    The CPU walk, memory GET and ifTable walk run concurrently within the
+    limits of *limiter*. Returns an empty dict if the device does not answer.
+    """
+    if limiter is None:
+        limiter = RequestLimiter(DEFAULT_POLL_DEVICE_CONCURRENCY, DEFAULT_POLL_DEVICE_CONCURRENCY)
+    if not max_repetitions:
+        max_repetitions = snmp._default_max_repetitions()
+    for candidate in negotiable_versions(ip, version):
+        try:
+            metrics = await _poll_once(ip, community, candidate, max_repetitions, limiter)
+        except SnmpNoResponse:
+            continue
+        if not version:
+            # stored on the device by poll_devices, outside the event loop
+            snmp._version_hints[ip] = candidate
+        return metrics
+    return {}
+
+
+async def _threaded_poll_metrics(ip, community=DEFAULT_COMMUNITY, version=None, max_repetitions=None,
+                                 limiter=None, executor=None):
+    """Run the blocking poller in a thread when puresnmp is not installed."""
+    loop = asyncio.get_running_loop()
+    async with limiter.slot(ip):
+        return await loop.run_in_executor(
+            executor,
+            partial(snmp.poll_metrics, ip, community, version=version, max_repetitions=max_repetitions),
+        )
+
+
+def device_community(device, default_community=DEFAULT_COMMUNITY):
+    """Return the SNMP community to poll *device* with."""
+    return device.snmp_community or device.discovered_snmp_community or default_community
+
+
+def _save_negotiated_versions(devices):
+    """Store the version negotiated with each device that had none stored."""
+    for device in devices:
+        version = snmp._version_hints.get(device.management_ip)
+        if version and not device.snmp_version:
+            device.snmp_version = version
+            device.save(update_fields=["snmp_version"])
+
+
+async def _poll_all(targets, concurrency, device_concurrency, poll):
+    limiter = RequestLimiter(concurrency, device_concurrency)
+
+    async def _one(device, community):
+        try:
+            metrics = await poll(
+                device.management_ip, community, limiter=limiter, **device_snmp_options(device)
+            )
+        except Exception:
+            logger.exception("Polling %s failed", device.management_ip)
+            metrics = {}
+        return device, metrics
+
+    return await asyncio.gather(*(_one(device, community) for device, community in targets))
+
+
+def poll_devices(devices, default_community=DEFAULT_COMMUNITY, concurrency=None, device_concurrency=None,
+                 poll=None):
+    """Poll *devices* concurrently.
+
+    Returns a dict with ``results``, a list of ``(device, metrics)`` pairs in
+    the order given, and ``wall_time``, the cycle duration in seconds.
+    """
+    if concurrency is None:
+        concurrency = getattr(settings, "SNMP_POLL_CONCURRENCY", DEFAULT_POLL_CONCURRENCY)
+    if device_concurrency is None:
+        device_concurrency = getattr(
+            settings, "SNMP_POLL_DEVICE_CONCURRENCY", DEFAULT_POLL_DEVICE_CONCURRENCY
+        )
+    executor = None
+    if poll is None:
+        if snmp.Client is not None:
+            poll = async_poll_metrics
+        else:
+            executor = ThreadPoolExecutor(concurrency)
+            poll = partial(_threaded_poll_metrics, executor=executor)
+
+    targets = [
+        (device, device_community(device, default_community))
+        for device in devices
+        if device.management_ip
+    ]
+    start = time.monotonic()
+    try:
+        results = snmp.session_pool.loop().run_until_complete(
+            _poll_all(targets, concurrency, device_concurrency, poll)
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+    wall_time = time.monotonic() - start
+    _save_negotiated_versions(device for device, _ in results)
+    logger.info("Polled %d devices in %.2fs", len(results), wall_time)
+    return {"results": results, "wall_time": wall_time}
@@ -0,0 +1,141 @@
+"""Bulk, change-only reconciliation of scan results with the database.
+
+A scan reports the full set of interfaces a device has. Instead of a
+``get_or_create`` and ``save`` per interface, existing rows are loaded once
+and only the differences are written, with ``bulk_create``, ``bulk_update``
+and at most one update and one delete for missing interfaces, so the query count does
+not grow with the port count and a rescan of an unchanged device writes no
+interface rows at all. Each real change is appended to
+:class:`~inventory.models.ChangeRecord`.
+
+An interface the device stops reporting is only marked as missed, since
+deleting it also deletes its metrics, hosts and connections; it is purged
+once ``INTERFACE_PURGE_SCANS`` scans in a row have missed it.
+"""
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ChangeRecord, Interface
+
+# device fields whose changes are worth keeping in the change log
+DEVICE_LOGGED_FIELDS = ("hostname", "vendor", "model", "os_version", "management_ip")
+# ChangeRecord.field for interfaces that appear or disappear
+INTERFACE_FIELD = "interface"
+DEFAULT_INTERFACE_PURGE_SCANS = 3
+
+
+def _text(value):
+    return "" if value is None else str(value)[:255]
+
+
+def apply_changes(instance, values):
+    """Set *values* on *instance* and return ``{field: (old, new)}`` for those that changed."""
+    changes = {}
+    for field, value in values.items():
+        old = getattr(instance, field)
+        if old != value:
+            changes[field] = (old, value)
+            setattr(instance, field, value)
+    return changes
+
+
+def _record(device, field, old, new, timestamp, interface_name=""):
+    return ChangeRecord(
+        device=device,
+        interface_name=interface_name,
+        field=field,
+        old_value=_text(old),
+        new_value=_text(new),
+        timestamp=timestamp,
+    )
+
+
+def save_device_changes(device, changes, timestamp=None, log=True):
+    """Write only the changed fields of *device* and log the notable ones.
+
+    *changes* is the result of :func:`apply_changes`. Nothing is written if
+    it is empty.
+    """
+    if not changes:
+        return
+    timestamp = timestamp or timezone.now()
+    device.save(update_fields=list(changes))
+    if log:
+        ChangeRecord.objects.bulk_create(
+            _record(device, field, old, new, timestamp)
+            for field, (old, new) in changes.items()
+            if field in DEVICE_LOGGED_FIELDS
+        )
+
+
+def reconcile_interfaces(device, interfaces, fields, timestamp=None, log=True):
+    """Make the interfaces of *device* match *interfaces*.
+
+    *interfaces* maps interface name to a dict holding a value for each of
+    *fields*. Missing interfaces are created. Interfaces the device no
+    longer reports have ``missed_scans`` incremented and are deleted once it
+    reaches ``INTERFACE_PURGE_SCANS``; one reported again is reset. Existing
+    ones are only written, and stamped with *timestamp*, when a value
+    actually changed. An empty *interfaces* is treated as a failed walk and
+    touches nothing. With *log*, every change is added to the change log,
+    an interface counting as gone from its first missed scan; interfaces
+    found on a device's first scan are not logged. Returns ``(created,
+    updated, deleted)`` counts.
+    """
+    timestamp = timestamp or timezone.now()
+    existing = {iface.name: iface for iface in device.interfaces.all()}
+    log_added = log and bool(existing)
+    to_create = []
+    to_update = []
+    updated_fields = set()
+    records = []
+    for name, values in interfaces.items():
+        iface = existing.pop(name, None)
+        if iface is None:
+            to_create.append(
+                Interface(device=device, name=name, last_scanned=timestamp, **values)
+            )
+            if log_added:
+                records.append(_record(device, INTERFACE_FIELD, None, name, timestamp, name))
+            continue
+        changes = apply_changes(iface, {field: values[field] for field in fields})
+        if iface.missed_scans:
+            iface.missed_scans = 0
+            updated_fields.add("missed_scans")
+            if log:
+                records.append(_record(device, INTERFACE_FIELD, None, name, timestamp, name))
+        elif not changes:
+            continue
+        iface.last_scanned = timestamp
+        to_update.append(iface)
+        updated_fields.update(changes)
+        if log:
+            records.extend(
+                _record(device, field, old, new, timestamp, name)
+                for field, (old, new) in changes.items()
+            )
+
+    Interface.objects.bulk_create(to_create)
+    if to_update:
+        Interface.objects.bulk_update(to_update, [*sorted(updated_fields), "last_scanned"])
+    deleted = 0
+    if interfaces and existing:
+        purge_after = max(1, getattr(settings, "INTERFACE_PURGE_SCANS", DEFAULT_INTERFACE_PURGE_SCANS))
+        kept, purged = [], []
+        for iface in existing.values():
+            (purged if iface.missed_scans + 1 >= purge_after else kept).append(iface.pk)
+        if kept:
+            Interface.objects.filter(pk__in=kept).update(missed_scans=F("missed_scans") + 1)
+        if purged:
+            Interface.objects.filter(pk__in=purged).delete()
+        deleted = len(purged)
+        if log:
+            records.extend(
+                _record(device, INTERFACE_FIELD, name, None, timestamp, name)
+                for name, iface in existing.items()
+                if not iface.missed_scans
+            )
+    if records:
+        ChangeRecord.objects.bulk_create(records)
+    return len(to_create), len(to_update), deleted
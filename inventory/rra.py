@@ -0,0 +1,402 @@
+"""Fixed-size round-robin archives for metric series, in the manner of RRDtool.
+
+Each series lives in one preallocated file holding several archives. An
+archive is a ring of rows, each consolidating ``steps`` primary intervals of
+``METRIC_RRA_STEP`` seconds with one function: AVERAGE, MIN, MAX or LAST.
+Files never grow, and a sample is folded into every archive in place
+through ``mmap``, so an update costs the same however much history is kept.
+As with RRDtool, samples older than a file's last update are ignored.
+
+Select it for interface octet counters with ``METRIC_INTERFACE_BACKEND=rra``.
+With ``METRIC_RRA_QUEUE_URL`` set, writers only queue updates in Redis and
+``manage.py rra_daemon`` applies them in batches, opening each file once
+per batch however many samples it received.
+"""
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import tsdb
+from .metrics import BaseStore, Sample
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"OPTIRRA1"
+# magic, step in seconds, archive count, time of the last update
+HEADER = struct.Struct("<8sIId")
+# consolidation function, steps per row, rows, padding, newest bucket, running sum and count
+ARCHIVE = struct.Struct("<IIIIqdq")
+VALUE = struct.Struct("<d")
+NAN = VALUE.pack(math.nan)
+CONSOLIDATION_FUNCTIONS = ("AVERAGE", "MIN", "MAX", "LAST")
+AGGREGATE_FUNCTIONS = {"avg": "AVERAGE", "min": "MIN", "max": "MAX", "last": "LAST"}
+DEFAULT_METRIC_RRA_STEP = 300
+# (consolidation function, steps per row, rows): 1 week of 5-minute samples,
+# 90 days of hourly and 2 years of daily averages and peaks
+DEFAULT_METRIC_RRA_ARCHIVES = (
+    ("LAST", 1, 2016),
+    ("AVERAGE", 12, 2160),
+    ("MAX", 12, 2160),
+    ("AVERAGE", 288, 730),
+    ("MAX", 288, 730),
+)
+QUEUE_KEY = "optinoc:rra:updates"
+# updates the daemon has claimed but not yet written
+PROCESSING_KEY = QUEUE_KEY + ":processing"
+# restarts that found the processing list unwritten, since the last good batch
+ATTEMPTS_KEY = PROCESSING_KEY + ":attempts"
+# updates set aside because they are malformed or their batch kept failing
+DEAD_LETTER_KEY = QUEUE_KEY + ":dead"
+DEFAULT_METRIC_RRA_MAX_ATTEMPTS = 3
+
+
+def create(path, step, archives):
+    """Create an archive file at *path* unless one exists."""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as handle:
+        handle.write(HEADER.pack(MAGIC, step, len(archives), -math.inf))
+        for function, steps, rows in archives:
+            handle.write(ARCHIVE.pack(CONSOLIDATION_FUNCTIONS.index(function), steps, rows, 0, -1, 0.0, 0))
+        for _, _, rows in archives:
+            handle.write(NAN * rows)
+    os.replace(tmp, path)
+
+
+class Archive:
+    """One consolidation ring within an open file."""
+
+    def __init__(self, index, header_offset, data_offset, function, steps, rows):
+        self.index = index
+        self.header_offset = header_offset
+        self.data_offset = data_offset
+        self.function = CONSOLIDATION_FUNCTIONS[function]
+        self.steps = steps
+        self.rows = rows
+
+
+class RoundRobinFile:
+    """An archive file mapped into memory and locked while open."""
+
+    def __init__(self, path):
+        self.path = path
+        self._handle = open(path, "r+b")
+        try:
+            fcntl.flock(self._handle, fcntl.LOCK_EX)
+            self._map = mmap.mmap(self._handle.fileno(), 0)
+        except Exception:
+            self._handle.close()
+            raise
+        magic, self.step, count, self.last_update = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a round-robin archive")
+        self.archives = []
+        data_offset = HEADER.size + count * ARCHIVE.size
+        for index in range(count):
+            header_offset = HEADER.size + index * ARCHIVE.size
+            function, steps, rows, _, _, _, _ = ARCHIVE.unpack_from(self._map, header_offset)
+            self.archives.append(Archive(index, header_offset, data_offset, function, steps, rows))
+            data_offset += rows * VALUE.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._handle.close()
+
+    def _state(self, archive):
+        _, _, _, _, bucket, total, count = ARCHIVE.unpack_from(self._map, archive.header_offset)
+        return bucket, total, count
+
+    def _row(self, archive, bucket):
+        return archive.data_offset + (bucket % archive.rows) * VALUE.size
+
+    def update(self, samples):
+        """Fold ``(epoch seconds, value)`` samples in; return how many were used."""
+        used = 0
+        for timestamp, value in sorted(samples):
+            if timestamp <= self.last_update:
+                continue
+            slot = int(timestamp // self.step)
+            for archive in self.archives:
+                self._consolidate(archive, slot // archive.steps, float(value))
+            self.last_update = timestamp
+            used += 1
+        if used:
+            HEADER.pack_into(self._map, 0, MAGIC, self.step, len(self.archives), self.last_update)
+        return used
+
+    def _consolidate(self, archive, bucket, value):
+        current, total, count = self._state(archive)
+        offset = self._row(archive, bucket)
+        if bucket != current:
+            # rows skipped since the last update hold values from a lap ago
+            for stale in range(max(current + 1, bucket - archive.rows + 1), bucket):
+                self._map[self._row(archive, stale):self._row(archive, stale) + VALUE.size] = NAN
+            total, count, row = value, 1, value
+        else:
+            total, count = total + value, count + 1
+            previous = VALUE.unpack_from(self._map, offset)[0]
+            if archive.function == "AVERAGE":
+                row = total / count
+            elif archive.function == "MIN":
+                row = min(previous, value)
+            elif archive.function == "MAX":
+                row = max(previous, value)
+            else:
+                row = value
+        VALUE.pack_into(self._map, offset, row)
+        ARCHIVE.pack_into(
+            self._map, archive.header_offset, CONSOLIDATION_FUNCTIONS.index(archive.function),
+            archive.steps, archive.rows, 0, bucket, total, count,
+        )
+
+    def width(self, archive):
+        return archive.steps * self.step
+
+    def oldest(self, archive):
+        """Start, in epoch seconds, of the oldest row *archive* still holds."""
+        current, _, _ = self._state(archive)
+        return (current - archive.rows + 1) * self.width(archive)
+
+    def fetch(self, archive, start=None, end=None):
+        """Return ``(epoch seconds, value)`` for the known rows of *archive* in range."""
+        current, _, _ = self._state(archive)
+        if current < 0:
+            return []
+        width = self.width(archive)
+        first = current - archive.rows + 1
+        if start is not None:
+            first = max(first, int(start // width))
+        last = current if end is None else min(current, int(end // width))
+        values = struct.unpack_from(f"<{archive.rows}d", self._map, archive.data_offset)
+        rows = []
+        for bucket in range(first, last + 1):
+            value = values[bucket % archive.rows]
+            if not math.isnan(value):
+                rows.append((bucket * width, value))
+        return rows
+
+    def choose(self, start=None, resolution=None, function=None):
+        """Pick the archive for a query.
+
+        Without *resolution* the finest archive reaching back to *start* is
+        used; with it, the coarsest no wider than *resolution* seconds.
+        Archives consolidated with *function* are preferred.
+        """
+        pool = [a for a in self.archives if a.function == function] or self.archives
+        pool = sorted(pool, key=self.width)
+        fits = [a for a in pool if resolution is None or self.width(a) <= resolution] or pool[:1]
+        covering = [a for a in fits if start is None or self.oldest(a) <= start]
+        if covering:
+            return covering[-1] if resolution else covering[0]
+        return max(fits, key=lambda a: a.rows * self.width(a))
+
+
+def _epoch(timestamp):
+    return tsdb.to_millis(timestamp) / 1000
+
+
+def _from_epoch(seconds):
+    return tsdb.from_millis(int(seconds * 1000))
+
+
+def _queue_client():
+    import redis
+
+    return redis.Redis.from_url(settings.METRIC_RRA_QUEUE_URL)
+
+
+class RoundRobinStore(BaseStore):
+    """Series kept in round-robin archive files under ``METRIC_RRA_DIR``.
+
+    Long-range queries read the coarser archives of the file itself, so
+    these series need no database rollups.
+    """
+
+    keeps_rollups = False
+
+    def __init__(self, directory=None, step=None, archives=None, queue=None):
+        self.directory = str(directory or getattr(settings, "METRIC_RRA_DIR", "rra"))
+        self.step = step or getattr(settings, "METRIC_RRA_STEP", DEFAULT_METRIC_RRA_STEP)
+        self.archives = archives or getattr(settings, "METRIC_RRA_ARCHIVES", DEFAULT_METRIC_RRA_ARCHIVES)
+        if queue is None and getattr(settings, "METRIC_RRA_QUEUE_URL", ""):
+            queue = _queue_client()
+        self.queue = queue
+
+    def path(self, device_id, interface_id, metric):
+        metric = re.sub(r"[^\w.-]", "_", metric)
+        name = f"{interface_id or 'device'}-{metric}.rra"
+        return os.path.join(self.directory, str(device_id), name)
+
+    def write(self, records):
+        updates = [
+            (record.device_id, record.interface_id, record.metric, _epoch(record.timestamp), record.value)
+            for record in records
+        ]
+        if self.queue:
+            self.queue.rpush(QUEUE_KEY, *(json.dumps(update) for update in updates))
+            return
+        self.apply(updates)
+
+    def apply(self, updates):
+        """Write ``(device_id, interface_id, metric, epoch seconds, value)`` updates,
+        opening each file once."""
+        by_path = defaultdict(list)
+        for device_id, interface_id, metric, timestamp, value in updates:
+            by_path[self.path(device_id, interface_id, metric)].append((timestamp, value))
+        for path, samples in by_path.items():
+            create(path, self.step, self.archives)
+            with RoundRobinFile(path) as rrd:
+                rrd.update(samples)
+        return len(by_path)
+
+    def _file(self, metric, device, interface):
+        device_id = interface.device_id if interface is not None else getattr(device, "pk", device)
+        path = self.path(device_id, getattr(interface, "pk", None), metric)
+        return RoundRobinFile(path) if os.path.exists(path) else None
+
+    def series(self, metric, device=None, interface=None, start=None, end=None,
+               resolution=None, aggregate="avg"):
+        rrd = self._file(metric, device, interface)
+        if rrd is None:
+            return []
+        start_ts = _epoch(start) if start else None
+        with rrd:
+            archive = rrd.choose(start_ts, resolution, AGGREGATE_FUNCTIONS.get(aggregate) if resolution else None)
+            rows = rrd.fetch(archive, start_ts, _epoch(end) if end else None)
+        return [Sample(_from_epoch(timestamp), value) for timestamp, value in rows]
+
+    def raw_series(self, metric, device=None, interface=None, start=None, end=None):
+        return self.series(metric, device, interface, start, end)
+
+    def latest(self, metric, device=None, interface=None):
+        rrd = self._file(metric, device, interface)
+        if rrd is None:
+            return None
+        with rrd:
+            rows = rrd.fetch(rrd.choose())
+        return Sample(_from_epoch(rows[-1][0]), rows[-1][1]) if rows else None
+
+
+def _claim(client, count):
+    """Move up to *count* queued updates onto the processing list and return them."""
+    count = min(count, client.llen(QUEUE_KEY))
+    if not count:
+        return []
+    pipe = client.pipeline(transaction=False)
+    for _ in range(count):
+        pipe.lmove(QUEUE_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+    return [item for item in pipe.execute() if item is not None]
+
+
+def _decode(item):
+    """Return the ``(device_id, interface_id, metric, epoch seconds, value)`` queued as *item*.
+
+    Raises ValueError or TypeError if it is not one.
+    """
+    device_id, interface_id, metric, timestamp, value = json.loads(item)
+    if interface_id is not None:
+        interface_id = int(interface_id)
+    return int(device_id), interface_id, str(metric), float(timestamp), float(value)
+
+
+def _recover(client, max_attempts):
+    """Deal with updates a previous daemon claimed but never wrote.
+
+    They are queued again, ahead of newer updates, unless restarts have
+    found them unwritten *max_attempts* times; then the batch is moved to
+    ``DEAD_LETTER_KEY`` so it cannot crash every daemon that takes it.
+    """
+    stranded = client.llen(PROCESSING_KEY)
+    if not stranded:
+        return
+    attempts = client.incr(ATTEMPTS_KEY)
+    if attempts >= max_attempts:
+        logger.error(
+            "Moving %d archive updates that failed %d times to %s", stranded, attempts, DEAD_LETTER_KEY
+        )
+        while client.lmove(PROCESSING_KEY, DEAD_LETTER_KEY, "LEFT", "RIGHT") is not None:
+            pass
+        client.delete(ATTEMPTS_KEY)
+        return
+    logger.warning("Queueing %d unwritten archive updates again", stranded)
+    while client.lmove(PROCESSING_KEY, QUEUE_KEY, "RIGHT", "LEFT") is not None:
+        pass
+
+
+def run_daemon(batch_size=10000, flush_interval=5.0, once=False, stop=None, client=None, store=None,
+               max_attempts=None):
+    """Apply queued updates until *stop* is set; return how many were applied.
+
+    Updates are collected until *batch_size* are pending or *flush_interval*
+    seconds have passed, then written with each file opened once. With
+    *once*, the queue is drained a single time.
+
+    Collected updates wait on a processing list and are only dropped from
+    it once written, so the batch of a daemon that died is queued again
+    when the next one starts, up to *max_attempts* times
+    (``METRIC_RRA_MAX_ATTEMPTS``). Malformed updates go straight to
+    ``DEAD_LETTER_KEY``. Run one daemon per queue.
+    """
+    client = client or _queue_client()
+    store = store or RoundRobinStore(queue=False)
+    stop = stop or threading.Event()
+    if max_attempts is None:
+        max_attempts = getattr(settings, "METRIC_RRA_MAX_ATTEMPTS", DEFAULT_METRIC_RRA_MAX_ATTEMPTS)
+    _recover(client, max(1, max_attempts))
+    pending = []
+    # every item moved onto the processing list, pending or dead-lettered
+    claimed = 0
+    applied = 0
+    flushed = time.monotonic()
+
+    def take(items):
+        nonlocal claimed
+        claimed += len(items)
+        for item in items:
+            try:
+                pending.append(_decode(item))
+            except (TypeError, ValueError):
+                logger.error("Moving malformed archive update %r to %s", item, DEAD_LETTER_KEY)
+                client.rpush(DEAD_LETTER_KEY, item)
+
+    while True:
+        items = _claim(client, batch_size)
+        take(items)
+        idle = not items
+        if pending and (len(pending) >= batch_size or idle and (once or stop.is_set())
+                        or time.monotonic() - flushed >= flush_interval):
+            files = store.apply(pending)
+            logger.info("Applied %d archive updates to %d files", len(pending), files)
+            applied += len(pending)
+            pending = []
+            flushed = time.monotonic()
+        if claimed and not pending:
+            # the processing list starts with exactly the claimed updates
+            client.ltrim(PROCESSING_KEY, claimed, -1)
+            client.delete(ATTEMPTS_KEY)
+            claimed = 0
+        if idle and not pending and (once or stop.is_set()):
+            return applied
+        if idle:
+            item = client.blmove(QUEUE_KEY, PROCESSING_KEY, min(flush_interval, 0.5), "LEFT", "RIGHT")
+            if item is not None:
+                take([item])
@@ -0,0 +1,118 @@
+"""Per-device metric poll scheduling.
+
+Each device is polled every ``poll_interval`` seconds: its own, else the
+shortest set on any of its tags, else ``METRIC_POLL_INTERVAL``. Instead of
+polling everything at once, each device owns a slot at a stable,
+hash-derived offset within its interval, so a thousand devices on a
+five-minute interval arrive at about three per second rather than a
+thousand at :00 and :05. ``scheduled_poll_task`` runs every
+``METRIC_POLL_TICK`` seconds and polls the devices whose slot has passed
+since they were last polled.
+
+A device is late by the time since the first slot it has not been polled
+for; :func:`poll_schedule` reports it for every device. A device never
+polled waits for its first slot, so adding many devices at once, or
+deploying the scheduler, does not cause a burst either.
+"""
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import Device, PollCycle
+from .partitions import DEFAULT_METRIC_RETENTION_DAYS
+from .tsdb import EPOCH
+
+DEFAULT_METRIC_POLL_INTERVAL = 300
+DEFAULT_METRIC_POLL_TICK = 10
+
+
+def default_interval():
+    return getattr(settings, "METRIC_POLL_INTERVAL", DEFAULT_METRIC_POLL_INTERVAL)
+
+
+def tick():
+    return getattr(settings, "METRIC_POLL_TICK", DEFAULT_METRIC_POLL_TICK)
+
+
+def poll_offset(device_pk, interval):
+    """Seconds into each *interval* at which the device is polled.
+
+    Derived from a hash of the primary key, so it is the same in every
+    worker and across restarts.
+    """
+    return zlib.crc32(f"device:{device_pk}".encode()) % max(1, int(interval))
+
+
+def _slot_after(when, interval, offset):
+    """Return the first poll slot strictly after *when*."""
+    seconds = (when - EPOCH).total_seconds() - offset
+    return EPOCH + timedelta(seconds=(seconds // interval + 1) * interval + offset)
+
+
+def _slot_before(when, interval, offset):
+    """Return the last poll slot at or before *when*."""
+    seconds = (when - EPOCH).total_seconds() - offset
+    return EPOCH + timedelta(seconds=(seconds // interval) * interval + offset)
+
+
+def with_intervals(devices=None):
+    """Annotate *devices* with ``interval``, the effective poll interval in seconds."""
+    devices = Device.objects.all() if devices is None else devices
+    default = default_interval()
+    devices = devices.annotate(tag_interval=Min("tags__poll_interval"))
+    for device in devices:
+        device.interval = device.poll_interval or device.tag_interval or default
+        yield device
+
+
+def deadline(device, now):
+    """Return the slot *device* is overdue for at *now*, or None if it is not due."""
+    offset = poll_offset(device.pk, device.interval)
+    if device.last_polled is None:
+        # first poll: only once its slot has come round within the last tick
+        slot = _slot_before(now, device.interval, offset)
+        return slot if (now - slot).total_seconds() < tick() else None
+    missed = _slot_after(device.last_polled, device.interval, offset)
+    return missed if missed <= now else None
+
+
+def due_devices(now=None, devices=None):
+    """Return ``[(device, seconds late)]`` for the devices due a poll at *now*."""
+    now = now or timezone.now()
+    due = []
+    for device in with_intervals(devices):
+        missed = deadline(device, now)
+        if missed is not None:
+            due.append((device, (now - missed).total_seconds()))
+    return due
+
+
+def poll_schedule(now=None):
+    """Return one dict per device with its interval, next poll and lateness."""
+    now = now or timezone.now()
+    rows = []
+    for device in with_intervals(Device.objects.order_by("hostname")):
+        offset = poll_offset(device.pk, device.interval)
+        missed = deadline(device, now)
+        rows.append({
+            "device": device,
+            "interval": device.interval,
+            "offset": offset,
+            "last_polled": device.last_polled,
+            "next_poll": missed or _slot_after(device.last_polled or now, device.interval, offset),
+            "late": (now - missed).total_seconds() if missed else 0.0,
+        })
+    return rows
+
+
+def prune_poll_cycles(now=None):
+    """Delete poll cycle records older than ``METRIC_RETENTION_DAYS``."""
+    days = getattr(settings, "METRIC_RETENTION_DAYS", DEFAULT_METRIC_RETENTION_DAYS)
+    if not days:
+        return {}
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    deleted, _ = PollCycle.objects.filter(started_at__lt=cutoff).delete()
+    return {"poll_cycles": deleted}
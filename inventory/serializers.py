@@ -1,8 +1,16 @@
 from rest_framework import serializers
-from .models import MetricRecord
+from .models import Host, MetricRecord
 
 
 class MetricRecordSerializer(serializers.ModelSerializer):
+    """Serialize a MetricRecord, or a ``Sample`` from a metric store."""
+
     class Meta:
         model = MetricRecord
         fields = ['timestamp', 'value']
+
+
+class HostSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Host
+        fields = ['id', 'mac_address', 'ip_address', 'interface', 'last_seen']
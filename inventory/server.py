@@ -1,130 +1,214 @@
-import re
-import socket
+"""Inventory of the server OptiNOC runs on.
+
+Everything is read in one pass from the kernel, without running ``ip``:
+links and their MACs from ``/sys/class/net``, the default route and ARP
+table from ``/proc/net``, and IPv4 addresses and neighbours (IPv4 and
+IPv6) from rtnetlink dumps. On hosts with hundreds of veth and bridge
+interfaces this replaces hundreds of subprocesses per scan with a few
+file reads and two netlink round trips.
+"""
+import os
 import platform
-import subprocess
+import socket
+import struct
+
 from django.utils import timezone
-from .models import Device, Interface, Host
+
+from .hosts import upsert_hosts
+from .models import Device, Host
+from .reconcile import apply_changes, reconcile_interfaces, save_device_changes
 from .snmp import gather_cam_arp
 
+SYS_CLASS_NET = "/sys/class/net"
+PROC_NET_ROUTE = "/proc/net/route"
+PROC_NET_ARP = "/proc/net/arp"
 
-def discover_local_server():
-    """Add the server running OptiNOC as a Device and parse local ARP table."""
-    hostname = socket.gethostname()
+# rtnetlink, from linux/netlink.h, linux/rtnetlink.h and friends
+NETLINK_ROUTE = 0
+NLMSG_HEADER = struct.Struct("=LHHLL")
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_DUMP_REQUEST = 0x301  # NLM_F_REQUEST | NLM_F_DUMP
+RTM_GETADDR = 22
+RTM_GETNEIGH = 30
+RTATTR_HEADER = struct.Struct("=HH")
+IFADDRMSG = struct.Struct("=BBBBI")
+NDMSG = struct.Struct("=BxxxiHBB")
+IFA_ADDRESS, IFA_LOCAL = 1, 2
+NDA_DST, NDA_LLADDR = 1, 2
+# neighbour states without a host's MAC: unresolved or failed lookups, and
+# NOARP entries (multicast, broadcast, point-to-point). PERMANENT (0x80)
+# static entries are real hosts and are kept.
+NUD_SKIPPED = 0x01 | 0x20 | 0x40  # INCOMPLETE, FAILED, NOARP
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _netlink_dump(msg_type, body, payload):
+    """Yield ``(fields, attributes)`` for each message of an rtnetlink dump.
+
+    *body* is the struct of the request and reply header and *payload* the
+    packed request header; attributes map rtattr type to raw bytes.
+    """
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        request = NLMSG_HEADER.pack(
+            NLMSG_HEADER.size + len(payload), msg_type, NLM_F_DUMP_REQUEST, 1, 0
+        ) + payload
+        sock.send(request)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    raise OSError("rtnetlink dump failed")
+                start = offset + NLMSG_HEADER.size
+                fields = body.unpack_from(data, start)
+                attrs = {}
+                pos, end = start + _align(body.size), offset + length
+                while pos + RTATTR_HEADER.size <= end:
+                    attr_len, attr_type = RTATTR_HEADER.unpack_from(data, pos)
+                    if attr_len < RTATTR_HEADER.size:
+                        break
+                    attrs[attr_type] = data[pos + RTATTR_HEADER.size:pos + attr_len]
+                    pos += _align(attr_len)
+                yield fields, attrs
+                offset += _align(length)
+
+
+def _ipv4_addresses():
+    """Return ``{ifindex: address}`` with the first IPv4 address of each link."""
+    addresses = {}
+    for (_, _, _, _, index), attrs in _netlink_dump(
+        RTM_GETADDR, IFADDRMSG, IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+    ):
+        raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if raw and index not in addresses:
+            addresses[index] = socket.inet_ntoa(raw)
+    return addresses
+
+
+def _netlink_neighbours():
+    """Yield ``(ip, ifindex, mac)`` for resolved neighbours of either family."""
+    for (family, index, state, _, _), attrs in _netlink_dump(
+        RTM_GETNEIGH, NDMSG, NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+    ):
+        if state & NUD_SKIPPED or NDA_DST not in attrs:
+            continue
+        mac = attrs.get(NDA_LLADDR)
+        if mac and len(mac) == 6:
+            yield socket.inet_ntop(family, attrs[NDA_DST]), index, mac.hex(":")
+
+
+def _arp_table():
+    """Yield ``(ip, interface name, mac)`` from ``/proc/net/arp``."""
+    for line in _read(PROC_NET_ARP).splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 6:
+            yield parts[0], parts[5], parts[3]
+
+
+def _default_route():
+    """Return ``(interface name, gateway)`` of the IPv4 default route, or Nones."""
+    for line in _read(PROC_NET_ROUTE).splitlines()[1:]:
+        parts = line.split()
+        # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+        if len(parts) >= 8 and parts[1] == "00000000" and parts[7] == "00000000":
+            gateway = int(parts[2], 16)
+            return parts[0], socket.inet_ntoa(struct.pack("<L", gateway)) if gateway else None
+    return None, None
+
+
+def _links():
+    """Return ``{ifindex: (name, mac)}`` for every network interface."""
+    links = {}
+    for index, name in socket.if_nameindex():
+        try:
+            mac = _read(os.path.join(SYS_CLASS_NET, name, "address")).strip()
+        except OSError:
+            mac = ""
+        links[index] = (name, mac)
+    return links
+
+
+def _os_version():
+    """Return ``platform.platform()`` without the ``uname -p`` it runs on Linux."""
+    uname = os.uname()
+    libc = "".join(platform.libc_ver())
+    return "-".join(filter(None, (uname.sysname, uname.release, uname.machine, libc and "with", libc)))
+
+
+def _attempt(read, default):
     try:
-        route = subprocess.check_output(['ip', 'route', 'show', 'default'], text=True).strip()
+        return read()
     except Exception:
-        route = ''
-    default_iface = None
-    if ' dev ' in f' {route} ':
-        parts = route.split()
-        for i, part in enumerate(parts):
-            if part == 'dev' and i + 1 < len(parts):
-                default_iface = parts[i + 1]
-                break
+        return default
+
+
+def discover_local_server():
+    """Add the server running OptiNOC as a Device with its interfaces and neighbours."""
+    hostname = socket.gethostname()
+    default_iface, gateway = _attempt(_default_route, (None, None))
+    links = _attempt(_links, {})
+    addresses = _attempt(_ipv4_addresses, {})
+    names = {index: name for index, (name, _) in links.items()}
+
     mgmt_ip = None
     if default_iface:
-        try:
-            addr_out = subprocess.check_output(['ip', '-f', 'inet', 'addr', 'show', default_iface], text=True)
-            m = re.search(r'inet (\d+\.\d+\.\d+\.\d+)', addr_out)
-            if m:
-                mgmt_ip = m.group(1)
-        except Exception:
-            pass
+        mgmt_ip = next(
+            (addresses[index] for index, name in names.items()
+             if name == default_iface and index in addresses),
+            None,
+        )
     if mgmt_ip is None:
-        try:
-            mgmt_ip = socket.gethostbyname(hostname)
-        except Exception:
-            pass
-
-    device, _ = Device.objects.get_or_create(hostname=hostname)
-    changed = False
-    if mgmt_ip and device.management_ip != mgmt_ip:
-        device.management_ip = mgmt_ip
-        changed = True
-    vendor = 'Linux'
-    os_version = platform.platform()
-    if device.vendor != vendor:
-        device.vendor = vendor
-        changed = True
-    if device.os_version != os_version:
-        device.os_version = os_version
-        changed = True
-    if changed:
-        device.last_seen = timezone.now()
-        device.save()
+        mgmt_ip = _attempt(lambda: socket.gethostbyname(hostname), None)
 
-    try:
-        link_out = subprocess.check_output(['ip', '-o', 'link'], text=True)
-        for line in link_out.splitlines():
-            m = re.match(r'\d+: ([^:]+):.*link/[^ ]+ ([0-9a-f:]{17}|00:00:00:00:00:00)', line)
-            if not m:
-                continue
-            name, mac = m.groups()
-            iface, _ = Interface.objects.get_or_create(device=device, name=name)
-            iface.mac_address = mac
-            ip_addr = None
-            try:
-                addr_out = subprocess.check_output(['ip', '-f', 'inet', 'addr', 'show', name], text=True)
-                m2 = re.search(r'inet (\d+\.\d+\.\d+\.\d+)', addr_out)
-                if m2:
-                    ip_addr = m2.group(1)
-            except Exception:
-                pass
-            iface.ip_address = ip_addr
-            iface.last_scanned = timezone.now()
-            iface.save()
-    except Exception:
-        pass
+    device, created = Device.objects.get_or_create(hostname=hostname)
+    now = timezone.now()
+    values = {"vendor": "Linux", "os_version": _os_version()}
+    if mgmt_ip:
+        values["management_ip"] = mgmt_ip
+    changes = apply_changes(device, values)
+    if changes:
+        changes.update(apply_changes(device, {"last_seen": now}))
+        save_device_changes(device, changes, now, log=not created)
 
-    neighbor_entries = []
-    neighbor_set = set()
-    try:
-        neigh_out = subprocess.check_output(['ip', 'neigh'], text=True)
-        for line in neigh_out.splitlines():
-            parts = line.split()
-            if len(parts) >= 6 and parts[1] == 'dev' and parts[3] == 'lladdr':
-                entry = (parts[0], parts[2], parts[4])
-                if entry not in neighbor_set:
-                    neighbor_entries.append(entry)
-                    neighbor_set.add(entry)
-    except Exception:
-        pass
-    try:
-        with open('/proc/net/arp') as f:
-            next(f)
-            for line in f:
-                parts = line.split()
-                if len(parts) >= 6:
-                    entry = (parts[0], parts[5], parts[3])
-                    if entry not in neighbor_set:
-                        neighbor_entries.append(entry)
-                        neighbor_set.add(entry)
-    except Exception:
-        pass
+    interfaces = {
+        name: {"mac_address": mac, "ip_address": addresses.get(index)}
+        for index, (name, mac) in links.items()
+    }
+    reconcile_interfaces(device, interfaces, ["mac_address", "ip_address"], now, log=not created)
 
-    for ip_addr, if_name, mac in neighbor_entries:
-        iface_obj = device.interfaces.filter(name=if_name).first()
-        host, _ = Host.objects.get_or_create(mac_address=mac)
-        host.ip_address = ip_addr
-        if iface_obj:
-            host.interface = iface_obj
-        host.last_seen = timezone.now()
-        host.save()
+    by_name = {iface.name: iface for iface in device.interfaces.all()}
+    neighbours = {}
+    for ip_addr, index, mac in _attempt(lambda: list(_netlink_neighbours()), []):
+        neighbours.setdefault((ip_addr, names.get(index), mac), None)
+    for entry in _attempt(lambda: list(_arp_table()), []):
+        neighbours.setdefault(entry, None)
+    upsert_hosts(
+        (Host(mac_address=mac, ip_address=ip_addr, interface=by_name.get(if_name))
+         for ip_addr, if_name, mac in neighbours),
+        ["ip_address", "interface"],
+    )
 
     if mgmt_ip:
         try:
             gather_cam_arp(mgmt_ip)
         except Exception:
             pass
-    if default_iface and mgmt_ip:
+    if default_iface and mgmt_ip and gateway:
         try:
-            gw = None
-            if route:
-                match = re.search(r'via (\d+\.\d+\.\d+\.\d+)', route)
-                if match:
-                    gw = match.group(1)
-            if gw:
-                gather_cam_arp(gw)
+            gather_cam_arp(gateway)
         except Exception:
             pass
 
@@ -0,0 +1,58 @@
+"""Consistent hashing of devices onto metric poll queues.
+
+``METRIC_POLL_QUEUES`` names the Celery queues that poll workers consume,
+e.g. ``poll-a,poll-b,poll-c`` with one ``celery worker -Q poll-a`` and so
+on. Each queue owns many points on a hash ring and a device belongs to
+the queue owning the first point at or after the hash of its primary key,
+so adding or removing one of N queues moves only about 1/N of the
+devices, and each device keeps hitting the same worker's SNMP session
+pool and walk cache from cycle to cycle.
+"""
+import hashlib
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+
+# points per queue; more evens out the share each queue gets
+RING_REPLICAS = 128
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Map keys to one of *nodes* by consistent hashing."""
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(dict.fromkeys(nodes))
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node")
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect_left(self._keys, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+def poll_queues():
+    return [name for name in getattr(settings, "METRIC_POLL_QUEUES", []) if name]
+
+
+def shard_devices(devices, queues=None):
+    """Return ``{queue: [device, ...]}`` for *devices*; ``{None: devices}`` unsharded."""
+    queues = poll_queues() if queues is None else queues
+    if not queues:
+        return {None: list(devices)} if devices else {}
+    ring = HashRing(queues)
+    shards = defaultdict(list)
+    for device in devices:
+        shards[ring.node_for(f"device:{device.pk}")].append(device)
+    return dict(shards)
@@ -8,6 +8,7 @@ try:
         ObjectIdentity,
         getCmd,
         nextCmd,
+        bulkCmd,
     )
 except Exception:  # pragma: no cover - fallback for missing pysnmp on Py3.12
     SnmpEngine = CommunityData = UdpTransportTarget = ContextData = None
@@ -18,85 +19,586 @@ except Exception:  # pragma: no cover - fallback for missing pysnmp on Py3.12
     def nextCmd(*args, **kwargs):  # type: ignore
         raise ImportError("pysnmp is not available")
 
-    try:
-        from puresnmp import Client, V2C, PyWrapper
-        import asyncio
-
-        def _pure_client(target, community, port, timeout, retries):
-            client = Client(target, V2C(community), port=port)
-            client.configure(timeout=timeout, retries=retries)
-            return PyWrapper(client)
+    def bulkCmd(*args, **kwargs):  # type: ignore
+        raise ImportError("pysnmp is not available")
 
-    except Exception:  # pragma: no cover - no SNMP libraries available
-        Client = PyWrapper = None
+# puresnmp backs the Py3.12 fallback and the asyncio poller
+try:
+    from puresnmp import Client, V1, V2C, PyWrapper
+    from puresnmp.exc import NoSuchOID, TooBig
+
+    def _pure_client(target, community, port, timeout, retries, version="2c"):
+        credentials = V1(community) if version == "1" else V2C(community)
+        client = Client(target, credentials, port=port)
+        # puresnmp counts send attempts rather than retries
+        client.configure(timeout=timeout, retries=retries + 1)
+        return PyWrapper(client)
+
+except Exception:  # pragma: no cover - no SNMP libraries available
+    Client = PyWrapper = None
+import asyncio
+import heapq
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
 from django.utils import timezone
+from .cache import walk_cache, walk_cache_ttl
+from .hosts import format_mac, upsert_hosts
 from .models import Device, Interface, Connection, Host
 from .ping import check_ping
+from .reconcile import apply_changes, reconcile_interfaces, save_device_changes
 
 
 DEFAULT_COMMUNITY = "public"
 DEFAULT_PORT = 161
+DEFAULT_SESSION_IDLE_TIMEOUT = 300
+DEFAULT_SESSION_MAX = 4096
+DEFAULT_MAX_REPETITIONS = 25
+DEFAULT_MAX_OIDS_PER_PDU = 32
+DEFAULT_FULL_SCAN_INTERVAL = 3600
+
+# SNMP error-status values
+ERROR_TOO_BIG = 1
+ERROR_NO_SUCH_NAME = 2
+
+SNMP_V1 = "1"
+SNMP_V2C = "2c"
+SNMP_VERSIONS = (SNMP_V2C, SNMP_V1)
+MP_MODELS = {SNMP_V1: 0, SNMP_V2C: 1}
+
+
+class SnmpSessionPool:
+    """Per-process cache of SNMP engines and per-target session objects.
+
+    Building an ``SnmpEngine`` and resolving a ``UdpTransportTarget`` costs
+    far more than the request itself, so each worker keeps a single engine
+    (one per thread, as pysnmp engines are not thread safe) and reuses the
+    auth/transport objects for every target it polls. Sessions unused for
+    ``idle_timeout`` seconds, or beyond ``max_sessions``, are evicted
+    least-recently-used first. The pool resets itself after a fork so
+    Celery prefork children never share sockets with their parent.
+    """
+
+    def __init__(self, idle_timeout=None, max_sessions=None):
+        self._idle_timeout = idle_timeout
+        self._max_sessions = max_sessions
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sessions = OrderedDict()
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            self._reset()
+
+    @property
+    def idle_timeout(self):
+        if self._idle_timeout is not None:
+            return self._idle_timeout
+        return getattr(settings, "SNMP_SESSION_IDLE_TIMEOUT", DEFAULT_SESSION_IDLE_TIMEOUT)
+
+    @property
+    def max_sessions(self):
+        if self._max_sessions is not None:
+            return self._max_sessions
+        return getattr(settings, "SNMP_SESSION_MAX", DEFAULT_SESSION_MAX)
+
+    def engine(self):
+        """Return the SnmpEngine owned by the calling worker thread."""
+        self._check_fork()
+        engine = getattr(self._local, "engine", None)
+        if engine is None:
+            engine = self._local.engine = SnmpEngine()
+        return engine
+
+    def loop(self):
+        """Return the long-lived event loop owned by the calling worker thread.
+
+        The puresnmp fallback runs every request on this loop instead of
+        creating and tearing one down per call with ``asyncio.run()``.
+        """
+        self._check_fork()
+        loop = getattr(self._local, "loop", None)
+        if loop is None or loop.is_closed():
+            loop = self._local.loop = asyncio.new_event_loop()
+        return loop
+
+    def session(self, key, factory):
+        """Return the cached session for *key*, creating it with *factory*."""
+        self._check_fork()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                entry[0] = now
+                self._sessions.move_to_end(key)
+                return entry[1]
+        session = factory()
+        with self._lock:
+            self._sessions[key] = [now, session]
+            self._sessions.move_to_end(key)
+            self._evict(now)
+        return session
+
+    def _evict(self, now):
+        cutoff = now - self.idle_timeout
+        limit = self.max_sessions
+        while self._sessions:
+            last_used, _ = next(iter(self._sessions.values()))
+            if last_used > cutoff and len(self._sessions) <= limit:
+                break
+            self._sessions.popitem(last=False)
+
+    def evict_idle(self):
+        """Drop sessions that have not been used within the idle timeout."""
+        self._check_fork()
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def clear(self):
+        """Forget all cached engines and sessions."""
+        self._reset()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+session_pool = SnmpSessionPool()
+
+
+def _new_session(target, community, port, timeout, retries, version=SNMP_V2C):
+    """Build the backend specific session objects for a single target."""
+    if SnmpEngine is None:
+        return _pure_client(target, community, port, timeout, retries, version)
+    return (
+        CommunityData(community, mpModel=MP_MODELS[version]),
+        UdpTransportTarget((target, port), timeout=timeout, retries=retries),
+    )
 
 
-def snmp_get(oid, target, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0):
-    """Perform a simple SNMP GET request and return the value or None on failure."""
+def _session(target, community, port, timeout, retries, version=SNMP_V2C):
+    """Return a pooled session for *target* with the given parameters."""
+    key = (target, port, community, timeout, retries, version)
+    return session_pool.session(
+        key, lambda: _new_session(target, community, port, timeout, retries, version)
+    )
+
+
+class SnmpNoResponse(Exception):
+    """Raised when a target does not answer the first request of a walk."""
+
+
+class SnmpWalkIncomplete(Exception):
+    """Raised when a walk fails after its first response.
+
+    The rows already returned are only part of the table, so callers must
+    not treat them as the whole of it.
+    """
+
+
+_version_hints = {}
+
+
+def _default_version():
+    return str(getattr(settings, "SNMP_VERSION", SNMP_V2C))
+
+
+def _default_max_repetitions():
+    return getattr(settings, "SNMP_MAX_REPETITIONS", DEFAULT_MAX_REPETITIONS) or DEFAULT_MAX_REPETITIONS
+
+
+def snmp_versions(target, preferred=None):
+    """Return SNMP versions to try for *target*, most preferred first."""
+    preferred = preferred or _version_hints.get(target) or _default_version()
+    return (preferred,) + tuple(v for v in SNMP_VERSIONS if v != preferred)
+
+
+def negotiable_versions(target, version=None):
+    """Return the versions a request to *target* may try, in order.
+
+    A given *version*, or one already negotiated with *target* in this
+    process, is used alone; only a target of unknown version falls back,
+    so an unreachable host costs one timeout per request rather than one
+    per version.
+    """
+    version = version or _version_hints.get(target)
+    return (version,) if version else snmp_versions(target)
+
+
+def remember_version(target, version):
+    """Record that *target* answers to *version*.
+
+    Later requests in this process use it alone, and a device at *target*
+    without a stored ``snmp_version`` keeps it for the next scan or poll.
+    """
+    if _version_hints.get(target) == version:
+        return
+    _version_hints[target] = version
+    Device.objects.filter(management_ip=target, snmp_version="").update(snmp_version=version)
+
+
+def device_snmp_options(device):
+    """Return the version and GETBULK size keyword arguments remembered for *device*.
+
+    Every walk, table and GET helper in this module accepts them.
+    """
+    return {
+        "version": device.snmp_version or None,
+        # a GETBULK of 0 repetitions returns nothing, so 0 means the default
+        "max_repetitions": device.snmp_max_repetitions or None,
+    }
+
+
+class SnmpTooBig(Exception):
+    """Raised when an agent answers a GET with the tooBig error status."""
+
+
+class SnmpNoSuchName(Exception):
+    """Raised when an SNMPv1 agent rejects a GET because one OID is missing."""
+
+    def __init__(self, index):
+        super().__init__(index)
+        self.index = index
+
+
+# Exception values returned in place of a varbind value by SNMPv2c agents
+_MISSING_VALUE_TYPES = {"NoSuchObject", "NoSuchInstance", "EndOfMibView"}
+
+
+def _value(value):
+    return None if type(value).__name__ in _MISSING_VALUE_TYPES else value
+
+
+def _get(oids, target, community, port, timeout, retries, version):
+    """Send one GET PDU for *oids* and return a dict of OID to value."""
     if SnmpEngine is None:
         if Client is None:
             raise ImportError("No SNMP library available")
-        async def _run():
-            wrapper = _pure_client(target, community, port, timeout, retries)
-            return await wrapper.get(oid)
-
         try:
-            return asyncio.run(_run())
+            wrapper = _session(target, community, port, timeout, retries, version)
+            values = session_pool.loop().run_until_complete(wrapper.multiget(oids))
+        except TooBig:
+            raise SnmpTooBig(target)
+        except NoSuchOID as exc:
+            offending = str(exc.offending_oid)
+            if offending not in oids:
+                raise SnmpNoResponse(target)
+            raise SnmpNoSuchName(oids.index(offending))
         except Exception:
-            return None
+            raise SnmpNoResponse(target)
+        return {oid: _value(value) for oid, value in zip(oids, values)}
 
+    auth, transport = _session(target, community, port, timeout, retries, version)
     iterator = getCmd(
-        SnmpEngine(),
-        CommunityData(community, mpModel=0),
-        UdpTransportTarget((target, port), timeout=timeout, retries=retries),
+        session_pool.engine(),
+        auth,
+        transport,
         ContextData(),
-        ObjectType(ObjectIdentity(oid)),
+        *[ObjectType(ObjectIdentity(oid)) for oid in oids],
     )
     error_indication, error_status, error_index, var_binds = next(iterator)
-    if error_indication or error_status:
-        return None
-    return var_binds[0][1]
+    if error_indication:
+        raise SnmpNoResponse(target)
+    if error_status:
+        status = int(error_status)
+        if status == ERROR_TOO_BIG:
+            raise SnmpTooBig(target)
+        if status == ERROR_NO_SUCH_NAME and error_index:
+            raise SnmpNoSuchName(int(error_index) - 1)
+        raise SnmpNoResponse(target)
+    return {oid: _value(var_bind[1]) for oid, var_bind in zip(oids, var_binds)}
+
+
+def _get_chunks(oids, target, community, port, timeout, retries, version, max_oids):
+    """Fetch *oids* with *version*; raise SnmpNoResponse if nothing was answered."""
+    values = dict.fromkeys(oids)
+    chunks = [oids[i:i + max_oids] for i in range(0, len(oids), max_oids)]
+    answered = False
+    while chunks:
+        chunk = chunks.pop(0)
+        try:
+            values.update(_get(chunk, target, community, port, timeout, retries, version))
+        except SnmpTooBig:
+            if len(chunk) > 1:
+                half = len(chunk) // 2
+                chunks[:0] = [chunk[:half], chunk[half:]]
+        except SnmpNoSuchName as exc:
+            rest = chunk[:exc.index] + chunk[exc.index + 1:]
+            if rest:
+                chunks.insert(0, rest)
+        except SnmpNoResponse:
+            if not answered:
+                raise
+            break
+        # tooBig and noSuchName are answers too
+        answered = True
+    return values
+
+
+def snmp_get_many(target, oids, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0,
+                  version=None, max_oids=None, max_repetitions=None):
+    """Fetch several scalar OIDs from *target* in as few GET PDUs as possible.
+
+    Returns a dict mapping every requested OID to its value, or None when
+    the agent does not have it or did not answer. OIDs are packed up to
+    ``SNMP_MAX_OIDS_PER_PDU`` per request; a request the agent rejects as
+    tooBig is split in half and retried, and OIDs an SNMPv1 agent reports
+    as noSuchName are dropped so the rest of the PDU can be answered.
+    Without a known *version* an agent that ignores SNMPv2c is asked again
+    with SNMPv1, as walks are. *max_repetitions* is accepted, and unused,
+    so :func:`device_snmp_options` can be passed to every request.
+    """
+    if max_oids is None:
+        max_oids = getattr(settings, "SNMP_MAX_OIDS_PER_PDU", DEFAULT_MAX_OIDS_PER_PDU)
+    oids = list(oids)
+    for candidate in negotiable_versions(target, version):
+        try:
+            values = _get_chunks(oids, target, community, port, timeout, retries, candidate, max_oids)
+        except SnmpNoResponse:
+            continue
+        if not version:
+            remember_version(target, candidate)
+        return values
+    return dict.fromkeys(oids)
+
+
+def snmp_get(oid, target, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0,
+             version=None, max_repetitions=None):
+    """Perform a simple SNMP GET request and return the value or None on failure."""
+    return snmp_get_many(target, [oid], community, port, timeout, retries, version)[oid]
+
+
+def _column_of(oid, columns):
+    """Return the column in *columns* that *oid* belongs to, or None."""
+    for column in columns:
+        if oid.startswith(column + "."):
+            return column
+    return None
+
 
+def _walk(oids, target, community, port, timeout, retries, version, max_repetitions):
+    """Yield OID, value pairs below *oids* using GETNEXT (v1) or GETBULK (v2c).
 
-def snmp_walk(oid, target, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0):
-    """Generator yielding OID, value pairs from an SNMP walk."""
+    All OIDs are requested side by side in every PDU. Raises SnmpNoResponse
+    if the very first request fails, which is how a v1-only agent rejects
+    (or silently drops) v2c PDUs, and SnmpWalkIncomplete if a later one
+    does.
+    """
+    bulk = version != SNMP_V1
     if SnmpEngine is None:
         if Client is None:
             raise ImportError("No SNMP library available")
 
-        async def _run():
-            wrapper = _pure_client(target, community, port, timeout, retries)
-            results = []
-            async for vb in wrapper.walk(oid):
-                results.append((str(vb.oid), vb.value))
-            return results
-
         try:
-            for item in asyncio.run(_run()):
-                yield item
-            return
+            wrapper = _session(target, community, port, timeout, retries, version)
         except Exception:
-            return
+            raise SnmpNoResponse(target)
+        if bulk:
+            varbinds = wrapper.bulkwalk(list(oids), bulk_size=max_repetitions)
+        else:
+            varbinds = wrapper.multiwalk(list(oids))
+        # Step the async walk on the worker's loop so varbinds are handed
+        # out as they arrive rather than collected into a list first.
+        loop = session_pool.loop()
+        first = True
+        try:
+            while True:
+                try:
+                    vb = loop.run_until_complete(varbinds.__anext__())
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    if first:
+                        raise SnmpNoResponse(target)
+                    raise SnmpWalkIncomplete(target)
+                first = False
+                yield str(vb.oid), vb.value
+        finally:
+            loop.run_until_complete(varbinds.aclose())
+        return
 
-    for (error_indication, error_status, error_index, var_binds) in nextCmd(
-        SnmpEngine(),
-        CommunityData(community, mpModel=0),
-        UdpTransportTarget((target, port), timeout=timeout, retries=retries),
-        ContextData(),
-        ObjectType(ObjectIdentity(oid)),
-        lexicographicMode=False,
-    ):
+    auth, transport = _session(target, community, port, timeout, retries, version)
+    object_types = [ObjectType(ObjectIdentity(oid)) for oid in oids]
+    if bulk:
+        iterator = bulkCmd(
+            session_pool.engine(),
+            auth,
+            transport,
+            ContextData(),
+            0,
+            max_repetitions,
+            *object_types,
+            lexicographicMode=False,
+        )
+    else:
+        iterator = nextCmd(
+            session_pool.engine(),
+            auth,
+            transport,
+            ContextData(),
+            *object_types,
+            lexicographicMode=False,
+        )
+    first = True
+    for (error_indication, error_status, error_index, var_binds) in iterator:
         if error_indication or error_status:
-            break
+            if first:
+                raise SnmpNoResponse(target)
+            raise SnmpWalkIncomplete(target)
+        first = False
         for oid_val in var_binds:
-            yield str(oid_val[0]), oid_val[1]
+            oid = str(oid_val[0])
+            # columns that ran off the end of their subtree keep returning
+            # the following objects until every column has finished
+            if len(oids) == 1 or _column_of(oid, oids):
+                yield oid, oid_val[1]
+
+
+def _walk_with_fallback(oids, target, community, port, timeout, retries, version, max_repetitions):
+    if not max_repetitions:
+        max_repetitions = _default_max_repetitions()
+    for candidate in negotiable_versions(target, version):
+        try:
+            for item in _walk(oids, target, community, port, timeout, retries, candidate, max_repetitions):
+                yield item
+        except SnmpNoResponse:
+            continue
+        if not version:
+            remember_version(target, candidate)
+        return
+
+
+def _walk_key(target, oid, community, version):
+    # a walk is only reused with the credentials and version that fetched it
+    return f"walk:{target}:{community}:{version}:{oid}"
+
+
+def _cached_walk(columns, target, walk, community=DEFAULT_COMMUNITY, version=None):
+    """Yield varbinds for *columns*, serving cached columns and caching the rest.
+
+    Only the interface name column (see ``CACHED_COLUMNS``) is cached; it is
+    shared by scans, neighbour discovery and polling, while counters and
+    status have to be read live. *walk* is called once with the columns that
+    must be fetched. Names are stored per (target, community, version,
+    column) once the walk completes, so a later single-column walk can
+    reuse a column fetched as part of a table. Empty results, and walks
+    that raised part way (see SnmpWalkIncomplete), are not kept.
+    """
+    ttl = walk_cache_ttl()
+    cacheable = [column for column in columns if column in CACHED_COLUMNS]
+    if ttl <= 0 or not cacheable:
+        yield from walk(columns)
+        return
+    cache = walk_cache()
+
+    def key(column):
+        return _walk_key(target, column, community, version or _version_hints.get(target) or _default_version())
+
+    missing = []
+    for column in cacheable:
+        cached = cache.get(key(column))
+        if cached is None:
+            missing.append(column)
+        else:
+            yield from cached
+    fetch = [column for column in columns if column not in cacheable or column in missing]
+    if not fetch:
+        return
+    fetched = {column: [] for column in missing}
+    for oid, value in walk(fetch):
+        column = _column_of(oid, missing)
+        if column is not None:
+            fetched[column].append((oid, value))
+        yield oid, value
+    for column, varbinds in fetched.items():
+        if varbinds:
+            cache.set(key(column), varbinds, ttl)
+
+
+def snmp_walk(oid, target, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0,
+              version=None, max_repetitions=None, cache=False):
+    """Generator yielding OID, value pairs from an SNMP walk.
+
+    SNMPv2c walks use GETBULK with *max_repetitions* rows per request. When
+    no *version* is given the device is assumed to speak the configured
+    ``SNMP_VERSION`` and the walk falls back to SNMPv1 if it does not answer.
+    With *cache* an interface name walk is shared through the walk cache
+    for ``SNMP_WALK_CACHE_TTL`` seconds; other columns are always walked.
+    """
+    def walk(oids):
+        return _walk_with_fallback(
+            oids, target, community, port, timeout, retries, version, max_repetitions
+        )
+
+    if cache:
+        return _cached_walk([oid], target, walk, community, version)
+    return walk([oid])
+
+
+def _index_key(index):
+    return tuple(int(part) for part in index.split(".") if part.isdigit())
+
+
+def table_rows(varbinds, columns):
+    """Group OID, value pairs from a multi-column walk into ``(index, row)`` pairs.
+
+    *row* maps each column OID to its value; columns missing for an index
+    are left out. Rows are yielded in index order as soon as every column
+    has moved past them, so large tables are not buffered in full.
+    """
+    columns = list(columns)
+    pending = {}
+    heap = []
+    progress = {}
+
+    def _complete(key):
+        return all(column in progress and progress[column] >= key for column in columns)
+
+    for oid, value in varbinds:
+        column = _column_of(oid, columns)
+        if column is None:
+            continue
+        index = oid[len(column) + 1:]
+        key = _index_key(index)
+        progress[column] = max(progress.get(column, key), key)
+        if index not in pending:
+            pending[index] = {}
+            heapq.heappush(heap, (key, index))
+        pending[index][column] = value
+        while heap and _complete(heap[0][0]):
+            _, ready = heapq.heappop(heap)
+            yield ready, pending.pop(ready)
+
+    while heap:
+        _, ready = heapq.heappop(heap)
+        yield ready, pending.pop(ready)
+
+
+def snmp_table(target, columns, community=DEFAULT_COMMUNITY, port=DEFAULT_PORT, timeout=1, retries=0,
+               version=None, max_repetitions=None, cache=False):
+    """Walk several table *columns* at once and yield ``(index, row)`` pairs.
+
+    Every GETNEXT/GETBULK PDU carries all requested columns, so a table is
+    fetched in a single pass instead of one walk per column. See
+    :func:`table_rows` for the shape of the rows. With *cache* the
+    interface name column is served from the walk cache when it is there.
+    """
+    columns = list(columns)
+
+    def walk(oids):
+        return _walk_with_fallback(
+            oids, target, community, port, timeout, retries, version, max_repetitions
+        )
+
+    varbinds = _cached_walk(columns, target, walk, community, version) if cache else walk(columns)
+    return table_rows(varbinds, columns)
 
 
 SYS_NAME_OID = "1.3.6.1.2.1.1.5.0"
@@ -104,6 +606,8 @@ SYS_DESCR_OID = "1.3.6.1.2.1.1.1.0"
 IF_NAME_OID = "1.3.6.1.2.1.2.2.1.2"
 IF_MAC_OID = "1.3.6.1.2.1.2.2.1.6"
 IF_STATUS_OID = "1.3.6.1.2.1.2.2.1.8"
+# columns the walk cache may serve; anything that changes between polls is walked live
+CACHED_COLUMNS = {IF_NAME_OID}
 
 # CAM and ARP table OIDs
 DOT1D_TP_FDB_PORT_OID = "1.3.6.1.2.1.17.4.3.1.2"
@@ -112,11 +616,102 @@ IP_NET_TO_MEDIA_PHYSADDR_OID = "1.3.6.1.2.1.4.22.1.2"
 IP_NET_TO_MEDIA_IFINDEX_OID = "1.3.6.1.2.1.4.22.1.1"
 IP_NET_TO_MEDIA_NETADDR_OID = "1.3.6.1.2.1.4.22.1.3"
 
+# Change markers stored by a full scan; the periodic scan compares them to
+# skip devices where nothing moved
+SYS_UPTIME_OID = "1.3.6.1.2.1.1.3.0"
+IF_TABLE_LAST_CHANGE_OID = "1.3.6.1.2.1.31.1.5.0"
+LLDP_REM_TABLES_LAST_CHANGE_OID = "1.0.8802.1.1.2.1.2.1.0"
+CHANGE_MARKER_OIDS = {
+    "sys_uptime": SYS_UPTIME_OID,
+    "if_table_last_change": IF_TABLE_LAST_CHANGE_OID,
+    "lldp_last_change": LLDP_REM_TABLES_LAST_CHANGE_OID,
+}
+
+
+def _ticks(value):
+    """Return a TimeTicks value in hundredths of a second, or None."""
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        # puresnmp converts TimeTicks to timedelta
+        return int(value.total_seconds() * 100)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def change_markers(values):
+    """Map the change marker OIDs in *values* to Device field values."""
+    return {field: _ticks(values.get(oid)) for field, oid in CHANGE_MARKER_OIDS.items()}
+
+
+def full_scan_due(device, now=None):
+    """Return True if *device* has not had a full scan within ``SCAN_FULL_INTERVAL``."""
+    if device.last_scanned is None:
+        return True
+    interval = getattr(settings, "SCAN_FULL_INTERVAL", DEFAULT_FULL_SCAN_INTERVAL)
+    now = now or timezone.now()
+    return (now - device.last_scanned).total_seconds() >= interval
+
 
-def scan_device(ip, community=DEFAULT_COMMUNITY):
-    """Discover a device via SNMP and update Device/Interface models."""
-    sys_name = snmp_get(SYS_NAME_OID, ip, community)
-    sys_descr = snmp_get(SYS_DESCR_OID, ip, community)
+def unchanged_device(ip, community=DEFAULT_COMMUNITY):
+    """Return the known device at *ip* if nothing changed since its last full scan.
+
+    A single GET fetches sysUpTime, ifTableLastChange and
+    lldpStatsRemTablesLastChangeTime and compares them with the values
+    stored by the last full scan. Returns None when the device needs a full
+    scan: it is unknown, rebooted, a marker moved, it did not answer, or
+    its forced full rescan is due.
+    """
+    device = Device.objects.filter(management_ip=ip).first()
+    if device is None or device.sys_uptime is None or full_scan_due(device):
+        return None
+    values = snmp_get_many(ip, list(CHANGE_MARKER_OIDS.values()), community, **device_snmp_options(device))
+    markers = change_markers(values)
+    uptime = markers["sys_uptime"]
+    # a lower uptime means the device rebooted (or the counter wrapped)
+    if uptime is None or uptime < device.sys_uptime:
+        return None
+    if (
+        markers["if_table_last_change"] != device.if_table_last_change
+        or markers["lldp_last_change"] != device.lldp_last_change
+    ):
+        return None
+    device.sys_uptime = uptime
+    device.last_seen = timezone.now()
+    device.save(update_fields=["sys_uptime", "last_seen"])
+    return device
+
+
+def save_change_markers(device):
+    """Store the change markers a ``scan_device(save_markers=False)`` left on *device*."""
+    markers = getattr(device, "pending_markers", None) or {}
+    device.pending_markers = {}
+    save_device_changes(device, apply_changes(device, markers))
+
+
+def scan_device(ip, community=DEFAULT_COMMUNITY, save_markers=True):
+    """Discover a device via SNMP and update Device/Interface models.
+
+    The change markers read with sysName are stored with the rest, unless
+    *save_markers* is false: they are then kept on the device for a caller
+    that scans more of it to store with :func:`save_change_markers` once
+    all of that succeeded, so a scan that fails half way is not skipped as
+    unchanged next time.
+    """
+    known = Device.objects.filter(management_ip=ip).first()
+    # Try the version remembered for this device first so that later scans
+    # skip probing; only fall back to the other versions when it stops working.
+    sys_name = sys_descr = version = None
+    for version in snmp_versions(ip, known.snmp_version if known else None):
+        system = snmp_get_many(
+            ip, [SYS_NAME_OID, SYS_DESCR_OID, *CHANGE_MARKER_OIDS.values()], community, version=version
+        )
+        sys_name = system.get(SYS_NAME_OID)
+        sys_descr = system.get(SYS_DESCR_OID)
+        if sys_name is not None:
+            break
     if sys_name is None:
         # Device did not respond to SNMP; try ICMP reachability
         if not check_ping(ip):
@@ -140,39 +735,60 @@ def scan_device(ip, community=DEFAULT_COMMUNITY):
         ])
         return device
 
-    device, _ = Device.objects.get_or_create(
+    _version_hints[ip] = version
+
+    device, created = Device.objects.get_or_create(
         management_ip=ip, defaults={"hostname": str(sys_name)}
     )
 
-    device.hostname = str(sys_name)
-    device.vendor = str(sys_descr).split()[0] if sys_descr else ""
-    device.os_version = str(sys_descr)
-    device.discovered_snmp_community = community
-    device.last_seen = timezone.now()
-    device.save()
-
-    # Walk interface table
-    names = {}
-    for oid, val in snmp_walk(IF_NAME_OID, ip, community):
-        # IF-MIB::ifDescr.<index> or ifName
-        idx = oid.split(".")[-1]
-        names[idx] = str(val)
-
-    macs = {oid.split(".")[-1]: str(val) for oid, val in snmp_walk(IF_MAC_OID, ip, community)}
-    statuses = {oid.split(".")[-1]: int(val) for oid, val in snmp_walk(IF_STATUS_OID, ip, community)}
-
-    for idx, name in names.items():
-        iface, _ = Interface.objects.get_or_create(device=device, name=name)
-        iface.mac_address = macs.get(idx, "")
-        iface.status = str(statuses.get(idx, ""))
-        iface.last_scanned = timezone.now()
-        iface.save()
-
-    device.last_scanned = timezone.now()
-    device.save()
+    now = timezone.now()
+    markers = change_markers(system)
+    changes = apply_changes(device, {
+        "hostname": str(sys_name),
+        "vendor": str(sys_descr).split()[0] if sys_descr else "",
+        "os_version": str(sys_descr),
+        "discovered_snmp_community": community,
+        "snmp_version": version,
+        "last_seen": now,
+        **(markers if save_markers else {}),
+    })
+    device.pending_markers = {} if save_markers else markers
+    options = device_snmp_options(device)
+
+    # Walk interface table (ifDescr/ifName, MAC and status) in one pass
+    columns = [IF_NAME_OID, IF_MAC_OID, IF_STATUS_OID]
+    interfaces = {}
+    for _, row in snmp_table(ip, columns, community, cache=True, **options):
+        if IF_NAME_OID not in row:
+            continue
+        interfaces[str(row[IF_NAME_OID])] = {
+            "mac_address": str(row.get(IF_MAC_OID, "")),
+            "status": str(int(row[IF_STATUS_OID])) if IF_STATUS_OID in row else "",
+        }
+    reconcile_interfaces(device, interfaces, ["mac_address", "status"], now, log=not created)
+
+    changes.update(apply_changes(device, {"last_scanned": now}))
+    save_device_changes(device, changes, now, log=not created)
     return device
 
 
+def interface_index_map(device, ip, community=DEFAULT_COMMUNITY, **options):
+    """Return a ``{ifIndex: Interface}`` map for *device*.
+
+    Built from the cached ifName walk and a single query for the device's
+    interfaces, instead of one lookup per index.
+    """
+    by_name = {}
+    for iface in device.interfaces.order_by("pk"):
+        by_name.setdefault(iface.name, iface)
+    idx_to_iface = {}
+    for oid, val in snmp_walk(IF_NAME_OID, ip, community, cache=True, **options):
+        iface = by_name.get(str(val))
+        if iface:
+            idx_to_iface[oid.split(".")[-1]] = iface
+    return idx_to_iface
+
+
 # LLDP and CDP tables
 LLDP_SYSNAME_OID = "1.0.8802.1.1.2.1.4.1.1.9"
 LLDP_PORTID_OID = "1.0.8802.1.1.2.1.4.1.1.7"
@@ -180,99 +796,106 @@ CDP_DEVICEID_OID = "1.3.6.1.4.1.9.9.23.1.2.1.1.6"
 CDP_DEVICEPORT_OID = "1.3.6.1.4.1.9.9.23.1.2.1.1.7"
 
 
+# crawl threads reporting the same neighbour must not each create it
+_neighbor_lock = threading.Lock()
+
+
+def _neighbor_device(hostname):
+    """Return the device named *hostname*, creating it if there is none.
+
+    ``hostname`` is not unique, so the oldest match wins where earlier
+    scans left duplicates. Callers hold ``_neighbor_lock``.
+    """
+    device = Device.objects.filter(hostname=hostname).order_by("pk").first()
+    if device is None:
+        device = Device.objects.create(hostname=hostname)
+    return device
+
+
 def discover_neighbors(ip, community=DEFAULT_COMMUNITY):
     """Discover neighbors via LLDP/CDP and create Connection records."""
     device = Device.objects.filter(management_ip=ip).first()
     if not device:
         return
+    options = device_snmp_options(device)
 
-    # Map interface indexes to Interface objects
-    idx_to_iface = {}
-    for oid, val in snmp_walk(IF_NAME_OID, ip, community):
-        idx = oid.split(".")[-1]
-        iface = Interface.objects.filter(device=device, name=str(val)).first()
-        if iface:
-            idx_to_iface[idx] = iface
+    idx_to_iface = interface_index_map(device, ip, community, **options)
 
     neighbors = {}
 
-    # LLDP neighbors
-    for oid, val in snmp_walk(LLDP_SYSNAME_OID, ip, community):
-        local_idx = oid.split(".")[-2]
-        neighbors.setdefault(local_idx, {})["hostname"] = str(val)
-    for oid, val in snmp_walk(LLDP_PORTID_OID, ip, community):
-        local_idx = oid.split(".")[-2]
-        neighbors.setdefault(local_idx, {})["port"] = str(val)
-
-    # CDP neighbors
-    for oid, val in snmp_walk(CDP_DEVICEID_OID, ip, community):
-        local_idx = oid.split(".")[-2]
-        neighbors.setdefault(local_idx, {})["hostname"] = str(val)
-    for oid, val in snmp_walk(CDP_DEVICEPORT_OID, ip, community):
-        local_idx = oid.split(".")[-2]
-        neighbors.setdefault(local_idx, {})["port"] = str(val)
+    # LLDP and CDP neighbors, both indexed by <...>.<local port>.<entry>
+    for hostname_oid, port_oid in (
+        (LLDP_SYSNAME_OID, LLDP_PORTID_OID),
+        (CDP_DEVICEID_OID, CDP_DEVICEPORT_OID),
+    ):
+        for index, row in snmp_table(ip, [hostname_oid, port_oid], community, **options):
+            local_idx = index.split(".")[-2]
+            if hostname_oid in row:
+                neighbors.setdefault(local_idx, {})["hostname"] = str(row[hostname_oid])
+            if port_oid in row:
+                neighbors.setdefault(local_idx, {})["port"] = str(row[port_oid])
 
     for idx, data in neighbors.items():
         local_iface = idx_to_iface.get(idx)
         if not local_iface:
             continue
-        remote_device, _ = Device.objects.get_or_create(hostname=data.get("hostname", ""))
-        remote_iface, _ = Interface.objects.get_or_create(device=remote_device, name=data.get("port", ""))
-        Connection.objects.get_or_create(interface_a=local_iface, interface_b=remote_iface)
+        with _neighbor_lock:
+            remote_device = _neighbor_device(data.get("hostname", ""))
+            remote_iface, _ = Interface.objects.get_or_create(device=remote_device, name=data.get("port", ""))
+            Connection.objects.get_or_create(interface_a=local_iface, interface_b=remote_iface)
+
+
+def _cam_hosts(varbinds, bridge_to_if, idx_to_iface):
+    """Yield an unsaved Host for each FDB entry on a known interface."""
+    for oid, val in varbinds:
+        # the FDB index is the MAC as six decimal octets
+        octets = oid.rsplit(".", 6)[1:]
+        iface = idx_to_iface.get(bridge_to_if.get(str(val)))
+        if iface and len(octets) == 6:
+            yield Host(mac_address=format_mac(int(p) for p in octets), interface=iface)
+
+
+def _arp_hosts(varbinds, idx_to_iface):
+    """Yield an unsaved Host for each ipNetToMedia entry."""
+    for oid, val in varbinds:
+        # <column>.<ifIndex>.<a>.<b>.<c>.<d>
+        parts = oid.rsplit(".", 5)
+        if len(parts) < 6:
+            continue
+        octets = val.asOctets() if hasattr(val, "asOctets") else val
+        yield Host(
+            mac_address=format_mac(octets),
+            ip_address=".".join(parts[2:]),
+            interface=idx_to_iface.get(parts[1]),
+        )
 
 
 def gather_cam_arp(ip, community=DEFAULT_COMMUNITY):
-    """Collect CAM and ARP tables and link hosts to interfaces."""
+    """Collect CAM and ARP tables and link hosts to interfaces.
+
+    Both tables are decoded as they are walked and merged into Host in
+    batches (see :func:`inventory.hosts.upsert_hosts`). An ARP entry sets
+    the host's interface only when its ifIndex is known, and overrides the
+    CAM port otherwise.
+    """
     device = Device.objects.filter(management_ip=ip).first()
     if not device:
         return
+    options = device_snmp_options(device)
 
-    # Map interface indexes to Interface objects
-    idx_to_iface = {}
-    for oid, val in snmp_walk(IF_NAME_OID, ip, community):
-        idx = oid.split(".")[-1]
-        iface = Interface.objects.filter(device=device, name=str(val)).first()
-        if iface:
-            idx_to_iface[idx] = iface
+    idx_to_iface = interface_index_map(device, ip, community, **options)
 
     # Bridge port -> ifIndex mapping
-    bridge_to_if = {oid.split(".")[-1]: str(val) for oid, val in snmp_walk(DOT1D_BASE_PORT_IFINDEX_OID, ip, community)}
-
-    # CAM table entries: map MAC -> ifIndex
-    cam_entries = {}
-    for oid, val in snmp_walk(DOT1D_TP_FDB_PORT_OID, ip, community):
-        mac_parts = oid.split(".")[-6:]
-        mac = ":".join(f"{int(p):02x}" for p in mac_parts)
-        bridge_port = str(val)
-        ifindex = bridge_to_if.get(bridge_port)
-        if ifindex:
-            cam_entries[mac] = ifindex
-
-    for mac, ifidx in cam_entries.items():
-        iface = idx_to_iface.get(ifidx)
-        if not iface:
-            continue
-        host, _ = Host.objects.get_or_create(mac_address=mac)
-        host.interface = iface
-        host.last_seen = timezone.now()
-        host.save()
-
-    # ARP table entries
-    for oid, val in snmp_walk(IP_NET_TO_MEDIA_PHYSADDR_OID, ip, community):
-        parts = oid.split(".")
-        if len(parts) < 5:
-            continue
-        ifindex = parts[-5]
-        ip_addr = ".".join(parts[-4:])
-        octets = val.asOctets() if hasattr(val, "asOctets") else val
-        mac = ":".join(f"{b:02x}" for b in octets)
-        iface = idx_to_iface.get(ifindex)
-        host, _ = Host.objects.get_or_create(mac_address=mac)
-        host.ip_address = ip_addr
-        if iface:
-            host.interface = iface
-        host.last_seen = timezone.now()
-        host.save()
+    bridge_to_if = {
+        oid.split(".")[-1]: str(val)
+        for oid, val in snmp_walk(DOT1D_BASE_PORT_IFINDEX_OID, ip, community, **options)
+    }
+
+    fdb = snmp_walk(DOT1D_TP_FDB_PORT_OID, ip, community, **options)
+    upsert_hosts(_cam_hosts(fdb, bridge_to_if, idx_to_iface), ["interface"])
+
+    arp = snmp_walk(IP_NET_TO_MEDIA_PHYSADDR_OID, ip, community, **options)
+    upsert_hosts(_arp_hosts(arp, idx_to_iface), ["ip_address", "interface"])
 
 
 # OSPF and BGP neighbor OIDs
@@ -281,26 +904,26 @@ OSPFV3_NBR_RTRID_OID = "1.3.6.1.2.1.191.1.2.2.1.1"
 BGP_REMOTE_ADDR_OID = "1.3.6.1.2.1.15.3.1.7"
 
 
-def discover_ospf_neighbors(ip, community=DEFAULT_COMMUNITY):
+def discover_ospf_neighbors(ip, community=DEFAULT_COMMUNITY, **options):
     """Return list of OSPF neighbor IPs."""
     neighbors = []
-    for _, val in snmp_walk(OSPF_NBR_IP_OID, ip, community):
+    for _, val in snmp_walk(OSPF_NBR_IP_OID, ip, community, **options):
         neighbors.append(str(val))
     return neighbors
 
 
-def discover_ospfv3_neighbors(ip, community=DEFAULT_COMMUNITY):
+def discover_ospfv3_neighbors(ip, community=DEFAULT_COMMUNITY, **options):
     """Return list of OSPFv3 neighbor router IDs."""
     neighbors = []
-    for _, val in snmp_walk(OSPFV3_NBR_RTRID_OID, ip, community):
+    for _, val in snmp_walk(OSPFV3_NBR_RTRID_OID, ip, community, **options):
         neighbors.append(str(val))
     return neighbors
 
 
-def discover_bgp_neighbors(ip, community=DEFAULT_COMMUNITY):
+def discover_bgp_neighbors(ip, community=DEFAULT_COMMUNITY, **options):
     """Return list of BGP peer addresses."""
     neighbors = []
-    for _, val in snmp_walk(BGP_REMOTE_ADDR_OID, ip, community):
+    for _, val in snmp_walk(BGP_REMOTE_ADDR_OID, ip, community, **options):
         neighbors.append(str(val))
     return neighbors
 
@@ -313,33 +936,42 @@ IF_IN_OCTETS_OID = "1.3.6.1.2.1.2.2.1.10"
 IF_OUT_OCTETS_OID = "1.3.6.1.2.1.2.2.1.16"
 
 
-def poll_metrics(ip, community=DEFAULT_COMMUNITY):
-    """Return basic performance metrics for a device."""
-
+def build_metrics(cpu_loads, mem_total, mem_avail, if_rows):
+    """Turn raw CPU, memory and ifTable readings into a metrics dict."""
     metrics = {}
 
-    cpu_loads = [int(v) for _, v in snmp_walk(CPU_LOAD_OID, ip, community)]
     if cpu_loads:
         metrics["cpu"] = sum(cpu_loads) / len(cpu_loads)
 
-    mem_total = snmp_get(MEM_TOTAL_OID, ip, community)
-    mem_avail = snmp_get(MEM_AVAIL_OID, ip, community)
     if mem_total is not None and mem_avail is not None and int(mem_total) > 0:
         used = int(mem_total) - int(mem_avail)
         metrics["memory"] = used / int(mem_total) * 100
 
-    names = {oid.split(".")[-1]: str(val) for oid, val in snmp_walk(IF_NAME_OID, ip, community)}
-    in_octets = {oid.split(".")[-1]: int(val) for oid, val in snmp_walk(IF_IN_OCTETS_OID, ip, community)}
-    out_octets = {oid.split(".")[-1]: int(val) for oid, val in snmp_walk(IF_OUT_OCTETS_OID, ip, community)}
-
     interfaces = {}
-    for idx, name in names.items():
-        interfaces[name] = {
-            "in_octets": in_octets.get(idx),
-            "out_octets": out_octets.get(idx),
+    for _, row in if_rows:
+        if IF_NAME_OID not in row:
+            continue
+        in_octets = row.get(IF_IN_OCTETS_OID)
+        out_octets = row.get(IF_OUT_OCTETS_OID)
+        interfaces[str(row[IF_NAME_OID])] = {
+            "in_octets": int(in_octets) if in_octets is not None else None,
+            "out_octets": int(out_octets) if out_octets is not None else None,
         }
     metrics["interfaces"] = interfaces
 
     return metrics
 
 
+METRIC_IF_COLUMNS = [IF_NAME_OID, IF_IN_OCTETS_OID, IF_OUT_OCTETS_OID]
+
+
+def poll_metrics(ip, community=DEFAULT_COMMUNITY, version=None, max_repetitions=None):
+    """Return basic performance metrics for a device."""
+    options = {"version": version, "max_repetitions": max_repetitions}
+
+    cpu_loads = [int(v) for _, v in snmp_walk(CPU_LOAD_OID, ip, community, **options)]
+    memory = snmp_get_many(ip, [MEM_TOTAL_OID, MEM_AVAIL_OID], community, **options)
+    mem_total = memory.get(MEM_TOTAL_OID)
+    mem_avail = memory.get(MEM_AVAIL_OID)
+    if_rows = snmp_table(ip, METRIC_IF_COLUMNS, community, cache=True, **options)
+    return build_metrics(cpu_loads, mem_total, mem_avail, if_rows)
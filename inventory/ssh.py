@@ -1,6 +1,39 @@
+import re
+
 from django.utils import timezone
 from netmiko import ConnectHandler
-from .models import Device, Interface
+from .models import Device
+from .reconcile import apply_changes, reconcile_interfaces, save_device_changes
+
+# Interface  IP-Address  OK?  Method  Status  Protocol
+IP_INTERFACE_BRIEF_HEADER = re.compile(
+    r"^Interface\s+IP-Address\s+OK\?\s+Method\s+Status\s+Protocol\s*$", re.IGNORECASE
+)
+IP_INTERFACE_BRIEF_ROW = re.compile(
+    r"^(?P<name>\S+)\s+(?P<ip>\d{1,3}(?:\.\d{1,3}){3}|unassigned)\s+(?:YES|NO)\s+\S+\s+"
+    r"(?:up|down|administratively down|deleted)\s+(?:up|down)\s*$",
+    re.IGNORECASE,
+)
+
+
+def parse_ip_interface_brief(output):
+    """Return ``{name: {"ip_address": ip}}`` from ``show ip interface brief``.
+
+    Rows are only read after the column header, and only if they have the
+    shape of an interface row, so CLI errors, banners and pager prompts are
+    never taken for interfaces. Returns an empty dict if there is no header.
+    """
+    interfaces = {}
+    header = False
+    for line in output.splitlines():
+        if not header:
+            header = bool(IP_INTERFACE_BRIEF_HEADER.match(line.strip()))
+            continue
+        match = IP_INTERFACE_BRIEF_ROW.match(line.strip())
+        if match:
+            ip_addr = match["ip"] if match["ip"].lower() != "unassigned" else None
+            interfaces[match["name"]] = {"ip_address": ip_addr}
+    return interfaces
 
 
 def ssh_scan_device(ip, username, password, device_type="cisco_ios"):
@@ -18,23 +51,22 @@ def ssh_scan_device(ip, username, password, device_type="cisco_ios"):
             hostname = line.split()[-1]
             break
 
-    device, _ = Device.objects.get_or_create(management_ip=ip)
+    device, created = Device.objects.get_or_create(management_ip=ip)
+    now = timezone.now()
+    values = {
+        "discovered_ssh_username": username,
+        "discovered_ssh_password": password,
+        "last_seen": now,
+        "last_scanned": now,
+    }
     if hostname:
-        device.hostname = hostname
-    device.discovered_ssh_username = username
-    device.discovered_ssh_password = password
-    device.last_seen = timezone.now()
-    device.last_scanned = timezone.now()
-    device.save()
-
-    for line in iface_output.splitlines():
-        parts = line.split()
-        if len(parts) >= 2 and not line.lower().startswith("interface"):
-            name = parts[0]
-            ip_addr = parts[1] if parts[1].lower() != "unassigned" else None
-            iface, _ = Interface.objects.get_or_create(device=device, name=name)
-            iface.ip_address = ip_addr
-            iface.last_scanned = timezone.now()
-            iface.save()
+        values["hostname"] = hostname
+    changes = apply_changes(device, values)
+
+    interfaces = parse_ip_interface_brief(iface_output)
+    # output that could not be parsed says nothing about the interfaces
+    if interfaces:
+        reconcile_interfaces(device, interfaces, ["ip_address"], now, log=not created)
+    save_device_changes(device, changes, now, log=not created)
 
     return device
@@ -0,0 +1,184 @@
+"""Sweep whole subnets for devices with asynchronous ICMP and SNMP probes.
+
+Every address is pinged from a single ICMP socket; addresses that do not
+answer are then asked for sysName, since many devices drop ICMP but still
+speak SNMP. Both probes share one packets-per-second budget. Responders are
+handed to :func:`inventory.snmp.scan_device`.
+"""
+import asyncio
+import ipaddress
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+
+from . import snmp
+from .discovery import scan_devices
+from .icmp import Pinger, RateLimiter
+from .ping import check_ping
+from .snmp import DEFAULT_COMMUNITY, DEFAULT_PORT, SYS_NAME_OID
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP_CONCURRENCY = 512
+DEFAULT_SWEEP_RATE = 1000
+# shortest prefix swept unless overridden: a /16 is 65534 addresses
+DEFAULT_SWEEP_MIN_PREFIX = 16
+# addresses probed per round, which bounds the memory of a large sweep
+SWEEP_BLOCK_SIZE = 4096
+
+
+def sweep_networks(cidrs, min_prefix=None):
+    """Parse *cidrs* into the IPv4 networks to sweep.
+
+    Raises ValueError for an invalid or IPv6 network, since the probes are
+    IPv4 only, and for one with a prefix shorter than *min_prefix*
+    (``SWEEP_MIN_PREFIX``).
+    """
+    if min_prefix is None:
+        min_prefix = getattr(settings, "SWEEP_MIN_PREFIX", DEFAULT_SWEEP_MIN_PREFIX)
+    networks = []
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        if network.version != 4:
+            raise ValueError(f"{cidr} is not an IPv4 network")
+        if network.prefixlen < min_prefix:
+            raise ValueError(f"{cidr} is larger than the /{min_prefix} sweep limit")
+        networks.append(network)
+    return networks
+
+
+def _hosts(network):
+    return network.hosts() if network.num_addresses > 1 else [network.network_address]
+
+
+def _is_host(address, network):
+    if address not in network:
+        return False
+    # /31 and /32 have no network and broadcast addresses to leave out
+    return network.num_addresses <= 2 or address not in (
+        network.network_address, network.broadcast_address
+    )
+
+
+def sweep_targets(networks):
+    """Yield each host address in *networks* once, in order.
+
+    Repeats are found by checking the earlier networks rather than
+    remembering every address, so memory does not grow with the sweep.
+    """
+    for index, network in enumerate(networks):
+        earlier = networks[:index]
+        for address in _hosts(network):
+            if not any(_is_host(address, prior) for prior in earlier):
+                yield str(address)
+
+
+async def _bounded(hosts, concurrency, probe):
+    """Run *probe* over *hosts* with at most *concurrency* in flight."""
+    found = set()
+    iterator = iter(hosts)
+
+    async def worker():
+        for host in iterator:
+            try:
+                if await probe(host):
+                    found.add(host)
+            except Exception:
+                logger.debug("Probe of %s failed", host, exc_info=True)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(hosts)) or 1)))
+    return found
+
+
+async def _icmp_sweep(hosts, limiter, concurrency, timeout, executor):
+    try:
+        results = await Pinger(limiter).ping(hosts, timeout)
+    except PermissionError:
+        logger.warning("No ICMP socket available; falling back to check_ping")
+        loop = asyncio.get_running_loop()
+
+        async def probe(host):
+            await limiter.wait()
+            return await loop.run_in_executor(executor, check_ping, host, 1, timeout)
+
+        return await _bounded(hosts, concurrency, probe)
+    return {host for host, rtt in results.items() if rtt is not None}
+
+
+async def _snmp_sweep(hosts, community, limiter, concurrency, timeout, executor):
+    loop = asyncio.get_running_loop()
+    version = snmp._default_version()
+
+    async def probe(host):
+        await limiter.wait()
+        if snmp.Client is None:
+            value = await loop.run_in_executor(
+                executor, snmp.snmp_get, SYS_NAME_OID, host, community, DEFAULT_PORT, timeout, 0, version
+            )
+            return value is not None
+        # one-off clients; sweeping thousands of addresses would flush the session pool
+        client = snmp._pure_client(host, community, DEFAULT_PORT, timeout, 0, version)
+        values = await client.multiget([SYS_NAME_OID])
+        return snmp._value(values[0]) is not None
+
+    return await _bounded(hosts, concurrency, probe)
+
+
+async def _probe(hosts, community, icmp, snmp_probe, concurrency, rate, timeout):
+    limiter = RateLimiter(rate)
+    executor = ThreadPoolExecutor(min(concurrency, 64))
+    try:
+        responders = set()
+        if icmp:
+            responders |= await _icmp_sweep(hosts, limiter, concurrency, timeout, executor)
+        if snmp_probe:
+            silent = [host for host in hosts if host not in responders]
+            responders |= await _snmp_sweep(silent, community, limiter, concurrency, timeout, executor)
+    finally:
+        executor.shutdown(wait=False)
+    return responders
+
+
+def sweep_subnets(cidrs, community=DEFAULT_COMMUNITY, concurrency=None, rate=None, timeout=1.0,
+                  icmp=True, snmp_probe=True, scan=True, workers=None, min_prefix=None):
+    """Probe every address in *cidrs* and scan the ones that respond.
+
+    *concurrency* caps probes in flight (``SWEEP_CONCURRENCY``) and *rate*
+    caps packets per second (``SWEEP_RATE``). Networks are checked with
+    :func:`sweep_networks` first and probed ``SWEEP_BLOCK_SIZE`` addresses
+    at a time. Returns a dict with the
+    ``responders``, the addresses ``scanned`` successfully (empty unless
+    *scan*), the number of ``addresses`` probed and the probe ``wall_time``
+    in seconds.
+    """
+    if concurrency is None:
+        concurrency = getattr(settings, "SWEEP_CONCURRENCY", DEFAULT_SWEEP_CONCURRENCY)
+    if rate is None:
+        rate = getattr(settings, "SWEEP_RATE", DEFAULT_SWEEP_RATE)
+    targets = sweep_targets(sweep_networks(cidrs, min_prefix))
+    addresses = 0
+    responders = []
+    start = time.monotonic()
+    while True:
+        hosts = list(islice(targets, SWEEP_BLOCK_SIZE))
+        if not hosts:
+            break
+        addresses += len(hosts)
+        found = snmp.session_pool.loop().run_until_complete(
+            _probe(hosts, community, icmp, snmp_probe, max(1, concurrency), rate, timeout)
+        )
+        # keep address order for stable output
+        responders.extend(host for host in hosts if host in found)
+    wall_time = time.monotonic() - start
+    logger.info("Swept %d addresses in %.2fs, %d responded", addresses, wall_time, len(responders))
+    scanned = set(scan_devices(responders, community, workers)) if scan else set()
+    scanned = [host for host in responders if host in scanned]
+    return {
+        "addresses": addresses,
+        "responders": responders,
+        "scanned": scanned,
+        "wall_time": wall_time,
+    }
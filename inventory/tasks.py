@@ -1,18 +1,25 @@
+import logging
+
 from celery import shared_task
-from .discovery import discover_network, periodic_scan
+from .discovery import discover_network, periodic_scan, scan_and_expand
+from django.db.models import F
 from django.utils import timezone
 from django.conf import settings
-from .snmp import (
-    scan_device,
-    discover_neighbors,
-    gather_cam_arp,
-    poll_metrics,
-    discover_ospf_neighbors,
-    discover_ospfv3_neighbors,
-    discover_bgp_neighbors,
-)
-from .ping import check_ping
-from .models import Device, MetricRecord, Alert, AlertProfile
+from .ping import ping_many
+from .metrics import MetricWriter, get_store, prune_rollups
+from .partitions import ensure_partitions, prune_metric_records
+from .models import Device, Alert, AlertProfile, PollCycle
+from .poller import poll_devices
+from .schedule import due_devices, prune_poll_cycles
+from .sharding import shard_devices
+from .sweep import sweep_subnets
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PING_COUNT = 5
+DEFAULT_PING_INTERVAL = 0.2
+# latency statistics recorded alongside the 1/0 "ping" metric
+PING_METRICS = ["rtt_min", "rtt_avg", "rtt_max", "jitter", "packet_loss"]
 
 
 def _get_alert_profiles(device):
@@ -52,142 +59,222 @@ def _evaluate_alerts(device, metrics, timestamp):
 
 
 @shared_task
-def scan_device_task(ip, community="public"):
-    """Scan a single device and return discovered host IPs."""
-    device = scan_device(ip, community)
-    if device is None:
-        return []
-
-    modules = getattr(settings, "DISCOVERY_MODULES", ["arp", "cdp", "lldp"])
-    modules = {m.strip().lower() for m in modules}
-    if {"cdp", "lldp"} & modules:
-        discover_neighbors(ip, community)
-    if "arp" in modules:
-        gather_cam_arp(ip, community)
-    new_ips = []
-    if "ospf" in modules:
-        new_ips.extend(discover_ospf_neighbors(ip, community))
-    if "ospfv3" in modules:
-        new_ips.extend(discover_ospfv3_neighbors(ip, community))
-    if "bgp" in modules:
-        new_ips.extend(discover_bgp_neighbors(ip, community))
-
-    from .models import Host
-
-    host_ips = list(
-        Host.objects.filter(interface__device=device).values_list("ip_address", flat=True)
-    )
-    return host_ips + new_ips
+def scan_device_task(ip, community="public", skip_unchanged=False):
+    """Scan a single device and return the IPs discovery should follow.
+
+    Returns None if the device did not answer.
+    """
+    return scan_and_expand(ip, community, skip_unchanged)
 
 
 @shared_task
-def discover_network_task(seed_ip, community="public"):
+def discover_network_task(seed_ip, community="public", workers=None, distributed=False):
     """Celery task wrapper for discover_network."""
-    return discover_network(seed_ip, community)
+    return discover_network(seed_ip, community, workers=workers, distributed=distributed)
 
 
 @shared_task
-def periodic_scan_task(community="public"):
+def periodic_scan_task(community="public", workers=None, distributed=False):
     """Rescan all known devices."""
-    return periodic_scan(community)
+    return periodic_scan(community, workers=workers, distributed=distributed)
 
 
 @shared_task
-def metric_poll_task(default_community="public"):
-    """Poll devices for performance metrics and store results."""
+def sweep_subnets_task(cidrs, community="public", concurrency=None, rate=None, timeout=1.0, icmp=True,
+                       snmp_probe=True, scan=True, workers=None, min_prefix=None):
+    """Sweep *cidrs* for devices and scan the ones that respond.
+
+    Raises ValueError for networks :func:`inventory.sweep.sweep_networks`
+    rejects.
+    """
+    return sweep_subnets(
+        cidrs, community, concurrency=concurrency, rate=rate, timeout=timeout, icmp=icmp,
+        snmp_probe=snmp_probe, scan=scan, workers=workers, min_prefix=min_prefix,
+    )
+
+
+def _poll_and_record(devices, default_community):
+    """Poll *devices*, store their metrics and evaluate alerts.
+
+    Returns the IPs polled, how many of them answered and the wall time.
+    """
     results = []
+    answered = 0
     timestamp = timezone.now()
-    for device in Device.objects.all():
-        if not device.management_ip:
-            continue
-        community = device.snmp_community or device.discovered_snmp_community or default_community
-        metrics = poll_metrics(device.management_ip, community)
-
-        if "cpu" in metrics:
-            MetricRecord.objects.create(
-                device=device,
-                metric="cpu",
-                value=metrics["cpu"],
-                timestamp=timestamp,
-            )
-        if "memory" in metrics:
-            MetricRecord.objects.create(
-                device=device,
-                metric="memory",
-                value=metrics["memory"],
-                timestamp=timestamp,
+    cycle = poll_devices(devices, default_community)
+    with MetricWriter() as writer:
+        for device, metrics in cycle["results"]:
+            writer.add_device_metrics(device, metrics, timestamp)
+            _evaluate_alerts(device, metrics, timestamp)
+            results.append(device.management_ip)
+            if metrics:
+                answered += 1
+    return results, answered, cycle["wall_time"]
+
+
+def _poll_shard(cycle_id, devices, default_community):
+    """Poll one shard of a cycle and add its results to the cycle's record."""
+    results, answered, wall_time = [], 0, 0.0
+    try:
+        results, answered, wall_time = _poll_and_record(devices, default_community)
+    finally:
+        PollCycle.objects.filter(pk=cycle_id).update(
+            shards_done=F("shards_done") + 1,
+            polled=F("polled") + answered,
+            poll_seconds=F("poll_seconds") + wall_time,
+        )
+        PollCycle.objects.filter(
+            pk=cycle_id, shards_done__gte=F("shards"), finished_at__isnull=True
+        ).update(finished_at=timezone.now())
+    return results
+
+
+def _start_cycle(due, default_community):
+    """Record a poll cycle for ``(device, seconds late)`` pairs and run its shards.
+
+    With ``METRIC_POLL_QUEUES`` each shard is sent to its queue and the
+    cycle's record is completed by the last one to finish; otherwise the
+    devices are polled here. Devices without a management IP cannot be
+    polled and are left out. Returns the cycle and the IPs polled here.
+    """
+    due = [(device, late) for device, late in due if device.management_ip]
+    devices = [device for device, _ in due]
+    now = timezone.now()
+    # claim them first so a slow cycle is not picked up again by the next tick
+    Device.objects.filter(pk__in=[device.pk for device in devices]).update(last_polled=now)
+    shards = shard_devices(devices)
+    cycle = PollCycle.objects.create(
+        started_at=now,
+        # no shard will run to finish a cycle with nothing to poll
+        finished_at=None if shards else now,
+        shards=len(shards),
+        devices=len(devices),
+        max_late=max((late for _, late in due), default=0),
+    )
+    polled = []
+    for queue, shard in shards.items():
+        if queue is None:
+            polled.extend(_poll_shard(cycle.pk, shard, default_community))
+        else:
+            poll_shard_task.apply_async(
+                (cycle.pk, [device.pk for device in shard], default_community), queue=queue
             )
+    return cycle, polled
+
+
+@shared_task
+def poll_shard_task(cycle_id, device_ids, default_community="public"):
+    """Poll the devices of one shard of a poll cycle."""
+    devices = list(Device.objects.filter(pk__in=device_ids))
+    return _poll_shard(cycle_id, devices, default_community)
 
-        for iface_name, vals in metrics.get("interfaces", {}).items():
-            iface = device.interfaces.filter(name=iface_name).first()
-            if not iface:
-                continue
-            if vals.get("in_octets") is not None:
-                MetricRecord.objects.create(
-                    device=device,
-                    interface=iface,
-                    metric="in_octets",
-                    value=vals["in_octets"],
-                    timestamp=timestamp,
-                )
-            if vals.get("out_octets") is not None:
-                MetricRecord.objects.create(
-                    device=device,
-                    interface=iface,
-                    metric="out_octets",
-                    value=vals["out_octets"],
-                    timestamp=timestamp,
-                )
-
-        _evaluate_alerts(device, metrics, timestamp)
-        results.append(device.management_ip)
 
+@shared_task
+def metric_poll_task(default_community="public"):
+    """Poll every device for performance metrics and store results."""
+    cycle, results = _start_cycle([(device, 0) for device in Device.objects.all()], default_community)
+
+    logger.info(
+        "Metric poll cycle %d: %d devices in %d shards, %d polled here",
+        cycle.pk,
+        cycle.devices,
+        cycle.shards,
+        len(results),
+    )
     return results
 
 
+@shared_task
+def scheduled_poll_task(default_community="public"):
+    """Poll the devices whose slot in their poll interval has come round.
+
+    Returns the poll cycle, the IPs polled in this worker and, per
+    hostname, the seconds each was past its deadline when this tick picked
+    it up.
+    """
+    due = due_devices()
+    if not due:
+        return {"cycle": None, "polled": [], "late": {}}
+    cycle, results = _start_cycle(due, default_community)
+    late = {device.hostname or device.management_ip: round(seconds, 1) for device, seconds in due}
+
+    logger.info(
+        "Scheduled poll cycle %d: %d due devices in %d shards, at most %.1fs late",
+        cycle.pk,
+        cycle.devices,
+        cycle.shards,
+        cycle.max_late,
+    )
+    return {"cycle": cycle.pk, "polled": results, "late": late}
+
+
 @shared_task
 def ping_check_task():
-    """Ping all devices and record availability."""
+    """Ping all devices and record availability, latency and packet loss."""
     timestamp = timezone.now()
-    results = []
-    for device in Device.objects.all():
-        if not device.management_ip:
-            continue
-        is_up = check_ping(device.management_ip)
-        MetricRecord.objects.create(
-            device=device,
-            metric="ping",
-            value=1 if is_up else 0,
-            timestamp=timestamp,
-        )
-        device.is_online = is_up
+    devices = [device for device in Device.objects.all() if device.management_ip]
+    results = ping_many(
+        [device.management_ip for device in devices],
+        count=getattr(settings, "PING_COUNT", DEFAULT_PING_COUNT),
+        interval=getattr(settings, "PING_INTERVAL", DEFAULT_PING_INTERVAL),
+    )
+
+    active_alerts = {
+        alert.device_id: alert
+        for alert in Alert.objects.filter(metric="ping", cleared_at__isnull=True)
+    }
+    writer = MetricWriter()
+    new_alerts = []
+    cleared_alerts = []
+    for device in devices:
+        stats = results.get(device.management_ip, {})
+        up = stats.get("up", False)
+        writer.add(device, "ping", 1 if up else 0, timestamp)
+        for metric in PING_METRICS:
+            if stats.get(metric) is not None:
+                writer.add(device, metric, stats[metric], timestamp)
+        device.is_online = up
         device.last_ping = timestamp
-        device.save(update_fields=["is_online", "last_ping"])
-        active = Alert.objects.filter(device=device, metric="ping", cleared_at__isnull=True).first()
-        if not is_up:
+        active = active_alerts.get(device.pk)
+        if not up:
             if not active:
-                Alert.objects.create(device=device, metric="ping", value=0)
+                new_alerts.append(Alert(device=device, metric="ping", value=0))
         elif active:
             active.value = 1
             active.cleared_at = timestamp
-            active.save()
-        results.append(device.management_ip)
-    return results
+            cleared_alerts.append(active)
+
+    writer.flush()
+    Device.objects.bulk_update(devices, ["is_online", "last_ping"])
+    Alert.objects.bulk_create(new_alerts)
+    Alert.objects.bulk_update(cleared_alerts, ["value", "cleared_at"])
+    return [device.management_ip for device in devices]
 
 
 @shared_task
 def alert_check_task():
     """Evaluate recent metrics against alert profiles."""
     timestamp = timezone.now()
+    store = get_store()
     for device in Device.objects.all():
         latest = {}
         for metric in ["cpu", "memory"]:
-            rec = (
-                device.metric_records.filter(metric=metric)
-                .order_by("-timestamp")
-                .first()
-            )
-            if rec:
-                latest[metric] = rec.value
+            sample = store.latest(metric, device=device)
+            if sample:
+                latest[metric] = sample.value
         _evaluate_alerts(device, latest, timestamp)
     return "alerts checked"
+
+
+@shared_task
+def prune_metrics_task():
+    """Delete raw samples, rollups and poll cycle records that have outlived their retention."""
+    deleted = {**prune_metric_records(), **prune_rollups(), **prune_poll_cycles()}
+    logger.info("Pruned metrics: %s", deleted)
+    return deleted
+
+
+@shared_task
+def maintain_metric_partitions_task():
+    """Create upcoming MetricRecord partitions when the table is partitioned."""
+    return ensure_partitions()
@@ -1,8 +1,12 @@
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
-from .models import Device, Interface, Connection, Tag, AlertProfile, Host, MetricRecord, Alert
+from django.utils import timezone
+from .models import Device, Interface, Connection, Tag, AlertProfile, Host, MetricRecord, Alert, Neighbor
 import subprocess
+import threading
+import time
+from datetime import timedelta
 
 
 class DeviceModelTest(TestCase):
@@ -35,6 +39,17 @@ from . import tasks
 from . import server
 
 
+def _fake_table(fake_walk):
+    """Build a snmp_table stand-in from a per-column fake snmp_walk."""
+    def fake_table(target, columns, community="public", *args, **kwargs):
+        rows = {}
+        for column in columns:
+            for oid, val in fake_walk(column, target, community):
+                rows.setdefault(oid[len(column) + 1:], {})[column] = val
+        return iter(rows.items())
+    return fake_table
+
+
 class SNMPScanTest(TestCase):
     def test_scan_device_creates_interfaces(self):
         def fake_walk(oid, ip, community, *args, **kwargs):
@@ -55,9 +70,10 @@ class SNMPScanTest(TestCase):
                 ])
             return iter([])
 
-        with patch.object(snmp_module, "snmp_get", side_effect=["sw1", "VendorOS"]), patch.object(
+        system = {snmp_module.SYS_NAME_OID: "sw1", snmp_module.SYS_DESCR_OID: "VendorOS"}
+        with patch.object(snmp_module, "snmp_get_many", return_value=system), patch.object(
             snmp_module, "snmp_walk", side_effect=fake_walk
-        ):
+        ), patch.object(snmp_module, "snmp_table", side_effect=_fake_table(fake_walk)):
             device = snmp_module.scan_device("192.0.2.1")
 
         self.assertIsNotNone(device)
@@ -67,7 +83,7 @@ class SNMPScanTest(TestCase):
 
 class PingFallbackTest(TestCase):
     def test_scan_device_adds_host_when_pingable(self):
-        with patch.object(snmp_module, "snmp_get", side_effect=[None, None]), \
+        with patch.object(snmp_module, "snmp_get_many", return_value={}), \
              patch.object(snmp_module, "check_ping", return_value=True):
             device = snmp_module.scan_device("192.0.2.1")
 
@@ -90,14 +106,36 @@ class NeighborDiscoveryTest(TestCase):
                 return iter([(f"{oid}.1.1", "Eth0/1")])
             return iter([])
 
-        with patch.object(snmp_module, "snmp_walk", side_effect=fake_walk):
+        with patch.object(snmp_module, "snmp_walk", side_effect=fake_walk), \
+             patch.object(snmp_module, "snmp_table", side_effect=_fake_table(fake_walk)):
             snmp_module.discover_neighbors("192.0.2.1")
 
         self.assertEqual(Connection.objects.count(), 1)
         conn = Connection.objects.first()
         self.assertEqual(conn.interface_b.device.hostname, "sw2")
 
-from unittest.mock import MagicMock
+    def test_existing_duplicate_neighbors_are_reused(self):
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1")
+        Interface.objects.create(device=device, name="Gig0/1")
+        first = Device.objects.create(hostname="sw2")
+        Device.objects.create(hostname="sw2")
+
+        def fake_walk(oid, ip, community, *args, **kwargs):
+            if oid == snmp_module.IF_NAME_OID:
+                return iter([(f"{oid}.1", "Gig0/1")])
+            if oid == snmp_module.LLDP_SYSNAME_OID:
+                return iter([(f"{oid}.1.1", "sw2")])
+            return iter([])
+
+        with patch.object(snmp_module, "snmp_walk", side_effect=fake_walk), \
+             patch.object(snmp_module, "snmp_table", side_effect=_fake_table(fake_walk)):
+            snmp_module.discover_neighbors("192.0.2.1")
+            snmp_module.discover_neighbors("192.0.2.1")
+
+        self.assertEqual(Device.objects.filter(hostname="sw2").count(), 2)
+        self.assertEqual(Connection.objects.get().interface_b.device, first)
+
+from unittest.mock import AsyncMock, MagicMock
 from . import ssh as ssh_module
 
 
@@ -106,7 +144,10 @@ class SSHScanTest(TestCase):
         fake_conn = MagicMock()
         fake_conn.send_command.side_effect = [
             "Hostname: sw1\nVersion 15.1",
-            "Gig0/0 10.0.0.1 up up\nGig0/1 unassigned up down",
+            "Interface              IP-Address      OK? Method Status                Protocol\n"
+            "Gig0/0                 10.0.0.1        YES manual up                    up\n"
+            "Gig0/1                 unassigned      YES unset  administratively down down\n"
+            " --More-- ",
         ]
         with patch("inventory.ssh.ConnectHandler", return_value=fake_conn):
             device = ssh_module.ssh_scan_device("192.0.2.1", "admin", "pass")
@@ -115,6 +156,20 @@ class SSHScanTest(TestCase):
         self.assertEqual(device.interfaces.count(), 2)
         names = sorted(i.name for i in device.interfaces.all())
         self.assertEqual(names, ["Gig0/0", "Gig0/1"])
+        self.assertEqual(device.interfaces.get(name="Gig0/0").ip_address, "10.0.0.1")
+
+    def test_cli_errors_leave_interfaces_alone(self):
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1")
+        Interface.objects.create(device=device, name="Gig0/0")
+        fake_conn = MagicMock()
+        fake_conn.send_command.side_effect = [
+            "Hostname: sw1",
+            "                ^\n% Invalid input detected at '^' marker.",
+        ]
+        with patch("inventory.ssh.ConnectHandler", return_value=fake_conn):
+            ssh_module.ssh_scan_device("192.0.2.1", "admin", "pass")
+
+        self.assertEqual(list(device.interfaces.values_list("name", flat=True)), ["Gig0/0"])
 
 
 class CamArpTest(TestCase):
@@ -140,15 +195,50 @@ class CamArpTest(TestCase):
         self.assertEqual(host.ip_address, "192.0.2.100")
         self.assertEqual(host.interface.name, "Gig0/1")
 
+    @override_settings(HOST_BATCH_SIZE=3)
+    def test_gather_cam_arp_upserts_in_batches(self):
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1")
+        gig1 = Interface.objects.create(device=device, name="Gig0/1")
+        gig2 = Interface.objects.create(device=device, name="Gig0/2")
+        Host.objects.create(mac_address="00:00:00:00:00:01", ip_address="10.0.0.1")
+        fdb = [(f"{snmp_module.DOT1D_TP_FDB_PORT_OID}.0.0.0.0.0.{n}", 1 + n % 2) for n in range(1, 8)]
+        arp = [
+            (f"{snmp_module.IP_NET_TO_MEDIA_PHYSADDR_OID}.9.10.0.0.1", bytes(5) + b"\x01"),
+            (f"{snmp_module.IP_NET_TO_MEDIA_PHYSADDR_OID}.2.10.0.0.2", bytes(5) + b"\x02"),
+        ]
+
+        def fake_walk(oid, ip, community, *args, **kwargs):
+            tables = {
+                snmp_module.IF_NAME_OID: [(f"{oid}.1", "Gig0/1"), (f"{oid}.2", "Gig0/2")],
+                snmp_module.DOT1D_BASE_PORT_IFINDEX_OID: [(f"{oid}.1", 1), (f"{oid}.2", 2)],
+                snmp_module.DOT1D_TP_FDB_PORT_OID: fdb,
+                snmp_module.IP_NET_TO_MEDIA_PHYSADDR_OID: arp,
+            }
+            return iter(tables.get(oid, []))
+
+        with patch.object(snmp_module, "snmp_walk", side_effect=fake_walk), \
+             self.assertNumQueries(7):  # device, ifIndex map, 3 FDB batches, 1 ARP batch x 2 column sets
+            snmp_module.gather_cam_arp("192.0.2.1")
+
+        self.assertEqual(Host.objects.count(), 7)
+        first = Host.objects.get(mac_address="00:00:00:00:00:01")
+        # the ARP entry's ifIndex is unknown, so the CAM port stays
+        self.assertEqual((first.ip_address, first.interface), ("10.0.0.1", gig2))
+        second = Host.objects.get(mac_address="00:00:00:00:00:02")
+        self.assertEqual((second.ip_address, second.interface), ("10.0.0.2", gig2))
+        self.assertEqual(Host.objects.get(mac_address="00:00:00:00:00:04").interface, gig1)
+        self.assertEqual(Host.objects.filter(last_seen__isnull=True).count(), 0)
+
 
 from . import discovery as discovery_module
 
 
+@override_settings(DISCOVERY_WORKERS=1)
 class DiscoveryLogicTest(TestCase):
     def test_discover_network_recurses(self):
         created = {}
 
-        def fake_scan(ip, community="public"):
+        def fake_scan(ip, community="public", save_markers=True):
             device = Device.objects.create(hostname=f"dev-{ip}", management_ip=ip)
             Interface.objects.create(device=device, name="eth0")
             created[ip] = device
@@ -169,7 +259,7 @@ class DiscoveryLogicTest(TestCase):
     def test_local_arp_seeds_are_filtered(self):
         created = {}
 
-        def fake_scan(ip, community="public"):
+        def fake_scan(ip, community="public", save_markers=True):
             device = Device.objects.create(hostname=f"dev-{ip}", management_ip=ip)
             Interface.objects.create(device=device, name="eth0")
             created[ip] = device
@@ -199,13 +289,13 @@ class DiscoveryLogicTest(TestCase):
     def test_ospf_module_enqueues_neighbors(self):
         created = {}
 
-        def fake_scan(ip, community="public"):
+        def fake_scan(ip, community="public", save_markers=True):
             device = Device.objects.create(hostname=f"dev-{ip}", management_ip=ip)
             Interface.objects.create(device=device, name="eth0")
             created[ip] = device
             return device
 
-        def fake_ospf(ip, community="public"):
+        def fake_ospf(ip, community="public", **options):
             if ip == "10.0.0.1":
                 return ["10.0.0.3"]
             return []
@@ -223,66 +313,259 @@ class DiscoveryLogicTest(TestCase):
         self.assertIn("10.0.0.3", visited)
 
 
-class ServerDiscoveryTest(TestCase):
-    def test_proc_net_arp_fallback(self):
-        arp_data = (
-            "IP address       HW type     Flags       HW address            Mask     Device\n"
-            "10.0.0.5       0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0\n"
+class ParallelCrawlTest(TestCase):
+    GRAPH = {
+        "10.0.0.1": ["10.0.0.2", "10.0.0.3", "8.8.8.8"],
+        "10.0.0.2": ["10.0.0.1", "10.0.0.4", "10.0.0.5"],
+        "10.0.0.3": ["10.0.0.4", "10.0.0.6"],
+        "10.0.0.4": ["10.0.0.7", "10.0.0.2"],
+        "10.0.0.5": [],
+        "10.0.0.6": ["10.0.0.1"],
+        "10.0.0.7": ["10.0.0.3", "10.0.0.9"],
+    }
+
+    def _crawl(self, workers):
+        calls = []
+        active = {"now": 0, "max": 0}
+        lock = threading.Lock()
+
+        def fake_scan(ip, community="public", skip_unchanged=False):
+            with lock:
+                calls.append(ip)
+                active["now"] += 1
+                active["max"] = max(active["max"], active["now"])
+            time.sleep(0.01)
+            with lock:
+                active["now"] -= 1
+            return self.GRAPH.get(ip)
+
+        with patch.object(discovery_module, "scan_and_expand", side_effect=fake_scan), \
+             patch.object(discovery_module, "discover_local_server", return_value=None):
+            visited = discovery_module.discover_network("10.0.0.1", workers=workers)
+        return set(visited), calls, active["max"]
+
+    def test_parallel_crawl_matches_serial(self):
+        serial, serial_calls, _ = self._crawl(1)
+        parallel, parallel_calls, concurrency = self._crawl(4)
+        self.assertEqual(serial, set(self.GRAPH))
+        self.assertEqual(parallel, serial)
+        # every address is scanned once, including the one that does not answer
+        self.assertEqual(sorted(parallel_calls), sorted(set(parallel_calls)))
+        self.assertEqual(set(parallel_calls), set(serial_calls))
+        self.assertIn("10.0.0.9", parallel_calls)
+        self.assertGreater(concurrency, 1)
+
+    def test_failed_scan_does_not_stop_crawl(self):
+        calls = []
+
+        def fake_scan(ip, community="public", skip_unchanged=False):
+            calls.append(ip)
+            if ip == "10.0.0.2":
+                raise RuntimeError("boom")
+            return {"10.0.0.1": ["10.0.0.2", "10.0.0.3"]}.get(ip, [])
+
+        with patch.object(discovery_module, "scan_and_expand", side_effect=fake_scan), \
+             patch.object(discovery_module, "discover_local_server", return_value=None), \
+             self.assertLogs("inventory.discovery", level="ERROR"):
+            visited = discovery_module.discover_network("10.0.0.1", workers=2)
+        self.assertEqual(set(visited), {"10.0.0.1", "10.0.0.3"})
+        self.assertEqual(calls.count("10.0.0.2"), discovery_module.SCAN_ATTEMPTS)
+
+    def test_failed_scan_is_retried(self):
+        attempts = []
+
+        def fake_scan(ip, community="public", skip_unchanged=False):
+            attempts.append(ip)
+            if ip == "10.0.0.2" and attempts.count(ip) == 1:
+                raise RuntimeError("database is locked")
+            return {"10.0.0.1": ["10.0.0.2"], "10.0.0.2": ["10.0.0.3"]}.get(ip, [])
+
+        with patch.object(discovery_module, "scan_and_expand", side_effect=fake_scan), \
+             patch.object(discovery_module, "discover_local_server", return_value=None), \
+             self.assertLogs("inventory.discovery", level="ERROR"):
+            visited = discovery_module.discover_network("10.0.0.1", workers=1)
+        self.assertEqual(set(visited), {"10.0.0.1", "10.0.0.2", "10.0.0.3"})
+
+    def test_sqlite_defaults_to_one_worker(self):
+        with override_settings(DISCOVERY_WORKERS=0):
+            self.assertEqual(discovery_module._discovery_workers(), 1)
+            self.assertEqual(discovery_module._discovery_workers(4), 4)
+        with override_settings(DISCOVERY_WORKERS=8):
+            self.assertEqual(discovery_module._discovery_workers(), 8)
+
+
+@override_settings(DISCOVERY_WORKERS=1)
+class ChangeDetectionTest(TestCase):
+    MARKERS = {
+        snmp_module.SYS_UPTIME_OID: 5000,
+        snmp_module.IF_TABLE_LAST_CHANGE_OID: 1200,
+        snmp_module.LLDP_REM_TABLES_LAST_CHANGE_OID: 300,
+    }
+
+    def setUp(self):
+        self.device = Device.objects.create(
+            hostname="sw1",
+            management_ip="10.0.0.1",
+            last_scanned=timezone.now(),
+            sys_uptime=4000,
+            if_table_last_change=1200,
+            lldp_last_change=300,
+        )
+
+    def _unchanged(self, **markers):
+        values = dict(self.MARKERS, **markers)
+        with patch.object(snmp_module, "snmp_get_many", return_value=values) as get_many:
+            device = snmp_module.unchanged_device("10.0.0.1")
+        return device, get_many
+
+    def test_unchanged_device_skips_and_records_uptime(self):
+        device, get_many = self._unchanged()
+        self.assertEqual(device, self.device)
+        self.assertEqual(get_many.call_count, 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.sys_uptime, 5000)
+
+    def test_moved_markers_and_reboot_need_full_scan(self):
+        self.assertIsNone(self._unchanged(**{snmp_module.IF_TABLE_LAST_CHANGE_OID: 1300})[0])
+        self.assertIsNone(self._unchanged(**{snmp_module.LLDP_REM_TABLES_LAST_CHANGE_OID: 301})[0])
+        self.assertIsNone(self._unchanged(**{snmp_module.SYS_UPTIME_OID: 100})[0])
+        self.assertIsNone(self._unchanged(**{snmp_module.SYS_UPTIME_OID: None})[0])
+
+    def test_full_scan_forced_after_interval(self):
+        Device.objects.filter(pk=self.device.pk).update(
+            last_scanned=timezone.now() - timedelta(seconds=120)
         )
+        with override_settings(SCAN_FULL_INTERVAL=60):
+            device, get_many = self._unchanged()
+        self.assertIsNone(device)
+        get_many.assert_not_called()
+
+    def test_scan_device_stores_markers(self):
+        values = dict(self.MARKERS, **{
+            snmp_module.SYS_NAME_OID: "sw1",
+            snmp_module.SYS_DESCR_OID: "Cisco IOS",
+            snmp_module.SYS_UPTIME_OID: timedelta(seconds=90),
+        })
+        with patch.object(snmp_module, "snmp_get_many", return_value=values), \
+             patch.object(snmp_module, "snmp_table", return_value=iter([])):
+            snmp_module.scan_device("10.0.0.1")
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.sys_uptime, 9000)
+        self.assertEqual(self.device.if_table_last_change, 1200)
+        self.assertEqual(self.device.lldp_last_change, 300)
+
+    def test_markers_are_saved_only_after_a_full_scan(self):
+        values = dict(self.MARKERS, **{
+            snmp_module.SYS_NAME_OID: "sw1",
+            snmp_module.SYS_DESCR_OID: "Cisco IOS",
+            snmp_module.IF_TABLE_LAST_CHANGE_OID: 1300,
+        })
+        with override_settings(DISCOVERY_MODULES=["arp"]), \
+             patch.object(snmp_module, "snmp_get_many", return_value=values), \
+             patch.object(snmp_module, "snmp_table", return_value=iter([])), \
+             patch.object(discovery_module, "gather_cam_arp", side_effect=snmp_module.SnmpWalkIncomplete("10.0.0.1")):
+            with self.assertRaises(snmp_module.SnmpWalkIncomplete):
+                discovery_module.scan_and_expand("10.0.0.1")
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.if_table_last_change, 1200)
+
+        with override_settings(DISCOVERY_MODULES=["arp"]), \
+             patch.object(snmp_module, "snmp_get_many", return_value=values), \
+             patch.object(snmp_module, "snmp_table", return_value=iter([])), \
+             patch.object(discovery_module, "gather_cam_arp", return_value=None):
+            discovery_module.scan_and_expand("10.0.0.1")
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.sys_uptime, self.device.if_table_last_change), (5000, 1300))
+
+    def test_unchanged_device_expands_stored_neighbors(self):
+        local = Interface.objects.create(device=self.device, name="eth0")
+        peer = Device.objects.create(hostname="sw2", management_ip="10.0.0.7")
+        Connection.objects.create(interface_a=local, interface_b=Interface.objects.create(device=peer, name="eth1"))
+        Host.objects.create(mac_address="aa", ip_address="10.0.0.2", interface=local)
+        Neighbor.objects.create(device=self.device, protocol="ospf", address="10.0.0.3")
+        Neighbor.objects.create(device=self.device, protocol="bgp", address="10.0.0.4")
+
+        with override_settings(DISCOVERY_MODULES=["arp", "cdp", "ospf"]), \
+             patch.object(snmp_module, "snmp_get_many", return_value=self.MARKERS), \
+             patch.object(discovery_module, "scan_device") as scan:
+            found = discovery_module.scan_and_expand("10.0.0.1", skip_unchanged=True)
+        scan.assert_not_called()
+        self.assertEqual(sorted(found), ["10.0.0.2", "10.0.0.3", "10.0.0.7"])
+
+    def test_full_scan_replaces_stored_routing_peers(self):
+        Neighbor.objects.create(device=self.device, protocol="ospf", address="10.0.0.9")
+        with override_settings(DISCOVERY_MODULES=["ospf"]), \
+             patch.object(discovery_module, "scan_device", return_value=self.device), \
+             patch.object(discovery_module, "discover_ospf_neighbors", return_value=["10.0.0.3", "10.0.0.3"]):
+            self.assertEqual(discovery_module.scan_and_expand("10.0.0.1"), ["10.0.0.3"])
+        self.assertEqual(list(self.device.neighbors.values_list("address", flat=True)), ["10.0.0.3"])
+
+    def test_periodic_scan_skips_unchanged_devices(self):
+        iface = Interface.objects.create(device=self.device, name="eth0")
+        Host.objects.create(mac_address="aa", ip_address="10.0.0.2", interface=iface)
+        scanned = []
+
+        def fake_unchanged(ip, community="public"):
+            return self.device if ip == "10.0.0.1" else None
+
+        def fake_scan(ip, community="public", save_markers=True):
+            scanned.append(ip)
+            return Device.objects.create(hostname=f"dev-{ip}", management_ip=ip)
+
+        with patch.object(discovery_module, "unchanged_device", side_effect=fake_unchanged), \
+             patch.object(discovery_module, "scan_device", side_effect=fake_scan), \
+             patch.object(discovery_module, "discover_neighbors", return_value=None) as neighbors, \
+             patch.object(discovery_module, "gather_cam_arp", return_value=None), \
+             patch.object(discovery_module, "discover_local_server", return_value=None):
+            visited = discovery_module.periodic_scan()
+            self.assertEqual(set(visited), {"10.0.0.1", "10.0.0.2"})
+            self.assertEqual(scanned, ["10.0.0.2"])
+            neighbors.assert_called_once_with("10.0.0.2", "public")
 
-        real_check_output = subprocess.check_output
+            scanned.clear()
+            discovery_module.periodic_scan(full=True)
+            self.assertIn("10.0.0.1", scanned)
 
-        def fake_check_output(cmd, *args, **kwargs):
-            if isinstance(cmd, list) and cmd and cmd[0] == "ip":
-                if len(cmd) > 1 and cmd[1] == "neigh":
-                    raise FileNotFoundError
-                if cmd[:3] == ["ip", "-o", "link"]:
-                    return "2: eth0: <BROADCAST> mtu 1500 qdisc noop state DOWN mode DEFAULT group default qlen 1000 link/ether 02:42:ac:11:00:02 brd ff:ff:ff:ff:ff:ff"
-                if cmd[:5] == ["ip", "-f", "inet", "addr", "show"]:
-                    return "    inet 10.0.0.2/24 brd 10.0.0.255 scope global eth0"
-                return ""
-            return real_check_output(cmd, *args, **kwargs)
 
-        with patch("subprocess.check_output", side_effect=fake_check_output), \
+import socket
+
+
+class ServerDiscoveryTest(TestCase):
+    def _discover(self, arp_data, neighbours=()):
+        links = {1: ("lo", "00:00:00:00:00:00"), 2: ("eth0", "02:42:ac:11:00:02")}
+        with patch.object(server, "_default_route", return_value=("eth0", "10.0.0.1")), \
+             patch.object(server, "_links", return_value=links), \
+             patch.object(server, "_ipv4_addresses", return_value={1: "127.0.0.1", 2: "10.0.0.2"}), \
+             patch.object(server, "_netlink_neighbours", return_value=iter(neighbours)), \
              patch("inventory.server.open", mock_open(read_data=arp_data), create=True), \
-             patch("inventory.server.gather_cam_arp"), \
-             patch("socket.gethostname", return_value="srv"), \
-             patch("socket.gethostbyname", return_value="10.0.0.2"):
+             patch("inventory.server.gather_cam_arp") as gather, \
+             patch("subprocess.check_output") as check_output, \
+             patch("socket.gethostname", return_value="srv"):
             device = server.discover_local_server()
+        check_output.assert_not_called()
+        self.assertEqual([call.args[0] for call in gather.call_args_list], ["10.0.0.2", "10.0.0.1"])
+        return device
+
+    def test_proc_net_arp_fallback(self):
+        arp_data = (
+            "IP address       HW type     Flags       HW address            Mask     Device\n"
+            "10.0.0.5       0x1         0x2         aa:bb:cc:dd:ee:ff     *        eth0\n"
+        )
+        device = self._discover(arp_data)
 
         host = Host.objects.get(mac_address="aa:bb:cc:dd:ee:ff")
         self.assertEqual(host.ip_address, "10.0.0.5")
         self.assertEqual(host.interface.device, device)
+        self.assertEqual(device.management_ip, "10.0.0.2")
+        eth0 = device.interfaces.get(name="eth0")
+        self.assertEqual((eth0.mac_address, eth0.ip_address), ("02:42:ac:11:00:02", "10.0.0.2"))
 
     def test_proc_net_arp_additional_entries(self):
-        ip_neigh = "10.0.0.6 dev eth0 lladdr aa:aa:aa:aa:aa:aa REACHABLE\n"
         arp_data = (
             "IP address       HW type     Flags       HW address            Mask     Device\n"
             "10.0.0.5       0x1         0x2         bb:bb:bb:bb:bb:bb     *        eth0\n"
         )
-
-        real_check_output = subprocess.check_output
-
-        def fake_check_output(cmd, *args, **kwargs):
-            if isinstance(cmd, list) and cmd and cmd[0] == "ip":
-                if len(cmd) > 1 and cmd[1] == "neigh":
-                    return ip_neigh
-                if cmd[:3] == ["ip", "-o", "link"]:
-                    return (
-                        "2: eth0: <BROADCAST> mtu 1500 qdisc noop state DOWN mode DEFAULT group default qlen 1000 "
-                        "link/ether 02:42:ac:11:00:02 brd ff:ff:ff:ff:ff:ff"
-                    )
-                if cmd[:5] == ["ip", "-f", "inet", "addr", "show"]:
-                    return "    inet 10.0.0.2/24 brd 10.0.0.255 scope global eth0"
-                return ""
-            return real_check_output(cmd, *args, **kwargs)
-
-        with patch("subprocess.check_output", side_effect=fake_check_output), \
-             patch("inventory.server.open", mock_open(read_data=arp_data), create=True), \
-             patch("inventory.server.gather_cam_arp"), \
-             patch("socket.gethostname", return_value="srv"), \
-             patch("socket.gethostbyname", return_value="10.0.0.2"):
-            device = server.discover_local_server()
+        device = self._discover(arp_data, [("10.0.0.6", 2, "aa:aa:aa:aa:aa:aa")])
 
         hosts = list(
             Host.objects.filter(interface__device=device)
@@ -291,6 +574,29 @@ class ServerDiscoveryTest(TestCase):
         )
         self.assertEqual(hosts, ["aa:aa:aa:aa:aa:aa", "bb:bb:bb:bb:bb:bb"])
 
+    def test_netlink_neighbours_keep_static_entries(self):
+        ip = socket.inet_aton
+        mac = bytes.fromhex("aabbccddeeff")
+        dump = [
+            ((socket.AF_INET, 2, 0x02, 0, 0), {server.NDA_DST: ip("10.0.0.5"), server.NDA_LLADDR: mac}),
+            ((socket.AF_INET, 2, 0x80, 0, 0), {server.NDA_DST: ip("10.0.0.6"), server.NDA_LLADDR: mac}),
+            ((socket.AF_INET, 2, 0x01, 0, 0), {server.NDA_DST: ip("10.0.0.7")}),
+            ((socket.AF_INET, 2, 0x20, 0, 0), {server.NDA_DST: ip("10.0.0.8"), server.NDA_LLADDR: mac}),
+            ((socket.AF_INET, 2, 0x40, 0, 0), {server.NDA_DST: ip("224.0.0.1"), server.NDA_LLADDR: mac}),
+        ]
+        with patch.object(server, "_netlink_dump", return_value=iter(dump)):
+            found = [entry[0] for entry in server._netlink_neighbours()]
+        self.assertEqual(found, ["10.0.0.5", "10.0.0.6"])
+
+    def test_default_route_from_proc(self):
+        route = (
+            "Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n"
+            "eth0\t0000000A\t00000000\t0001\t0\t0\t0\t00FFFFFF\t0\t0\t0\n"
+            "eth0\t00000000\t0100000A\t0003\t0\t0\t0\t00000000\t0\t0\t0\n"
+        )
+        with patch("inventory.server.open", mock_open(read_data=route), create=True):
+            self.assertEqual(server._default_route(), ("eth0", "10.0.0.1"))
+
 
 class TopologyDataTest(TestCase):
     def setUp(self):
@@ -370,8 +676,11 @@ class AlertListViewTest(TestCase):
         self.assertContains(resp, 'r1')
 
 
+from . import metrics as metrics_module
+
+
 class MetricPollingTaskTest(TestCase):
-    @patch('inventory.tasks.poll_metrics')
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
     def test_metric_poll_task_creates_metric_records(self, mock_poll):
         device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
         Interface.objects.create(device=device, name='eth0')
@@ -391,8 +700,80 @@ class MetricPollingTaskTest(TestCase):
         )
 
 
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
+    def test_metric_poll_task_inserts_in_bulk(self, mock_poll):
+        for i in range(5):
+            device = Device.objects.create(hostname=f'r{i}', management_ip=f'192.0.2.{i + 1}')
+            for port in range(4):
+                Interface.objects.create(device=device, name=f'eth{port}')
+        mock_poll.return_value = {
+            'cpu': 50,
+            'memory': 70,
+            'interfaces': {f'eth{port}': {'in_octets': 1, 'out_octets': 2} for port in range(4)},
+        }
+
+        with CaptureQueriesContext(connection) as ctx:
+            tasks.metric_poll_task()
+
+        inserts = [q for q in ctx.captured_queries
+                   if q['sql'].startswith('INSERT INTO "inventory_metricrecord"')]
+        self.assertEqual(len(inserts), 1)
+        iface_lookups = [q for q in ctx.captured_queries
+                         if 'FROM "inventory_interface"' in q['sql']]
+        self.assertEqual(len(iface_lookups), 5)
+        self.assertEqual(MetricRecord.objects.count(), 5 * (2 + 4 * 2))
+
+
+class MetricWriterTest(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+
+    def test_flushes_by_batch_size(self):
+        writer = metrics_module.MetricWriter(batch_size=3, flush_interval=3600)
+        writer.add(self.device, 'cpu', 1)
+        writer.add(self.device, 'cpu', 2)
+        self.assertEqual(MetricRecord.objects.count(), 0)
+        writer.add(self.device, 'cpu', 3)
+        self.assertEqual(MetricRecord.objects.count(), 3)
+
+    def test_flushes_by_age_and_on_exit(self):
+        with patch('inventory.metrics.time.monotonic', side_effect=[0.0, 1.0, 10.0, 10.0, 11.0]):
+            with metrics_module.MetricWriter(batch_size=100, flush_interval=5) as writer:
+                writer.add(self.device, 'cpu', 1)
+                self.assertEqual(MetricRecord.objects.count(), 0)
+                writer.add(self.device, 'cpu', 2)
+                self.assertEqual(MetricRecord.objects.count(), 2)
+                writer.add(self.device, 'cpu', 3)
+        self.assertEqual(MetricRecord.objects.count(), 3)
+
+    def test_keeps_sample_timestamp(self):
+        sampled = timezone.now() - timedelta(minutes=5)
+        with metrics_module.MetricWriter() as writer:
+            writer.add(self.device, 'cpu', 1, sampled)
+        self.assertEqual(MetricRecord.objects.get().timestamp, sampled)
+
+    def test_unknown_interfaces_are_skipped(self):
+        Interface.objects.create(device=self.device, name='eth0')
+        with metrics_module.MetricWriter() as writer:
+            writer.add_device_metrics(self.device, {
+                'cpu': None,
+                'interfaces': {'eth0': {'in_octets': 5, 'out_octets': None},
+                               'eth9': {'in_octets': 7}},
+            })
+        record = MetricRecord.objects.get()
+        self.assertEqual((record.interface.name, record.metric, record.value), ('eth0', 'in_octets', 5))
+
+    def test_failed_rollup_update_rolls_back_samples(self):
+        writer = metrics_module.MetricWriter()
+        writer.add(self.device, 'cpu', 1)
+        with patch.object(metrics_module, 'update_rollups', side_effect=RuntimeError('boom')), \
+             self.assertRaises(RuntimeError):
+            writer.flush()
+        self.assertFalse(MetricRecord.objects.exists())
+
+
 class AlertEvaluationTest(TestCase):
-    @patch('inventory.tasks.poll_metrics')
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
     def test_cpu_alert_created_and_cleared(self, mock_poll):
         device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
         profile = AlertProfile.objects.create(name='default', cpu_threshold=80)
@@ -423,3 +804,1467 @@ class DeviceDetailHostsViewTest(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertContains(resp, 'aa:bb:cc:dd:ee:ff')
         self.assertContains(resp, '10.0.0.2')
+
+
+class SnmpSessionPoolTest(TestCase):
+    def test_session_is_reused_per_target(self):
+        pool = snmp_module.SnmpSessionPool(idle_timeout=60, max_sessions=10)
+        factory = MagicMock(side_effect=lambda: object())
+
+        first = pool.session(("192.0.2.1", 161, "public", 1, 0), factory)
+        second = pool.session(("192.0.2.1", 161, "public", 1, 0), factory)
+        pool.session(("192.0.2.2", 161, "public", 1, 0), factory)
+
+        self.assertIs(first, second)
+        self.assertEqual(factory.call_count, 2)
+        self.assertEqual(len(pool), 2)
+
+    def test_idle_and_excess_sessions_are_evicted(self):
+        pool = snmp_module.SnmpSessionPool(idle_timeout=30, max_sessions=2)
+        with patch.object(snmp_module.time, "monotonic", return_value=100.0):
+            pool.session("a", object)
+            pool.session("b", object)
+            pool.session("c", object)
+        self.assertEqual(len(pool), 2)
+
+        with patch.object(snmp_module.time, "monotonic", return_value=200.0):
+            pool.evict_idle()
+        self.assertEqual(len(pool), 0)
+
+    def test_snmp_get_uses_pooled_session(self):
+        snmp_module.session_pool.clear()
+        with patch.object(snmp_module, "_new_session", return_value=(MagicMock(), MagicMock())) as new_session, \
+             patch.object(snmp_module, "getCmd", side_effect=lambda *a: iter([(None, 0, 0, [("oid", "sw1")])])), \
+             patch.object(snmp_module, "SnmpEngine", MagicMock()), \
+             patch.object(snmp_module, "ContextData", MagicMock(), create=True), \
+             patch.object(snmp_module, "ObjectType", MagicMock(), create=True), \
+             patch.object(snmp_module, "ObjectIdentity", MagicMock(), create=True):
+            for _ in range(3):
+                snmp_module.snmp_get(snmp_module.SYS_NAME_OID, "192.0.2.1")
+        self.assertEqual(new_session.call_count, 1)
+        snmp_module.session_pool.clear()
+
+
+class SnmpVersionTest(TestCase):
+    def tearDown(self):
+        snmp_module._version_hints.clear()
+
+    def test_walk_falls_back_to_v1(self):
+        calls = []
+
+        def fake_walk(oids, target, community, port, timeout, retries, version, max_repetitions):
+            calls.append((version, max_repetitions))
+            if version == snmp_module.SNMP_V2C:
+                raise snmp_module.SnmpNoResponse(target)
+            yield f"{oids[0]}.1", "Gig0/1"
+
+        with override_settings(SNMP_MAX_REPETITIONS=50), \
+             patch.object(snmp_module, "_walk", side_effect=fake_walk):
+            rows = list(snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1"))
+            list(snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1"))
+
+        self.assertEqual(rows, [(f"{snmp_module.IF_NAME_OID}.1", "Gig0/1")])
+        self.assertEqual(calls, [("2c", 50), ("1", 50), ("1", 50)])
+
+    def test_negotiated_version_is_stored_and_reused(self):
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1")
+        versions = []
+
+        def fake_get(chunk, target, community, port, timeout, retries, version):
+            versions.append(version)
+            if version == snmp_module.SNMP_V2C:
+                raise snmp_module.SnmpNoResponse(target)
+            return {oid: "ok" for oid in chunk}
+
+        with patch.object(snmp_module, "_get", side_effect=fake_get):
+            first = snmp_module.snmp_get(snmp_module.SYS_NAME_OID, "192.0.2.1")
+            snmp_module.snmp_get(snmp_module.SYS_NAME_OID, "192.0.2.1")
+
+        self.assertEqual(first, "ok")
+        self.assertEqual(versions, ["2c", "1", "1"])
+        device.refresh_from_db()
+        self.assertEqual(device.snmp_version, "1")
+
+    def test_zero_max_repetitions_uses_default(self):
+        from .forms import DeviceCredentialsForm
+
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1", snmp_max_repetitions=0)
+        calls = []
+
+        def fake_walk(oids, target, community, port, timeout, retries, version, max_repetitions):
+            calls.append(max_repetitions)
+            yield f"{oids[0]}.1", "Gig0/1"
+
+        with override_settings(SNMP_MAX_REPETITIONS=40), \
+             patch.object(snmp_module, "_walk", side_effect=fake_walk):
+            list(snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1",
+                                       **snmp_module.device_snmp_options(device)))
+            list(snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1", max_repetitions=0))
+        self.assertEqual(calls, [40, 40])
+
+        form = DeviceCredentialsForm({"snmp_max_repetitions": 0}, instance=device)
+        self.assertIn("snmp_max_repetitions", form.errors)
+
+    def test_known_version_is_not_retried(self):
+        calls = []
+
+        def fake_walk(oids, target, community, port, timeout, retries, version, max_repetitions):
+            calls.append(version)
+            raise snmp_module.SnmpNoResponse(target)
+            yield
+
+        snmp_module._version_hints["192.0.2.1"] = "2c"
+        with patch.object(snmp_module, "_walk", side_effect=fake_walk):
+            self.assertEqual(list(snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1")), [])
+            list(snmp_module.discover_bgp_neighbors("192.0.2.1", version="1", max_repetitions=5))
+        self.assertEqual(calls, ["2c", "1"])
+
+    def test_scan_device_remembers_working_version(self):
+        system = {snmp_module.SYS_NAME_OID: "sw1", snmp_module.SYS_DESCR_OID: "VendorOS"}
+        with patch.object(snmp_module, "snmp_get_many", side_effect=[{}, system]), \
+             patch.object(snmp_module, "snmp_table", return_value=iter([])):
+            device = snmp_module.scan_device("192.0.2.1")
+        self.assertEqual(device.snmp_version, "1")
+
+        snmp_module._version_hints.clear()
+        with patch.object(snmp_module, "snmp_get_many", return_value=system) as mock_get, \
+             patch.object(snmp_module, "snmp_table", return_value=iter([])):
+            snmp_module.scan_device("192.0.2.1")
+        self.assertEqual(mock_get.call_args_list[0].kwargs["version"], "1")
+
+
+class SnmpTableTest(TestCase):
+    def test_rows_are_assembled_from_one_multi_column_walk(self):
+        name, status = snmp_module.IF_NAME_OID, snmp_module.IF_STATUS_OID
+        varbinds = [
+            (f"{name}.1", "Gig0/1"), (f"{status}.1", 1),
+            (f"{name}.2", "Gig0/2"), (f"{status}.3", 2),
+            (f"{name}.3", "Gig0/3"),
+        ]
+        with patch.object(snmp_module, "_walk", return_value=iter(varbinds)) as mock_walk:
+            rows = list(snmp_module.snmp_table("192.0.2.1", [name, status], version="2c"))
+
+        self.assertEqual(mock_walk.call_count, 1)
+        self.assertEqual(mock_walk.call_args.args[0], [name, status])
+        self.assertEqual(rows, [
+            ("1", {name: "Gig0/1", status: 1}),
+            ("2", {name: "Gig0/2"}),
+            ("3", {status: 2, name: "Gig0/3"}),
+        ])
+
+    def test_poll_metrics_reads_interfaces_from_table(self):
+        def fake_walk(oid, ip, community, *args, **kwargs):
+            if oid == snmp_module.IF_NAME_OID:
+                return iter([(f"{oid}.1", "eth0")])
+            if oid == snmp_module.IF_IN_OCTETS_OID:
+                return iter([(f"{oid}.1", 100)])
+            if oid == snmp_module.IF_OUT_OCTETS_OID:
+                return iter([(f"{oid}.1", 200)])
+            return iter([])
+
+        with patch.object(snmp_module, "snmp_walk", side_effect=fake_walk), \
+             patch.object(snmp_module, "snmp_get_many", return_value={}), \
+             patch.object(snmp_module, "snmp_table", side_effect=_fake_table(fake_walk)) as mock_table:
+            metrics = snmp_module.poll_metrics("192.0.2.1")
+
+        self.assertEqual(mock_table.call_count, 1)
+        self.assertEqual(metrics["interfaces"], {"eth0": {"in_octets": 100, "out_octets": 200}})
+
+
+import asyncio
+from . import poller as poller_module
+
+
+class AsyncPollerTest(TestCase):
+    def test_devices_are_polled_concurrently_within_caps(self):
+        devices = [
+            Device.objects.create(hostname=f"r{i}", management_ip=f"192.0.2.{i}") for i in range(1, 9)
+        ]
+        Device.objects.create(hostname="no-ip")
+        state = {"active": 0, "peak": 0}
+
+        async def fake_poll(ip, community, limiter=None, **options):
+            async with limiter.slot(ip):
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+                await asyncio.sleep(0.01)
+                state["active"] -= 1
+            return {"cpu": 10}
+
+        cycle = poller_module.poll_devices(
+            Device.objects.all(), concurrency=3, device_concurrency=1, poll=fake_poll
+        )
+
+        self.assertEqual([d for d, _ in cycle["results"]], devices)
+        self.assertEqual(state["peak"], 3)
+        self.assertGreater(cycle["wall_time"], 0)
+
+    def test_async_poll_falls_back_to_v1(self):
+        versions = []
+
+        async def fake_poll_once(ip, community, version, max_repetitions, limiter):
+            versions.append(version)
+            if version == snmp_module.SNMP_V2C:
+                raise snmp_module.SnmpNoResponse(ip)
+            return {"interfaces": {}}
+
+        with patch.object(poller_module, "_poll_once", side_effect=fake_poll_once):
+            metrics = asyncio.run(poller_module.async_poll_metrics("192.0.2.9"))
+        snmp_module._version_hints.clear()
+
+        self.assertEqual(metrics, {"interfaces": {}})
+        self.assertEqual(versions, ["2c", "1"])
+
+    def test_poll_cycle_stores_negotiated_version(self):
+        device = Device.objects.create(hostname="r1", management_ip="192.0.2.9")
+
+        async def fake_poll_once(ip, community, version, max_repetitions, limiter):
+            if version == snmp_module.SNMP_V2C:
+                raise snmp_module.SnmpNoResponse(ip)
+            return {"interfaces": {}}
+
+        with patch.object(poller_module, "_poll_once", side_effect=fake_poll_once):
+            poller_module.poll_devices(Device.objects.all(), poll=poller_module.async_poll_metrics)
+        snmp_module._version_hints.clear()
+
+        device.refresh_from_db()
+        self.assertEqual(device.snmp_version, "1")
+
+
+class PuresnmpFallbackTest(TestCase):
+    def setUp(self):
+        snmp_module.session_pool.clear()
+
+    def test_walk_streams_varbinds_on_persistent_loop(self):
+        produced = []
+
+        class FakeWrapper:
+            def bulkwalk(self, oids, bulk_size):
+                async def _gen():
+                    for i in range(1, 4):
+                        produced.append(i)
+                        yield MagicMock(oid=f"{oids[0]}.{i}", value=i)
+                return _gen()
+
+        with patch.object(snmp_module, "SnmpEngine", None), \
+             patch.object(snmp_module, "Client", object), \
+             patch.object(snmp_module, "_session", return_value=FakeWrapper()), \
+             patch.object(snmp_module.asyncio, "run", side_effect=AssertionError):
+            walk = snmp_module.snmp_walk(snmp_module.IF_NAME_OID, "192.0.2.1", version="2c")
+            first = next(walk)
+            self.assertEqual(produced, [1])
+            rest = list(walk)
+
+        self.assertEqual(first, (f"{snmp_module.IF_NAME_OID}.1", 1))
+        self.assertEqual(len(rest), 2)
+        self.assertIs(snmp_module.session_pool.loop(), snmp_module.session_pool.loop())
+
+
+class SnmpGetManyTest(TestCase):
+    oids = [f"1.3.6.1.2.1.1.{i}.0" for i in range(1, 7)]
+
+    def test_oids_share_pdus_and_too_big_pdus_are_split(self):
+        pdus = []
+
+        def fake_get(chunk, target, *args):
+            pdus.append(list(chunk))
+            if len(chunk) > 2:
+                raise snmp_module.SnmpTooBig(target)
+            return {oid: oid[-3] for oid in chunk}
+
+        with patch.object(snmp_module, "_get", side_effect=fake_get):
+            values = snmp_module.snmp_get_many("192.0.2.1", self.oids, version="2c", max_oids=4)
+
+        self.assertEqual(values, {oid: oid[-3] for oid in self.oids})
+        self.assertEqual(pdus[0], self.oids[:4])
+        self.assertEqual(sum(len(p) for p in pdus if len(p) <= 2), 6)
+
+    def test_v1_no_such_name_drops_only_the_missing_oid(self):
+        def fake_get(chunk, target, *args):
+            if self.oids[1] in chunk:
+                raise snmp_module.SnmpNoSuchName(chunk.index(self.oids[1]))
+            return {oid: "ok" for oid in chunk}
+
+        with patch.object(snmp_module, "_get", side_effect=fake_get) as mock_get:
+            values = snmp_module.snmp_get_many("192.0.2.1", self.oids[:3], version="1")
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(values, {self.oids[0]: "ok", self.oids[1]: None, self.oids[2]: "ok"})
+
+
+from . import cache as cache_module
+
+
+class FakeRedis:
+    """Minimal in-memory stand-in for a redis.Redis client."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match=None):
+        prefix = (match or "").rstrip("*")
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def sadd(self, key, *values):
+        members = self.data.setdefault(key, set())
+        added = len(set(values) - members)
+        members.update(values)
+        return added
+
+    def smembers(self, key):
+        return {value.encode() for value in self.data.get(key, set())}
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+        return len(self.data[key])
+
+    def lpop(self, key, count=None):
+        items = self.data.get(key)
+        if not items:
+            return None
+        if count is None:
+            return items.pop(0).encode()
+        popped, self.data[key] = items[:count], items[count:]
+        return [item.encode() for item in popped]
+
+    def llen(self, key):
+        return len(self.data.get(key, []))
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def lmove(self, source, destination, src="LEFT", dest="RIGHT"):
+        items = self.data.get(source)
+        if not items:
+            return None
+        item = items.pop(0 if src == "LEFT" else -1)
+        target = self.data.setdefault(destination, [])
+        target.insert(0 if dest == "LEFT" else len(target), item)
+        return item.encode() if isinstance(item, str) else item
+
+    def blmove(self, source, destination, timeout, src="LEFT", dest="RIGHT"):
+        return self.lmove(source, destination, src, dest)
+
+    def ltrim(self, key, start, end):
+        items = self.data.get(key, [])
+        self.data[key] = items[start:len(items) + end + 1 if end < 0 else end + 1]
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Queues FakeRedis calls until :meth:`execute`."""
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        return lambda *args, **kwargs: self._calls.append((method, args, kwargs))
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class WalkCacheTest(TestCase):
+    def setUp(self):
+        cache_module.local_cache.clear()
+
+    def tearDown(self):
+        cache_module.local_cache.clear()
+        snmp_module._version_hints.clear()
+
+    def test_discovery_pass_walks_if_name_once(self):
+        requested = []
+
+        def fake_walk(oids, target, *args):
+            requested.extend(oids)
+            for oid in oids:
+                if oid == snmp_module.IF_NAME_OID:
+                    yield f"{oid}.1", "Gig0/1"
+                elif oid in (snmp_module.IF_MAC_OID, snmp_module.IF_STATUS_OID):
+                    yield f"{oid}.1", 1
+
+        system = {snmp_module.SYS_NAME_OID: "sw1", snmp_module.SYS_DESCR_OID: "VendorOS"}
+        with patch.object(snmp_module, "snmp_get_many", return_value=system), \
+             patch.object(snmp_module, "_walk_with_fallback", side_effect=fake_walk):
+            snmp_module.scan_device("192.0.2.1")
+        with patch.object(snmp_module, "_walk_with_fallback", side_effect=fake_walk):
+            snmp_module.discover_neighbors("192.0.2.1")
+            snmp_module.gather_cam_arp("192.0.2.1")
+            snmp_module.poll_metrics("192.0.2.1")
+
+        self.assertEqual(requested.count(snmp_module.IF_NAME_OID), 1)
+
+    def test_ttl_zero_disables_cache(self):
+        name = snmp_module.IF_NAME_OID
+        walk = MagicMock(side_effect=lambda oids: iter([(f"{oids[0]}.1", "x")]))
+        with override_settings(SNMP_WALK_CACHE_TTL=0):
+            list(snmp_module._cached_walk([name], "192.0.2.1", walk))
+            list(snmp_module._cached_walk([name], "192.0.2.1", walk))
+        self.assertEqual(walk.call_count, 2)
+
+    def test_counters_are_always_walked_live(self):
+        requested = []
+
+        def fake_walk(oids, target, *args):
+            requested.append(list(oids))
+            for oid in oids:
+                yield f"{oid}.1", "eth0" if oid == snmp_module.IF_NAME_OID else len(requested)
+
+        with patch.object(snmp_module, "_walk_with_fallback", side_effect=fake_walk), \
+             patch.object(snmp_module, "snmp_get_many", return_value={}):
+            first = snmp_module.poll_metrics("192.0.2.1", version="2c")
+            second = snmp_module.poll_metrics("192.0.2.1", version="2c")
+
+        counters = [snmp_module.IF_IN_OCTETS_OID, snmp_module.IF_OUT_OCTETS_OID]
+        self.assertEqual([oids for oids in requested if oids != [snmp_module.CPU_LOAD_OID]],
+                         [snmp_module.METRIC_IF_COLUMNS, counters])
+        self.assertNotEqual(first["interfaces"], second["interfaces"])
+        self.assertEqual(second["interfaces"]["eth0"]["in_octets"], 4)
+
+    def test_key_includes_credentials_and_empty_walks_are_not_kept(self):
+        name = snmp_module.IF_NAME_OID
+        results = {"public": [], "secret": [(f"{name}.1", "Gig0/1")]}
+        calls = []
+
+        def fake_walk(oids, target, community, *args):
+            calls.append((community, args[-2]))
+            return iter(results[community])
+
+        with patch.object(snmp_module, "_walk_with_fallback", side_effect=fake_walk):
+            for community, version in [("public", "2c"), ("public", "2c"), ("secret", "2c"),
+                                       ("secret", "2c"), ("secret", "1")]:
+                list(snmp_module.snmp_walk(name, "192.0.2.1", community, version=version, cache=True))
+
+        self.assertEqual(calls, [("public", "2c"), ("public", "2c"), ("secret", "2c"), ("secret", "1")])
+
+    def test_redis_backend_shares_entries(self):
+        fake = FakeRedis()
+        with patch("redis.Redis.from_url", return_value=fake), \
+             override_settings(SNMP_WALK_CACHE_URL="redis://cache/1"):
+            cache_module._redis_caches.clear()
+            backend = cache_module.walk_cache()
+            backend.set("walk:192.0.2.1:1.2.3", [("1.2.3.1", 5)], 60)
+            self.assertEqual(backend.get("walk:192.0.2.1:1.2.3"), [("1.2.3.1", 5)])
+        cache_module._redis_caches.clear()
+        self.assertIn(cache_module.KEY_PREFIX + "walk:192.0.2.1:1.2.3", fake.data)
+
+
+from optinoc.celery import app as celery_app
+
+
+@override_settings(DISCOVERY_WORKERS=1)
+class DistributedCrawlTest(TestCase):
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+
+    def test_fanout_matches_local_crawl(self):
+        graph = {
+            "10.0.0.1": ["10.0.0.2", "10.0.0.3", "8.8.8.8"],
+            "10.0.0.2": ["10.0.0.1", "10.0.0.4"],
+            "10.0.0.3": ["10.0.0.4", None],
+            "10.0.0.4": ["10.0.0.5"],
+        }
+        calls = []
+
+        def fake_scan(ip, community="public", skip_unchanged=False):
+            calls.append(ip)
+            return graph.get(ip)
+
+        fake = FakeRedis()
+        with patch.object(discovery_module, "scan_and_expand", side_effect=fake_scan), \
+             patch.object(tasks, "scan_and_expand", side_effect=fake_scan), \
+             patch.object(discovery_module, "discover_local_server", return_value=None), \
+             patch("redis.Redis.from_url", return_value=fake):
+            local = discovery_module.discover_network("10.0.0.1")
+            calls.clear()
+            distributed = discovery_module.discover_network("10.0.0.1", distributed=True)
+
+        self.assertEqual(set(distributed), set(local))
+        self.assertEqual(set(distributed), {"10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"})
+        self.assertEqual(sorted(calls), sorted(set(calls)))
+        self.assertIn("10.0.0.5", calls)
+        # the crawl state is removed from Redis once the crawl is done
+        self.assertEqual(fake.data, {})
+
+    def test_failed_task_is_logged_and_skipped(self):
+        def fake_scan(ip, community="public", skip_unchanged=False):
+            if ip == "10.0.0.2":
+                raise RuntimeError("boom")
+            return {"10.0.0.1": ["10.0.0.2", "10.0.0.3"]}.get(ip, [])
+
+        fake = FakeRedis()
+        with patch.object(tasks, "scan_and_expand", side_effect=fake_scan) as mock_scan, \
+             self.assertLogs("inventory.discovery", level="ERROR"):
+            visited = discovery_module._distributed_crawl(["10.0.0.1"], client=fake)
+        self.assertEqual(set(visited), {"10.0.0.1", "10.0.0.3"})
+        scanned = [call.args[0] for call in mock_scan.call_args_list]
+        self.assertEqual(scanned.count("10.0.0.2"), discovery_module.SCAN_ATTEMPTS)
+
+
+from . import icmp as icmp_module
+from . import sweep as sweep_module
+
+
+class SubnetSweepTest(TestCase):
+    def test_targets_skip_network_and_broadcast_and_dedupe(self):
+        networks = sweep_module.sweep_networks(["10.0.0.0/30", "10.0.0.1/32", "10.0.0.4/31"])
+        targets = list(sweep_module.sweep_targets(networks))
+        self.assertEqual(targets, ["10.0.0.1", "10.0.0.2", "10.0.0.4", "10.0.0.5"])
+
+    def test_rejects_ipv6_and_oversized_networks(self):
+        with self.assertRaises(ValueError):
+            sweep_module.sweep_networks(["2001:db8::/64"])
+        with self.assertRaises(ValueError):
+            sweep_module.sweep_networks(["10.0.0.0/8"])
+        with override_settings(SWEEP_MIN_PREFIX=8):
+            self.assertEqual(len(sweep_module.sweep_networks(["10.0.0.0/8"])), 1)
+        self.assertEqual(len(sweep_module.sweep_networks(["10.0.0.0/8"], min_prefix=0)), 1)
+        with patch.object(sweep_module, "_probe") as probe, self.assertRaises(ValueError):
+            tasks.sweep_subnets_task(["10.0.0.0/30", "10.0.0.0/8"])
+        probe.assert_not_called()
+
+    def test_large_sweep_is_probed_in_blocks(self):
+        blocks = []
+
+        async def fake_probe(hosts, *args):
+            blocks.append(len(hosts))
+            return {hosts[0]}
+
+        with patch.object(sweep_module, "_probe", side_effect=fake_probe), \
+             patch.object(sweep_module, "SWEEP_BLOCK_SIZE", 100):
+            result = sweep_module.sweep_subnets(["10.0.0.0/24"], scan=False)
+        self.assertEqual(blocks, [100, 100, 54])
+        self.assertEqual(result["addresses"], 254)
+        self.assertEqual(result["responders"], ["10.0.0.1", "10.0.0.101", "10.0.0.201"])
+
+    def test_echo_packets(self):
+        packet = icmp_module.echo_request(0x1234, 7)
+        self.assertEqual(icmp_module._checksum(packet), 0)
+        reply = bytes([icmp_module.ICMP_ECHO_REPLY]) + packet[1:]
+        ip_header = bytes([0x45]) + bytes(19)
+        self.assertEqual(icmp_module.parse_reply(ip_header + reply, raw=True), (0x1234, 7))
+        self.assertEqual(icmp_module.parse_reply(reply, raw=False), (0x1234, 7))
+        self.assertIsNone(icmp_module.parse_reply(packet, raw=False))
+
+    def test_snmp_probes_silent_hosts_and_scans_responders(self):
+        icmp_results = {"10.0.0.1": 0.002, "10.0.0.2": None, "10.0.0.3": None}
+        probed = []
+
+        def fake_client(host, *args):
+            probed.append(host)
+            client = MagicMock()
+            value = "sw3" if host == "10.0.0.3" else None
+            client.multiget = AsyncMock(return_value=[value])
+            return client
+
+        with patch.object(sweep_module.Pinger, "ping", new_callable=AsyncMock, return_value=icmp_results), \
+             patch.object(snmp_module, "_pure_client", side_effect=fake_client), \
+             patch.object(sweep_module, "scan_devices", return_value=["10.0.0.3"]) as scan:
+            result = sweep_module.sweep_subnets(["10.0.0.0/30", "10.0.0.3/32"], rate=0)
+
+        self.assertEqual(sorted(probed), ["10.0.0.2", "10.0.0.3"])
+        self.assertEqual(result["responders"], ["10.0.0.1", "10.0.0.3"])
+        self.assertEqual(result["scanned"], ["10.0.0.3"])
+        scan.assert_called_once_with(["10.0.0.1", "10.0.0.3"], "public", None)
+
+    def test_ping_only_sweep_without_icmp_socket(self):
+        with patch.object(sweep_module.Pinger, "ping", new_callable=AsyncMock, side_effect=PermissionError), \
+             patch.object(sweep_module, "check_ping", side_effect=lambda host, *a: host == "10.0.0.2"), \
+             patch.object(snmp_module, "_pure_client") as client:
+            result = sweep_module.sweep_subnets(["10.0.0.0/30"], snmp_probe=False, scan=False)
+        client.assert_not_called()
+        self.assertEqual(result["responders"], ["10.0.0.2"])
+        self.assertEqual(result["scanned"], [])
+
+    def test_command_validates_every_cidr_and_passes_options_to_task(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with patch.object(tasks.sweep_subnets_task, "delay") as delay:
+            with self.assertRaises(CommandError):
+                call_command("sweep_subnets", "10.0.0.0/30", "10.0.0.300/24", "--async")
+            with self.assertRaises(CommandError):
+                call_command("sweep_subnets", "2001:db8::/64", "--async")
+            delay.assert_not_called()
+            call_command("sweep_subnets", "10.0.0.0/8", "--async", "--min-prefix", "8", stdout=MagicMock())
+            self.assertEqual(delay.call_args.kwargs["min_prefix"], 8)
+            call_command("sweep_subnets", "10.0.0.0/30", "--async", "--timeout", "2.5", "--workers", "3",
+                         stdout=MagicMock())
+        self.assertEqual(delay.call_args.kwargs["timeout"], 2.5)
+        self.assertEqual(delay.call_args.kwargs["workers"], 3)
+
+
+from . import ping as ping_module
+
+
+class PingCheckTaskTest(TestCase):
+    def _devices(self, count):
+        return [
+            Device.objects.create(hostname=f"d{n}", management_ip=f"10.0.1.{n}")
+            for n in range(1, count + 1)
+        ]
+
+    def test_records_availability_and_alerts(self):
+        up, down, back = self._devices(3)
+        Alert.objects.create(device=back, metric="ping", value=0)
+        measured = ping_module.ping_statistics([0.010, 0.014, None, 0.012])
+        results = {
+            up.management_ip: measured,
+            down.management_ip: ping_module.ping_statistics([None] * 4),
+            back.management_ip: ping_module._unmeasured(True),
+        }
+        with patch.object(tasks, "ping_many", return_value=results) as ping_many:
+            tasks.ping_check_task()
+
+        ping_many.assert_called_once()
+        values = dict(MetricRecord.objects.filter(metric="ping").values_list("device__hostname", "value"))
+        self.assertEqual(values, {"d1": 1, "d2": 0, "d3": 1})
+        latency = dict(up.metric_records.exclude(metric="ping").values_list("metric", "value"))
+        self.assertEqual(set(latency), set(tasks.PING_METRICS))
+        self.assertEqual(dict(down.metric_records.exclude(metric="ping").values_list("metric", "value")),
+                         {"packet_loss": 100.0})
+        self.assertFalse(back.metric_records.exclude(metric="ping").exists())
+        self.assertTrue(Device.objects.get(pk=up.pk).is_online)
+        self.assertFalse(Device.objects.get(pk=down.pk).is_online)
+        self.assertTrue(Alert.objects.filter(device=down, metric="ping", cleared_at__isnull=True).exists())
+        self.assertIsNotNone(Alert.objects.get(device=back).cleared_at)
+
+    def test_query_count_does_not_grow_with_fleet(self):
+        devices = self._devices(8)
+        with patch.object(tasks, "ping_many", return_value={}):
+            # 5 for the check itself, 2 for the flush's savepoint and 4 for
+            # the rollup update in its own savepoint
+            with self.assertNumQueries(11):
+                tasks.ping_check_task()
+        self.assertEqual(MetricRecord.objects.filter(metric="ping").count(), len(devices))
+
+    def test_ping_many_falls_back_without_icmp_socket(self):
+        with patch.object(ping_module.Pinger, "probe", new_callable=AsyncMock, side_effect=PermissionError), \
+             patch.object(ping_module, "check_ping", side_effect=lambda host, **kw: host == "10.0.0.1"):
+            results = ping_module.ping_many(["10.0.0.1", "10.0.0.2", "fe80::1"])
+        self.assertEqual({host: stats["up"] for host, stats in results.items()},
+                         {"10.0.0.1": True, "10.0.0.2": False, "fe80::1": False})
+        self.assertIsNone(results["10.0.0.1"]["rtt_avg"])
+
+    def test_ping_many_batches_ipv4(self):
+        rtts = {"10.0.0.1": [0.01, 0.03], "10.0.0.2": [None, None]}
+        with patch.object(ping_module.Pinger, "probe", new_callable=AsyncMock, return_value=rtts) as batch, \
+             patch.object(ping_module, "check_ping", return_value=True) as single:
+            results = ping_module.ping_many(["10.0.0.1", "10.0.0.2", "::1", "10.0.0.1"], count=2)
+        batch.assert_awaited_once_with(["10.0.0.1", "10.0.0.2"], 2, 0.2, 1.0)
+        single.assert_called_once_with("::1", count=2, timeout=1.0)
+        self.assertAlmostEqual(results["10.0.0.1"]["rtt_avg"], 20.0)
+        self.assertAlmostEqual(results["10.0.0.1"]["jitter"], 20.0)
+        self.assertEqual(results["10.0.0.2"]["packet_loss"], 100.0)
+        self.assertTrue(results["::1"]["up"])
+
+    def test_ping_statistics(self):
+        stats = ping_module.ping_statistics([0.010, None, 0.020, 0.012])
+        self.assertTrue(stats["up"])
+        self.assertEqual(stats["packet_loss"], 25.0)
+        self.assertAlmostEqual(stats["rtt_min"], 10.0)
+        self.assertAlmostEqual(stats["rtt_max"], 20.0)
+        self.assertAlmostEqual(stats["rtt_avg"], 14.0)
+        self.assertAlmostEqual(stats["jitter"], 9.0)
+
+    def test_device_metric_data_returns_latency(self):
+        device = self._devices(1)[0]
+        MetricRecord.objects.create(device=device, metric="rtt_avg", value=12.5)
+        User.objects.create_user("viewer", password="pw")
+        self.client.login(username="viewer", password="pw")
+        response = self.client.get(reverse("device_metric_data", args=[device.pk, "rtt_avg"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([point["value"] for point in response.json()], [12.5])
+
+
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+from . import reconcile as reconcile_module
+
+
+class InterfaceReconcileTest(TestCase):
+    def _scan(self, ip, ports):
+        def fake_table(target, columns, *args, **kwargs):
+            for n in range(1, ports + 1):
+                yield str(n), {
+                    snmp_module.IF_NAME_OID: f"Gig0/{n}",
+                    snmp_module.IF_MAC_OID: f"aa:00:00:00:00:{n:02x}",
+                    snmp_module.IF_STATUS_OID: 1,
+                }
+
+        system = {snmp_module.SYS_NAME_OID: f"sw-{ip}", snmp_module.SYS_DESCR_OID: "VendorOS"}
+        with patch.object(snmp_module, "snmp_get_many", return_value=system), \
+             patch.object(snmp_module, "snmp_table", side_effect=fake_table), \
+             CaptureQueriesContext(connection) as queries:
+            device = snmp_module.scan_device(ip)
+        self.assertEqual(device.interfaces.count(), ports)
+        return len(queries)
+
+    def test_scan_query_count_does_not_grow_with_ports(self):
+        self.assertEqual(self._scan("192.0.2.1", 4), self._scan("192.0.2.2", 100))
+        # rescans take the update path
+        self.assertEqual(self._scan("192.0.2.1", 4), self._scan("192.0.2.2", 100))
+
+    def test_reconcile_creates_updates_and_deletes(self):
+        device = Device.objects.create(hostname="sw1")
+        Interface.objects.create(device=device, name="eth0", status="1")
+        Interface.objects.create(device=device, name="eth1", status="1")
+
+        scan = {"eth1": {"status": "2"}, "eth2": {"status": "1"}}
+        with override_settings(INTERFACE_PURGE_SCANS=2):
+            counts = reconcile_module.reconcile_interfaces(device, scan, ["status"])
+            self.assertEqual(counts, (1, 1, 0))
+            self.assertEqual(
+                dict(device.interfaces.values_list("name", "missed_scans")), {"eth0": 1, "eth1": 0, "eth2": 0}
+            )
+            counts = reconcile_module.reconcile_interfaces(device, scan, ["status"])
+
+        self.assertEqual(counts, (0, 0, 1))
+        self.assertEqual(
+            dict(device.interfaces.values_list("name", "status")), {"eth1": "2", "eth2": "1"}
+        )
+
+    def test_missing_interface_keeps_history_until_purged(self):
+        device = Device.objects.create(hostname="sw1")
+        eth0 = Interface.objects.create(device=device, name="eth0")
+        Interface.objects.create(device=device, name="eth1")
+        MetricRecord.objects.create(device=device, interface=eth0, metric="in_octets", value=1)
+
+        reconcile_module.reconcile_interfaces(device, {"eth1": {}}, [])
+        reconcile_module.reconcile_interfaces(device, {"eth1": {}}, [])
+        self.assertEqual(Interface.objects.get(pk=eth0.pk).missed_scans, 2)
+        self.assertTrue(MetricRecord.objects.filter(interface=eth0).exists())
+
+        self.assertEqual(reconcile_module.reconcile_interfaces(device, {"eth0": {}, "eth1": {}}, []), (0, 1, 0))
+        self.assertEqual(Interface.objects.get(pk=eth0.pk).missed_scans, 0)
+        self.assertEqual(
+            list(ChangeRecord.objects.filter(interface_name="eth0").values_list("old_value", "new_value")),
+            [("eth0", ""), ("", "eth0")],
+        )
+
+    def test_interrupted_walk_keeps_interfaces_and_is_not_cached(self):
+        device = Device.objects.create(hostname="sw1", management_ip="192.0.2.1", snmp_version="2c")
+        for n in range(1, 4):
+            Interface.objects.create(device=device, name=f"Gig0/{n}")
+        name = snmp_module.IF_NAME_OID
+        responses = iter([
+            (None, 0, 0, [(f"{name}.1", "Gig0/1")]),
+            ("requestTimedOut", 0, 0, []),
+        ])
+        system = {snmp_module.SYS_NAME_OID: "sw1", snmp_module.SYS_DESCR_OID: "VendorOS"}
+        cache_module.local_cache.clear()
+        with patch.object(snmp_module, "snmp_get_many", return_value=system), \
+             patch.object(snmp_module, "_new_session", return_value=(MagicMock(), MagicMock())), \
+             patch.object(snmp_module, "bulkCmd", return_value=responses), \
+             patch.object(snmp_module, "SnmpEngine", MagicMock()), \
+             patch.object(snmp_module, "ContextData", MagicMock(), create=True), \
+             patch.object(snmp_module, "ObjectType", MagicMock(), create=True), \
+             patch.object(snmp_module, "ObjectIdentity", MagicMock(), create=True):
+            with self.assertRaises(snmp_module.SnmpWalkIncomplete):
+                snmp_module.scan_device("192.0.2.1")
+        snmp_module.session_pool.clear()
+
+        self.assertEqual(device.interfaces.count(), 3)
+        self.assertFalse(device.interfaces.filter(missed_scans__gt=0).exists())
+        self.assertIsNone(cache_module.local_cache.get(
+            snmp_module._walk_key("192.0.2.1", name, "public", "2c")
+        ))
+
+    def test_empty_walk_keeps_interfaces(self):
+        device = Device.objects.create(hostname="sw1")
+        Interface.objects.create(device=device, name="eth0")
+        self.assertEqual(reconcile_module.reconcile_interfaces(device, {}, ["status"]), (0, 0, 0))
+        self.assertTrue(device.interfaces.filter(name="eth0").exists())
+
+
+from .models import ChangeRecord
+
+
+class ChangeTrackingTest(TestCase):
+    def _scan(self, statuses, hostname="sw1"):
+        def fake_table(target, columns, *args, **kwargs):
+            for n, status in enumerate(statuses, start=1):
+                yield str(n), {
+                    snmp_module.IF_NAME_OID: f"Gig0/{n}",
+                    snmp_module.IF_MAC_OID: f"aa:00:00:00:00:{n:02x}",
+                    snmp_module.IF_STATUS_OID: status,
+                }
+
+        system = {snmp_module.SYS_NAME_OID: hostname, snmp_module.SYS_DESCR_OID: "VendorOS 1.0"}
+        with patch.object(snmp_module, "snmp_get_many", return_value=system), \
+             patch.object(snmp_module, "snmp_table", side_effect=fake_table), \
+             CaptureQueriesContext(connection) as queries:
+            snmp_module.scan_device("192.0.2.1")
+        return [q["sql"] for q in queries if not q["sql"].startswith("SELECT")]
+
+    def test_unchanged_rescan_writes_no_interfaces(self):
+        self._scan([1, 1, 1])
+        self.assertFalse(ChangeRecord.objects.exists())
+
+        writes = self._scan([1, 1, 1])
+
+        self.assertFalse([sql for sql in writes if "inventory_interface" in sql])
+        # only the device's scan timestamps are written
+        self.assertEqual(len(writes), 1)
+        self.assertFalse(ChangeRecord.objects.exists())
+
+    def test_changes_are_logged(self):
+        self._scan([1, 1, 1])
+        self._scan([1, 2], hostname="sw1-renamed")
+
+        changes = {
+            (c.interface_name, c.field): (c.old_value, c.new_value)
+            for c in ChangeRecord.objects.all()
+        }
+        self.assertEqual(changes, {
+            ("Gig0/2", "status"): ("1", "2"),
+            ("Gig0/3", "interface"): ("Gig0/3", ""),
+            ("", "hostname"): ("sw1", "sw1-renamed"),
+        })
+        self.assertEqual(Interface.objects.get(name="Gig0/2").status, "2")
+        self.assertEqual(Interface.objects.get(name="Gig0/3").missed_scans, 1)
+
+    def test_device_page_shows_changes(self):
+        self._scan([1])
+        self._scan([2])
+        device = Device.objects.get(management_ip="192.0.2.1")
+        User.objects.create_user("viewer", password="pw")
+        self.client.login(username="viewer", password="pw")
+        response = self.client.get(reverse("device_detail", args=[device.pk]))
+        self.assertContains(response, "Recent Changes")
+
+
+
+import math
+from . import tsdb
+from .models import MetricChunk
+
+
+class ChunkCodecTest(TestCase):
+    def test_round_trip(self):
+        start = timezone.now().replace(microsecond=250000)
+        offsets = [0, 300, 600, 900, 1200.005, 1500, 1499, 90000, 90000, -3600]
+        values = [1.5, 1.5, 2.0, -0.0, float('inf'), 1e300, 5e-324, 42, 2 ** 53, 0.1]
+        samples = [(start + timedelta(seconds=o), v) for o, v in zip(offsets, values)]
+
+        encoder = tsdb.ChunkEncoder.from_samples(samples)
+        decoded = tsdb.decode(encoder.getvalue(), encoder.count)
+
+        self.assertEqual(decoded, samples)
+        self.assertEqual(math.copysign(1, decoded[3][1]), -1)
+
+    def test_regular_series_compresses(self):
+        start = timezone.now().replace(microsecond=0)
+        encoder = tsdb.ChunkEncoder.from_samples(
+            (start + timedelta(minutes=5 * i), 50.0 + i % 2) for i in range(120)
+        )
+        self.assertLess(len(encoder.getvalue()) / 120, 2)
+
+
+@override_settings(METRIC_BACKEND='chunks')
+class ChunkStoreTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 't@example.com', 'pw')
+        self.device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+        self.iface = Interface.objects.create(device=self.device, name='eth0')
+        self.start = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+
+    def _write(self, store, samples, metric='cpu', interface=None):
+        with metrics_module.MetricWriter(store=store) as writer:
+            for minute, value in samples:
+                writer.add(self.device, metric, value, self.start + timedelta(minutes=minute), interface)
+
+    def test_chunks_seal_at_size_and_queries_span_them(self):
+        store = metrics_module.ChunkStore(chunk_samples=4)
+        self._write(store, [(m, m) for m in range(6)])
+        self._write(store, [(m, m) for m in range(6, 10)])
+
+        self.assertEqual(sorted(MetricChunk.objects.values_list('count', flat=True)), [2, 4, 4])
+        series = store.series('cpu', device=self.device,
+                              start=self.start + timedelta(minutes=3),
+                              end=self.start + timedelta(minutes=8))
+        self.assertEqual([s.value for s in series], [3, 4, 5, 6, 7, 8])
+        self.assertEqual(store.latest('cpu', device=self.device).value, 9)
+
+    def test_stores_sharing_a_series_do_not_overwrite(self):
+        first = metrics_module.ChunkStore()
+        second = metrics_module.ChunkStore()
+        self._write(first, [(0, 1)])
+        self._write(second, [(1, 2)])
+        self._write(first, [(2, 3), (-5, 0)])
+
+        values = [s.value for s in first.series('cpu', device=self.device)]
+        self.assertEqual(values, [0, 1, 2, 3])
+
+    def test_views_and_tasks_read_chunks(self):
+        self._write(metrics_module.get_store(), [(0, 100), (5, 200)], 'in_octets', self.iface)
+        self._write(metrics_module.get_store(), [(0, 95)])
+        AlertProfile.objects.create(name='default', cpu_threshold=80).devices.add(self.device)
+        self.assertFalse(MetricRecord.objects.exists())
+
+        self.client.force_login(self.user)
+        data = self.client.get(reverse('interface_metric_data', args=[self.iface.pk])).json()
+        self.assertEqual([d['value'] for d in data['in']], [100, 200])
+        self.assertEqual(data['out'], [])
+        data = self.client.get(reverse('device_metric_data', args=[self.device.pk, 'cpu'])).json()
+        self.assertEqual(len(data), 1)
+
+        tasks.alert_check_task()
+        self.assertTrue(Alert.objects.filter(device=self.device, metric='cpu').exists())
+
+
+from .models import MetricRollup
+
+
+class MetricRollupTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 't@example.com', 'pw')
+        self.device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+        self.hour = (timezone.now() - timedelta(days=2)).replace(minute=0, second=0, microsecond=0)
+
+    def _write(self, *samples):
+        with metrics_module.MetricWriter() as writer:
+            for minute, value in samples:
+                writer.add(self.device, 'cpu', value, self.hour + timedelta(minutes=minute))
+
+    def test_rollups_are_maintained_incrementally(self):
+        self._write((0, 10), (30, 30))
+        self._write((45, 20), (15, 50), (70, 5))
+
+        hourly = MetricRollup.objects.get(tier='hour', bucket=self.hour)
+        self.assertEqual((hourly.count, hourly.min, hourly.max, hourly.avg, hourly.last),
+                         (4, 10, 50, 27.5, 20))
+        self.assertEqual(MetricRollup.objects.filter(tier='hour').count(), 2)
+        daily = MetricRollup.objects.filter(tier='day').order_by('bucket')
+        self.assertEqual(sum(r.count for r in daily), 5)
+
+    def test_queries_use_coarsest_tier_that_fits(self):
+        now = timezone.now()
+        self.assertEqual(metrics_module.rollup_tier(now - timedelta(days=30), 86400, now), 'day')
+        self.assertEqual(metrics_module.rollup_tier(now - timedelta(days=30), 7200, now), 'hour')
+        self.assertIsNone(metrics_module.rollup_tier(now - timedelta(days=30), 600, now))
+        with override_settings(METRIC_HOURLY_RETENTION_DAYS=7):
+            self.assertIsNone(metrics_module.rollup_tier(now - timedelta(days=30), 7200, now))
+
+    def test_api_reads_rollups_when_resolution_allows(self):
+        self._write((0, 10), (30, 30), (70, 5))
+        self.client.force_login(self.user)
+        url = reverse('device_metric_data', args=[self.device.pk, 'cpu'])
+
+        self.assertEqual(len(self.client.get(url).json()), 3)
+        data = self.client.get(url, {'resolution': 3600}).json()
+        self.assertEqual([d['value'] for d in data], [20, 5])
+        data = self.client.get(url, {'resolution': 3600, 'aggregate': 'max'}).json()
+        self.assertEqual([d['value'] for d in data], [30, 5])
+
+    def test_prune_honours_tier_retention(self):
+        self._write((0, 10))
+        with override_settings(METRIC_HOURLY_RETENTION_DAYS=1, METRIC_DAILY_RETENTION_DAYS=0):
+            deleted = tasks.prune_metrics_task()
+        self.assertEqual(deleted['hour'], 1)
+        self.assertNotIn('day', deleted)
+        self.assertEqual(list(MetricRollup.objects.values_list('tier', flat=True)), ['day'])
+
+    def test_insert_race_is_retried_as_merge(self):
+        self._write((0, 10))
+        real = metrics_module._locked_rollups
+        calls = []
+
+        def locked(partials):
+            # the first attempt misses the rows another writer just committed
+            calls.append(partials)
+            return real(partials) if len(calls) > 1 else MetricRollup.objects.none()
+
+        with patch.object(metrics_module, '_locked_rollups', side_effect=locked):
+            self._write((30, 30))
+
+        self.assertEqual(len(calls), 2)
+        hourly = MetricRollup.objects.get(tier='hour', bucket=self.hour)
+        self.assertEqual((hourly.count, hourly.max), (2, 30))
+        self.assertEqual(MetricRollup.objects.count(), 2)
+
+    def test_racing_interface_inserts_merge_or_give_up(self):
+        iface = Interface.objects.create(device=self.device, name='eth0')
+
+        def record(value, minute):
+            return MetricRecord(device=self.device, interface=iface, metric='in_octets',
+                                value=value, timestamp=self.hour + timedelta(minutes=minute))
+
+        # the other writer inserted both buckets after this one looked for them
+        metrics_module.update_rollups([record(100, 0)])
+        real = metrics_module._locked_rollups
+        attempts = []
+
+        def miss_once(partials):
+            attempts.append(len(partials))
+            return MetricRollup.objects.none() if len(attempts) == 1 else real(partials)
+
+        with patch.object(metrics_module, '_locked_rollups', side_effect=miss_once):
+            metrics_module.update_rollups([record(300, 10)])
+        self.assertEqual(attempts, [2, 2])
+        hourly = MetricRollup.objects.get(tier='hour', interface=iface)
+        self.assertEqual((hourly.count, hourly.total, hourly.last), (2, 400, 300))
+
+        with patch.object(metrics_module, '_locked_rollups', return_value=MetricRollup.objects.none()), \
+             self.assertRaises(IntegrityError):
+            metrics_module.update_rollups([record(500, 20)])
+        self.assertEqual(MetricRollup.objects.get(tier='hour', interface=iface).count, 2)
+
+    def test_backfill_builds_missing_rollups_only(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        self.hour = metrics_module._bucket(self.hour, timedelta(days=1)) + timedelta(hours=12)
+        MetricRecord.objects.bulk_create([
+            MetricRecord(device=self.device, metric='cpu', value=value,
+                         timestamp=self.hour + timedelta(minutes=minute))
+            for minute, value in ((0, 10), (30, 30), (70, 5))
+        ])
+        store = metrics_module.ChunkStore()
+        store.write([MetricRecord(device=self.device, metric='memory', value=40,
+                                  timestamp=self.hour - timedelta(days=1))])
+        # a bucket the writers already maintain is not added to again
+        self._write((80, 7))
+
+        out = StringIO()
+        call_command('backfill_rollups', stdout=out)
+        self.assertIn('Created 3 rollups', out.getvalue())
+        hourly = MetricRollup.objects.get(tier='hour', bucket=self.hour, metric='cpu')
+        self.assertEqual((hourly.count, hourly.avg), (2, 20))
+        later = MetricRollup.objects.get(tier='hour', bucket=self.hour + timedelta(hours=1))
+        self.assertEqual(later.count, 1)
+        self.assertEqual(MetricRollup.objects.get(tier='day', metric='cpu').count, 1)
+        self.assertTrue(MetricRollup.objects.filter(metric='memory', tier='day').exists())
+
+        self.assertEqual(metrics_module.backfill_rollups(), 0)
+
+
+from . import partitions as partitions_module
+
+
+class MetricRetentionTest(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+        self.now = timezone.now()
+
+    @override_settings(METRIC_RETENTION_DAYS=30, METRIC_PRUNE_BATCH_SIZE=2)
+    def test_prunes_expired_samples_in_batches(self):
+        old = self.now - timedelta(days=31)
+        for i in range(5):
+            MetricRecord.objects.create(device=self.device, metric='cpu', value=i, timestamp=old)
+        MetricRecord.objects.create(device=self.device, metric='cpu', value=9, timestamp=self.now)
+        store = metrics_module.ChunkStore()
+        with metrics_module.MetricWriter(store=store) as writer:
+            writer.add(self.device, 'memory', 1, old - timedelta(hours=1))
+            writer.add(self.device, 'memory', 2, old)
+
+        with CaptureQueriesContext(connection) as ctx:
+            result = partitions_module.prune_metric_records(self.now)
+
+        self.assertEqual(result, {'records': 5, 'chunks': 1})
+        self.assertEqual(list(MetricRecord.objects.values_list('value', flat=True)), [9])
+        deletes = [q for q in ctx.captured_queries
+                   if q['sql'].startswith('DELETE FROM "inventory_metricrecord"')]
+        self.assertEqual(len(deletes), 3)
+
+    @override_settings(METRIC_RETENTION_DAYS=0)
+    def test_zero_retention_keeps_everything(self):
+        MetricRecord.objects.create(device=self.device, metric='cpu', value=1,
+                                    timestamp=self.now - timedelta(days=3650))
+        self.assertEqual(partitions_module.prune_metric_records(self.now), {})
+        self.assertEqual(MetricRecord.objects.count(), 1)
+
+    def test_partition_bounds(self):
+        when = timezone.now().replace(year=2026, month=10, day=15, hour=13)
+        self.assertEqual(partitions_module.partition_start(when, 'week').day, 12)
+        start = partitions_module.partition_start(when, 'day')
+        self.assertEqual(partitions_module.partition_name(start), 'inventory_metricrecord_p20261015')
+        lower, upper = partitions_module.parse_bound(
+            "FOR VALUES FROM (MINVALUE) TO ('2026-10-16 00:00:00+00')")
+        self.assertIsNone(lower)
+        self.assertEqual(upper, start + timedelta(days=1))
+        self.assertIsNone(partitions_module.parse_bound('DEFAULT'))
+
+    def test_ensure_partitions_skips_existing_ranges(self):
+        self.assertEqual(partitions_module.ensure_partitions(), [])
+
+        start = partitions_module.partition_start(self.now, 'day')
+        existing = [
+            ('inventory_metricrecord_legacy', (None, start + timedelta(days=1))),
+            ('inventory_metricrecord_default', None),
+        ]
+        with patch.object(partitions_module, 'is_partitioned', return_value=True), \
+             patch.object(partitions_module, 'partitions', return_value=existing), \
+             patch.object(partitions_module, '_create_partition') as create:
+            created = partitions_module.ensure_partitions(ahead=2, interval='day', now=self.now)
+
+        self.assertEqual(created, [partitions_module.partition_name(start + timedelta(days=d))
+                                   for d in (1, 2)])
+        self.assertEqual(create.call_args_list[0].args[1:],
+                         (start + timedelta(days=1), start + timedelta(days=2)))
+
+
+import os
+import tempfile
+from . import rra
+
+
+class RoundRobinArchiveTest(TestCase):
+    archives = (('LAST', 1, 4), ('AVERAGE', 3, 4), ('MAX', 3, 4))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'series.rra')
+        rra.create(self.path, 60, self.archives)
+
+    def test_consolidates_in_place_and_wraps(self):
+        size = os.path.getsize(self.path)
+        with rra.RoundRobinFile(self.path) as rrd:
+            self.assertEqual(rrd.update([(60 * m, m) for m in range(6)]), 6)
+            self.assertEqual(rrd.update([(0, 99)]), 0)  # older than the last update
+            last, average, peak = rrd.archives
+            self.assertEqual(rrd.fetch(last), [(120, 2), (180, 3), (240, 4), (300, 5)])
+            self.assertEqual(rrd.fetch(average), [(0, 1.0), (180, 4.0)])
+            self.assertEqual(rrd.fetch(peak, start=180), [(180, 5)])
+
+            # a gap longer than the ring leaves only the new sample
+            rrd.update([(60 * 20, 7)])
+            self.assertEqual(rrd.fetch(last), [(1200, 7)])
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_choose_archive(self):
+        with rra.RoundRobinFile(self.path) as rrd:
+            rrd.update([(60 * m, m) for m in range(12)])
+            last, average, peak = rrd.archives
+            self.assertIs(rrd.choose(start=600), last)
+            self.assertIs(rrd.choose(start=0), average)
+            self.assertIs(rrd.choose(resolution=300, function='MAX'), peak)
+
+
+@override_settings(METRIC_INTERFACE_BACKEND='rra', METRIC_BACKEND='records')
+class RoundRobinStoreTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.user = User.objects.create_user('tester', 't@example.com', 'pw')
+        self.device = Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+        self.iface = Interface.objects.create(device=self.device, name='eth0')
+        self.start = timezone.now().replace(second=0, microsecond=0) - timedelta(hours=1)
+        self.start -= timedelta(minutes=self.start.minute % 5)
+
+    def _store(self, **kwargs):
+        return rra.RoundRobinStore(self.tmp.name, step=300, **kwargs)
+
+    def test_interface_octets_are_routed_to_archives(self):
+        store = self._store()
+        with patch.dict(metrics_module._stores, {'rra': store}):
+            with metrics_module.MetricWriter() as writer:
+                for n in range(3):
+                    ts = self.start + timedelta(minutes=5 * n)
+                    writer.add(self.device, 'in_octets', 100 * n, ts, interface=self.iface)
+                    writer.add(self.device, 'cpu', n, ts)
+            self.client.login(username='tester', password='pw')
+            resp = self.client.get(reverse('interface_metric_data', args=[self.iface.pk]))
+
+        self.assertEqual(list(MetricRecord.objects.values_list('metric', flat=True).distinct()), ['cpu'])
+        self.assertFalse(MetricRollup.objects.filter(metric='in_octets').exists())
+        self.assertEqual([row['value'] for row in resp.json()['in']], [0, 100, 200])
+        self.assertEqual(resp.json()['out'], [])
+        self.assertEqual(store.latest('in_octets', interface=self.iface).value, 200)
+
+    def test_daemon_batches_queued_updates(self):
+        client = FakeRedis()
+        queued = self._store(queue=client)
+        for n in range(4):
+            record = MetricRecord(device=self.device, interface=self.iface, metric='out_octets',
+                                  value=n, timestamp=self.start + timedelta(minutes=5 * n))
+            queued.write([record])
+        self.assertEqual(queued.series('out_octets', interface=self.iface), [])
+
+        store = self._store(queue=False)
+        with patch.object(store, 'apply', wraps=store.apply) as apply:
+            applied = rra.run_daemon(batch_size=10, once=True, client=client, store=store)
+
+        self.assertEqual(applied, 4)
+        apply.assert_called_once()
+        self.assertEqual([s.value for s in store.series('out_octets', interface=self.iface)],
+                         [0, 1, 2, 3])
+        self.assertEqual(client.data[rra.QUEUE_KEY], [])
+        self.assertEqual(client.data[rra.PROCESSING_KEY], [])
+
+    def test_daemon_requeues_unwritten_updates(self):
+        client = FakeRedis()
+        queued = self._store(queue=client)
+        for n in range(4):
+            record = MetricRecord(device=self.device, interface=self.iface, metric='out_octets',
+                                  value=n, timestamp=self.start + timedelta(minutes=5 * n))
+            queued.write([record])
+
+        store = self._store(queue=False)
+        with patch.object(store, 'apply', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                rra.run_daemon(batch_size=10, once=True, client=client, store=store)
+        self.assertEqual(len(client.data[rra.PROCESSING_KEY]), 4)
+
+        queued.write([MetricRecord(device=self.device, interface=self.iface, metric='out_octets',
+                                   value=4, timestamp=self.start + timedelta(minutes=20))])
+        self.assertEqual(rra.run_daemon(batch_size=10, once=True, client=client, store=store), 5)
+        self.assertEqual([s.value for s in store.series('out_octets', interface=self.iface)],
+                         [0, 1, 2, 3, 4])
+        self.assertEqual(client.data[rra.PROCESSING_KEY], [])
+        self.assertNotIn(rra.ATTEMPTS_KEY, client.data)
+
+    def test_daemon_sets_aside_a_batch_that_keeps_failing(self):
+        client = FakeRedis()
+        queued = self._store(queue=client)
+        queued.write([MetricRecord(device=self.device, interface=self.iface, metric='out_octets',
+                                   value=1, timestamp=self.start)])
+        store = self._store(queue=False)
+        with patch.object(store, 'apply', side_effect=OSError('bad file')):
+            for _ in range(3):
+                with self.assertRaises(OSError):
+                    rra.run_daemon(batch_size=10, once=True, client=client, store=store, max_attempts=3)
+
+        with self.assertLogs('inventory.rra', level='ERROR'):
+            applied = rra.run_daemon(batch_size=10, once=True, client=client, store=store, max_attempts=3)
+        self.assertEqual(applied, 0)
+        self.assertEqual(len(client.data[rra.DEAD_LETTER_KEY]), 1)
+        self.assertEqual(client.data[rra.PROCESSING_KEY], [])
+        self.assertNotIn(rra.ATTEMPTS_KEY, client.data)
+
+    def test_daemon_sets_aside_malformed_updates(self):
+        client = FakeRedis()
+        queued = self._store(queue=client)
+        client.rpush(rra.QUEUE_KEY, 'not json', '[1, 2]')
+        queued.write([MetricRecord(device=self.device, interface=self.iface, metric='out_octets',
+                                   value=7, timestamp=self.start)])
+
+        store = self._store(queue=False)
+        with self.assertLogs('inventory.rra', level='ERROR'):
+            applied = rra.run_daemon(batch_size=10, once=True, client=client, store=store)
+        self.assertEqual(applied, 1)
+        self.assertEqual([s.value for s in store.series('out_octets', interface=self.iface)], [7])
+        self.assertEqual(client.data[rra.DEAD_LETTER_KEY], [b'not json', b'[1, 2]'])
+        self.assertEqual(client.data[rra.PROCESSING_KEY], [])
+
+
+from . import addresses
+from . import hosts as hosts_module
+
+
+class HostSearchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 't@example.com', 'pw')
+        Host.objects.create(mac_address='00:11:22:aa:bb:01', ip_address='10.1.2.3')
+        Host.objects.create(mac_address='0011.22AA.BB02', ip_address='10.1.3.4')
+        Host.objects.create(mac_address='00-11-23-00-00-01', ip_address='2001:db8::5')
+        Host.objects.create(mac_address='legacy', ip_address='10.9.9.9')
+
+    def _macs(self, hosts):
+        return sorted(host.mac_address for host in hosts)
+
+    def test_address_keys(self):
+        self.assertEqual(addresses.mac_to_int('00:11:22:AA:BB:01'), 0x001122aabb01)
+        self.assertIsNone(addresses.mac_to_int('legacy'))
+        self.assertEqual(addresses.mac_range('00:11:22'), (0x001122000000, 0x001122ffffff))
+        self.assertEqual(addresses.int_to_mac(0x001122aabb01), '00:11:22:aa:bb:01')
+        low, high = addresses.network_range('10.1.2.0/23')
+        self.assertTrue(low <= addresses.pack_ip('10.1.3.255') <= high)
+        self.assertEqual(len(addresses.pack_ip('10.1.2.3')), 16)
+
+    def test_search(self):
+        self.assertEqual(self._macs(hosts_module.search_hosts(mac='00:11:22:aa:bb:02')),
+                         ['0011.22AA.BB02'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(mac_prefix='001122')),
+                         ['0011.22AA.BB02', '00:11:22:aa:bb:01'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(subnet='10.1.2.0/24')),
+                         ['00:11:22:aa:bb:01'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(subnet='2001:db8::/32')),
+                         ['00-11-23-00-00-01'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(ip='10.9.9.9')), ['legacy'])
+
+    def test_keys_follow_updates(self):
+        host = Host.objects.get(mac_address='legacy')
+        host.ip_address = '10.1.2.200'
+        host.save(update_fields=['ip_address'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(subnet='10.1.2.0/24')),
+                         ['00:11:22:aa:bb:01', 'legacy'])
+
+        hosts_module.upsert_hosts([Host(mac_address='00:11:22:aa:bb:01', ip_address='10.7.0.1')],
+                                  ['ip_address'])
+        self.assertEqual(self._macs(hosts_module.search_hosts(ip='10.7.0.1')), ['00:11:22:aa:bb:01'])
+
+    def test_api(self):
+        self.client.login(username='tester', password='pw')
+        url = reverse('host_search')
+        resp = self.client.get(url, {'oui': '00:11:22', 'limit': '1'})
+        self.assertEqual([row['mac_address'] for row in resp.json()], ['00:11:22:aa:bb:01'])
+        self.assertEqual(self.client.get(url, {'subnet': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+
+from collections import Counter
+from io import StringIO
+from django.core.management import call_command
+from . import schedule as schedule_module
+
+
+@override_settings(METRIC_POLL_INTERVAL=300, METRIC_POLL_TICK=10)
+class PollScheduleTest(TestCase):
+    def setUp(self):
+        self.core = Tag.objects.create(name='core', poll_interval=30)
+        self.ap = Tag.objects.create(name='ap', poll_interval=900)
+        self.router = Device.objects.create(hostname='core1', management_ip='192.0.2.1')
+        self.router.tags.add(self.core, self.ap)
+        self.access = Device.objects.create(hostname='ap1', management_ip='192.0.2.2')
+        self.access.tags.add(self.ap)
+        self.pinned = Device.objects.create(hostname='fw1', management_ip='192.0.2.3', poll_interval=60)
+        self.pinned.tags.add(self.core)
+        self.plain = Device.objects.create(hostname='sw1', management_ip='192.0.2.4')
+
+    def test_interval_precedence(self):
+        intervals = {d.hostname: d.interval for d in schedule_module.with_intervals()}
+        self.assertEqual(intervals, {'core1': 30, 'ap1': 900, 'fw1': 60, 'sw1': 300})
+
+    def test_offsets_are_stable_and_spread_evenly(self):
+        self.assertEqual(schedule_module.poll_offset(42, 300), schedule_module.poll_offset(42, 300))
+        per_tick = Counter(schedule_module.poll_offset(pk, 300) // 10 for pk in range(1, 3001))
+        self.assertEqual(len(per_tick), 30)
+        self.assertLess(max(per_tick.values()), 1.5 * 100)
+
+    def test_due_devices_and_lateness(self):
+        self.plain.interval = 300
+        offset = schedule_module.poll_offset(self.plain.pk, 300)
+        slot = schedule_module.EPOCH + timedelta(seconds=300 * 6000000 + offset)
+        # never polled: due only in the tick after its slot
+        self.assertIsNone(schedule_module.deadline(self.plain, slot - timedelta(seconds=1)))
+        self.assertEqual(schedule_module.deadline(self.plain, slot + timedelta(seconds=5)), slot)
+        self.assertIsNone(schedule_module.deadline(self.plain, slot + timedelta(seconds=60)))
+
+        self.plain.last_polled = slot + timedelta(seconds=2)
+        self.assertIsNone(schedule_module.deadline(self.plain, slot + timedelta(seconds=299)))
+        late = slot + timedelta(seconds=420)
+        self.assertEqual(schedule_module.deadline(self.plain, late), slot + timedelta(seconds=300))
+
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
+    def test_scheduled_poll_task_polls_due_devices(self, mock_poll):
+        mock_poll.return_value = {'cpu': 10}
+        now = timezone.now()
+        Device.objects.update(last_polled=now)
+        Device.objects.filter(pk=self.router.pk).update(last_polled=now - timedelta(seconds=95))
+
+        result = tasks.scheduled_poll_task()
+
+        self.assertEqual(result['polled'], ['192.0.2.1'])
+        self.assertGreaterEqual(result['late']['core1'], 35)
+        self.assertEqual(MetricRecord.objects.filter(metric='cpu').count(), 1)
+        self.router.refresh_from_db()
+        self.assertGreater(self.router.last_polled, now)
+        self.assertEqual(tasks.scheduled_poll_task(), {'cycle': None, 'polled': [], 'late': {}})
+
+    def test_poll_schedule_command(self):
+        out = StringIO()
+        call_command('poll_schedule', stdout=out)
+        self.assertIn('4 devices', out.getvalue())
+
+
+from . import sharding
+from .models import PollCycle
+
+
+class ShardedPollTest(TestCase):
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+
+    def test_adding_a_queue_moves_about_its_share(self):
+        keys = [f"device:{pk}" for pk in range(1, 5001)]
+        before = sharding.HashRing(["poll-a", "poll-b", "poll-c"])
+        after = sharding.HashRing(["poll-a", "poll-b", "poll-c", "poll-d"])
+        moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+        self.assertTrue(0.15 < len(moved) / len(keys) < 0.35)
+        self.assertEqual({after.node_for(key) for key in moved}, {"poll-d"})
+        shares = Counter(before.node_for(key) for key in keys)
+        self.assertLess(max(shares.values()), 1.3 * len(keys) / 3)
+
+    @override_settings(METRIC_POLL_QUEUES=["poll-a", "poll-b"])
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
+    def test_shards_complete_one_cycle_record(self, mock_poll):
+        for i in range(6):
+            Device.objects.create(hostname=f'r{i}', management_ip=f'192.0.2.{i + 1}')
+        mock_poll.return_value = {'cpu': 10}
+        queues = []
+        real_apply_async = tasks.poll_shard_task.apply_async
+
+        def apply_async(args, queue=None, **kwargs):
+            queues.append(queue)
+            return real_apply_async(args, queue=queue, **kwargs)
+
+        with patch.object(tasks.poll_shard_task, 'apply_async', side_effect=apply_async):
+            self.assertEqual(tasks.metric_poll_task(), [])
+
+        cycle = PollCycle.objects.get()
+        self.assertEqual(sorted(queues), ['poll-a', 'poll-b'])
+        self.assertEqual((cycle.shards, cycle.shards_done, cycle.devices, cycle.polled), (2, 2, 6, 6))
+        self.assertIsNotNone(cycle.finished_at)
+        self.assertEqual(MetricRecord.objects.filter(metric='cpu').count(), 6)
+        self.assertFalse(Device.objects.filter(last_polled__isnull=True).exists())
+
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
+    def test_failed_shard_still_completes_cycle(self, mock_poll):
+        Device.objects.create(hostname='r1', management_ip='192.0.2.1')
+        with patch.object(tasks, 'poll_devices', side_effect=RuntimeError('boom')), \
+             self.assertRaises(RuntimeError):
+            tasks.metric_poll_task()
+        cycle = PollCycle.objects.get()
+        self.assertEqual((cycle.shards_done, cycle.polled, cycle.failed), (1, 0, 1))
+        self.assertIsNotNone(cycle.finished_at)
+
+    @patch('inventory.poller.async_poll_metrics', new_callable=AsyncMock)
+    def test_cycle_counts_only_answering_devices_as_polled(self, mock_poll):
+        Device.objects.create(hostname='good', management_ip='192.0.2.1')
+        Device.objects.create(hostname='dead', management_ip='192.0.2.2')
+        Device.objects.create(hostname='noip')
+
+        async def poll(ip, *args, **kwargs):
+            return {'cpu': 10} if ip == '192.0.2.1' else {}
+
+        mock_poll.side_effect = poll
+        tasks.metric_poll_task()
+
+        cycle = PollCycle.objects.get()
+        self.assertEqual((cycle.devices, cycle.polled, cycle.failed), (2, 1, 1))
+        self.assertIsNotNone(cycle.finished_at)
+        self.assertIsNone(Device.objects.get(hostname='noip').last_polled)
+
+    def test_empty_cycle_is_finished(self):
+        Device.objects.create(hostname='noip')
+        tasks.metric_poll_task()
+        cycle = PollCycle.objects.get()
+        self.assertEqual((cycle.shards, cycle.devices), (0, 0))
+        self.assertIsNotNone(cycle.finished_at)
@@ -0,0 +1,182 @@
+"""Gorilla-style compression for metric series.
+
+A chunk holds consecutive samples of one series. Timestamps, in
+milliseconds since the epoch, are stored as delta-of-deltas, so a series
+polled on a fixed interval costs about one bit per timestamp. Values are
+XORed with the previous value and only the bits that changed are kept, so
+a flat or slowly moving gauge costs a bit or two per value. The first
+sample of a chunk is stored in full; a chunk decodes without reference to
+any other.
+"""
+import struct
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+# (prefix, prefix bits, value bits) for delta-of-deltas that are not zero,
+# tried in order; the last bucket holds any 64-bit value
+DOD_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+    (0b11110, 5, 20),
+    (0b11111, 5, 64),
+]
+MASK64 = (1 << 64) - 1
+
+
+def to_millis(timestamp):
+    return (timestamp - EPOCH) // MILLISECOND
+
+
+def from_millis(millis):
+    return EPOCH + millis * MILLISECOND
+
+
+def _float_bits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+
+def _bits_float(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+
+class BitWriter:
+    def __init__(self):
+        self._value = 0
+        self.bits = 0
+
+    def write(self, value, nbits):
+        self._value = (self._value << nbits) | (value & ((1 << nbits) - 1))
+        self.bits += nbits
+
+    def getvalue(self):
+        pad = -self.bits % 8
+        return (self._value << pad).to_bytes((self.bits + pad) // 8, "big")
+
+
+class BitReader:
+    def __init__(self, data):
+        self._value = int.from_bytes(data, "big")
+        self._remaining = len(data) * 8
+
+    def read(self, nbits):
+        self._remaining -= nbits
+        if self._remaining < 0:
+            raise ValueError("chunk is truncated")
+        return (self._value >> self._remaining) & ((1 << nbits) - 1)
+
+
+class ChunkEncoder:
+    """Append samples to a compressed chunk.
+
+    Timestamps are datetimes and are kept to the millisecond; they should
+    not decrease, although a chunk still decodes correctly if they do.
+    """
+
+    def __init__(self):
+        self._writer = BitWriter()
+        self.count = 0
+        self.first = None
+        self.last = None
+        self._delta = 0
+        self._value_bits = 0
+        self._leading = None
+        self._trailing = None
+
+    @classmethod
+    def from_samples(cls, samples):
+        encoder = cls()
+        for timestamp, value in samples:
+            encoder.append(timestamp, value)
+        return encoder
+
+    def append(self, timestamp, value):
+        millis = to_millis(timestamp)
+        bits = _float_bits(float(value))
+        writer = self._writer
+        if not self.count:
+            writer.write(millis, 64)
+            writer.write(bits, 64)
+            self.first = millis
+        else:
+            delta = millis - self.last
+            self._write_dod(delta - self._delta)
+            self._delta = delta
+            self._write_value(bits)
+        self.last = millis
+        self._value_bits = bits
+        self.count += 1
+
+    def _write_dod(self, dod):
+        writer = self._writer
+        if dod == 0:
+            writer.write(0, 1)
+            return
+        for prefix, prefix_bits, value_bits in DOD_BUCKETS:
+            bias = (1 << (value_bits - 1)) - 1
+            if value_bits == 64 or -bias <= dod <= bias + 1:
+                writer.write(prefix, prefix_bits)
+                writer.write(dod + bias if value_bits < 64 else dod & MASK64, value_bits)
+                return
+
+    def _write_value(self, bits):
+        writer = self._writer
+        xor = bits ^ self._value_bits
+        if not xor:
+            writer.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if self._leading is not None and leading >= self._leading and trailing >= self._trailing:
+            writer.write(0b10, 2)
+            writer.write(xor >> self._trailing, 64 - self._leading - self._trailing)
+            return
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        # 64 meaningful bits wraps to 0; a non-zero XOR never has 0
+        writer.write(meaningful, 6)
+        writer.write(xor >> trailing, meaningful)
+        self._leading, self._trailing = leading, trailing
+
+    def getvalue(self):
+        return self._writer.getvalue()
+
+
+def decode(data, count):
+    """Return the first *count* samples of a chunk as ``(timestamp, value)``."""
+    samples = []
+    if not count:
+        return samples
+    reader = BitReader(data)
+    millis = reader.read(64)
+    if millis >> 63:
+        millis -= 1 << 64
+    bits = reader.read(64)
+    samples.append((from_millis(millis), _bits_float(bits)))
+    delta = 0
+    leading = trailing = 0
+    for _ in range(count - 1):
+        ones = 0
+        while ones < len(DOD_BUCKETS) and reader.read(1):
+            ones += 1
+        if ones:
+            _, _, value_bits = DOD_BUCKETS[ones - 1]
+            raw = reader.read(value_bits)
+            if value_bits == 64:
+                dod = raw - (1 << 64) if raw >> 63 else raw
+            else:
+                dod = raw - ((1 << (value_bits - 1)) - 1)
+            delta += dod
+        millis += delta
+
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        samples.append((from_millis(millis), _bits_float(bits)))
+    return samples
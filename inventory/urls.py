@@ -18,4 +18,5 @@ urlpatterns = [
     path('api/interfaces/<int:pk>/metrics/',
          views.interface_metric_data,
          name='interface_metric_data'),
+    path('api/hosts/', views.host_search, name='host_search'),
 ]
@@ -4,7 +4,9 @@ from django.http import JsonResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.utils.dateparse import parse_datetime
-from .serializers import MetricRecordSerializer
+from .serializers import HostSerializer, MetricRecordSerializer
+from .hosts import search_hosts
+from .metrics import ROLLUP_AGGREGATES, get_store, store_for
 from .models import Device, Interface, Connection, Tag, Alert, Host
 from .forms import DeviceTagForm, DeviceCredentialsForm
 from django.contrib.auth.decorators import login_required
@@ -57,10 +59,12 @@ def device_detail(request, pk):
     ).select_related('interface_b__device') | Connection.objects.filter(
         interface_b__device=device
     ).select_related('interface_a__device')
+    changes = device.changes.order_by('-timestamp')[:50]
     return render(request, 'inventory/device_detail.html', {
         'device': device,
         'connections': connections,
         'hosts': hosts,
+        'changes': changes,
         'form': form,
     })
 
@@ -116,24 +120,30 @@ def topology_data(request):
     return JsonResponse({'nodes': nodes, 'edges': edges})
 
 
+def _series_window(request):
+    """Read ``start``, ``end``, ``resolution`` and ``aggregate`` query parameters.
+
+    ``resolution`` is the widest spacing in seconds the client can use; it
+    lets the store answer from hourly or daily rollups, reduced with
+    ``aggregate`` (avg, min, max, last or count).
+    """
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    resolution = request.GET.get('resolution', '')
+    aggregate = request.GET.get('aggregate')
+    return {
+        'start': parse_datetime(start) if start else None,
+        'end': parse_datetime(end) if end else None,
+        'resolution': int(resolution) if resolution.isdigit() else None,
+        'aggregate': aggregate if aggregate in ROLLUP_AGGREGATES else 'avg',
+    }
+
+
 @api_view(['GET'])
 def device_metric_data(request, pk, metric):
     """Return time-series metric data for a device."""
     device = Device.objects.get(pk=pk)
-    records = device.metric_records.filter(metric=metric)
-
-    start = request.GET.get('start')
-    end = request.GET.get('end')
-    if start:
-        dt = parse_datetime(start)
-        if dt:
-            records = records.filter(timestamp__gte=dt)
-    if end:
-        dt = parse_datetime(end)
-        if dt:
-            records = records.filter(timestamp__lte=dt)
-
-    records = records.order_by('timestamp')
+    records = get_store().series(metric, device=device, **_series_window(request))
     serializer = MetricRecordSerializer(records, many=True)
     return Response(serializer.data)
 
@@ -142,21 +152,9 @@ def device_metric_data(request, pk, metric):
 def interface_metric_data(request, pk):
     """Return in/out octet metrics for an interface."""
     iface = Interface.objects.get(pk=pk)
-    records = iface.metric_records.filter(metric__in=["in_octets", "out_octets"])
-
-    start = request.GET.get("start")
-    end = request.GET.get("end")
-    if start:
-        dt = parse_datetime(start)
-        if dt:
-            records = records.filter(timestamp__gte=dt)
-    if end:
-        dt = parse_datetime(end)
-        if dt:
-            records = records.filter(timestamp__lte=dt)
-
-    in_records = records.filter(metric="in_octets").order_by("timestamp")
-    out_records = records.filter(metric="out_octets").order_by("timestamp")
+    window = _series_window(request)
+    in_records = store_for("in_octets", iface).series("in_octets", interface=iface, **window)
+    out_records = store_for("out_octets", iface).series("out_octets", interface=iface, **window)
     data = {
         "in": MetricRecordSerializer(in_records, many=True).data,
         "out": MetricRecordSerializer(out_records, many=True).data,
@@ -164,6 +162,29 @@ def interface_metric_data(request, pk):
     return Response(data)
 
 
+HOST_SEARCH_LIMIT = 1000
+
+
+@api_view(["GET"])
+def host_search(request):
+    """Find hosts by ``mac``, ``oui`` (any MAC prefix), ``ip`` or ``subnet``."""
+    criteria = {
+        "mac": request.GET.get("mac"),
+        "mac_prefix": request.GET.get("oui"),
+        "ip": request.GET.get("ip"),
+        "subnet": request.GET.get("subnet"),
+    }
+    if not any(criteria.values()):
+        return Response({"detail": "Give mac, oui, ip or subnet."}, status=400)
+    limit = request.GET.get("limit", "")
+    limit = min(int(limit), HOST_SEARCH_LIMIT) if limit.isdigit() else HOST_SEARCH_LIMIT
+    try:
+        hosts = search_hosts(**criteria)[:limit]
+    except ValueError as exc:
+        return Response({"detail": str(exc)}, status=400)
+    return Response(HostSerializer(hosts, many=True).data)
+
+
 @login_required
 def alert_list(request):
     """Display active alerts and recent history."""
@@ -14,6 +14,47 @@ DISCOVERY_MODULES = config(
     cast=Csv(),
 )
 
+# SNMP session pooling
+SNMP_SESSION_IDLE_TIMEOUT = config('SNMP_SESSION_IDLE_TIMEOUT', default=300, cast=int)
+SNMP_SESSION_MAX = config('SNMP_SESSION_MAX', default=4096, cast=int)
+SNMP_VERSION = config('SNMP_VERSION', default='2c')
+SNMP_MAX_REPETITIONS = config('SNMP_MAX_REPETITIONS', default=25, cast=int)
+SNMP_MAX_OIDS_PER_PDU = config('SNMP_MAX_OIDS_PER_PDU', default=32, cast=int)
+SNMP_WALK_CACHE_TTL = config('SNMP_WALK_CACHE_TTL', default=60, cast=int)
+SNMP_WALK_CACHE_URL = config('SNMP_WALK_CACHE_URL', default='')
+SNMP_POLL_CONCURRENCY = config('SNMP_POLL_CONCURRENCY', default=200, cast=int)
+SNMP_POLL_DEVICE_CONCURRENCY = config('SNMP_POLL_DEVICE_CONCURRENCY', default=2, cast=int)
+SCAN_FULL_INTERVAL = config('SCAN_FULL_INTERVAL', default=3600, cast=int)
+# 0 picks 1 worker on SQLite and 16 on other databases
+DISCOVERY_WORKERS = config('DISCOVERY_WORKERS', default=0, cast=int)
+DISCOVERY_FANOUT_WINDOW = config('DISCOVERY_FANOUT_WINDOW', default=256, cast=int)
+DISCOVERY_REDIS_URL = config('DISCOVERY_REDIS_URL', default='')
+INTERFACE_PURGE_SCANS = config('INTERFACE_PURGE_SCANS', default=3, cast=int)
+HOST_BATCH_SIZE = config('HOST_BATCH_SIZE', default=2000, cast=int)
+METRIC_POLL_INTERVAL = config('METRIC_POLL_INTERVAL', default=300, cast=int)
+METRIC_POLL_TICK = config('METRIC_POLL_TICK', default=10, cast=int)
+METRIC_POLL_QUEUES = config('METRIC_POLL_QUEUES', default='', cast=Csv())
+SWEEP_CONCURRENCY = config('SWEEP_CONCURRENCY', default=512, cast=int)
+SWEEP_RATE = config('SWEEP_RATE', default=1000, cast=int)
+SWEEP_MIN_PREFIX = config('SWEEP_MIN_PREFIX', default=16, cast=int)
+PING_COUNT = config('PING_COUNT', default=5, cast=int)
+PING_INTERVAL = config('PING_INTERVAL', default=0.2, cast=float)
+METRIC_BATCH_SIZE = config('METRIC_BATCH_SIZE', default=1000, cast=int)
+METRIC_FLUSH_INTERVAL = config('METRIC_FLUSH_INTERVAL', default=5.0, cast=float)
+METRIC_BACKEND = config('METRIC_BACKEND', default='records')
+METRIC_CHUNK_SAMPLES = config('METRIC_CHUNK_SAMPLES', default=120, cast=int)
+METRIC_HOURLY_RETENTION_DAYS = config('METRIC_HOURLY_RETENTION_DAYS', default=90, cast=int)
+METRIC_DAILY_RETENTION_DAYS = config('METRIC_DAILY_RETENTION_DAYS', default=730, cast=int)
+METRIC_RETENTION_DAYS = config('METRIC_RETENTION_DAYS', default=30, cast=int)
+METRIC_PRUNE_BATCH_SIZE = config('METRIC_PRUNE_BATCH_SIZE', default=5000, cast=int)
+METRIC_PARTITION_INTERVAL = config('METRIC_PARTITION_INTERVAL', default='day')
+METRIC_PARTITIONS_AHEAD = config('METRIC_PARTITIONS_AHEAD', default=7, cast=int)
+METRIC_INTERFACE_BACKEND = config('METRIC_INTERFACE_BACKEND', default='')
+METRIC_RRA_DIR = config('METRIC_RRA_DIR', default=str(BASE_DIR / 'rra'))
+METRIC_RRA_STEP = config('METRIC_RRA_STEP', default=300, cast=int)
+METRIC_RRA_QUEUE_URL = config('METRIC_RRA_QUEUE_URL', default='')
+METRIC_RRA_MAX_ATTEMPTS = config('METRIC_RRA_MAX_ATTEMPTS', default=3, cast=int)
+
 SECURE_SSL_REDIRECT = config('SECURE_SSL_REDIRECT', default=not DEBUG, cast=bool)
 SESSION_COOKIE_SECURE = config('SESSION_COOKIE_SECURE', default=not DEBUG, cast=bool)
 CSRF_COOKIE_SECURE = config('CSRF_COOKIE_SECURE', default=not DEBUG, cast=bool)
@@ -124,11 +165,19 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': crontab(minute='*/5'),
     },
     'metric-poll': {
-        'task': 'inventory.tasks.metric_poll_task',
-        'schedule': crontab(minute='*/5'),
+        'task': 'inventory.tasks.scheduled_poll_task',
+        'schedule': METRIC_POLL_TICK,
     },
     'alert-check': {
         'task': 'inventory.tasks.alert_check_task',
         'schedule': crontab(minute='*/1'),
     },
+    'metric-prune': {
+        'task': 'inventory.tasks.prune_metrics_task',
+        'schedule': crontab(minute=30, hour=3),
+    },
+    'metric-partitions': {
+        'task': 'inventory.tasks.maintain_metric_partitions_task',
+        'schedule': crontab(minute=15),
+    },
 }